@@ -1,20 +1,32 @@
 import argparse
+import logging
 import sys
 
 from PySide6 import QtWidgets
 
+from battle_map_tv import image_buffer, pixel_cache, scale_detection, storage
+from battle_map_tv.batch_detection import detect_directory
+from battle_map_tv.image_cache import image_cache
+from battle_map_tv.journal import session_journal
 from battle_map_tv.settings import Settings
+from battle_map_tv.storage import compact_storage, use_storage_backend
+from battle_map_tv.storage_backends import storage_backends
 from battle_map_tv.window_gui import GuiWindow
 from battle_map_tv.window_image import ImageWindow
+from battle_map_tv.workers import collect_garbage_on_gui_thread
 
 
 def main():
     app = QtWidgets.QApplication([])
+    collect_garbage_on_gui_thread()
+    app.aboutToQuit.connect(session_journal.close)
+    session_journal.open()
 
     screens = app.screens()
 
     image_window = ImageWindow()
     image_window.resize(800, 600)
+    app.aboutToQuit.connect(image_window.cancel_autoscale)
 
     gui_window = GuiWindow()
 
@@ -27,9 +39,21 @@ def main():
     image_window.move(image_window.screen().geometry().center())
     gui_window.move(gui_window.screen().geometry().topLeft())
 
+    image_window.restore_session()
+    gui_window.restore_session()
+
     sys.exit(app.exec())
 
 
+def compact():
+    before, after = compact_storage()
+    for label, values in [("before", before), ("after", after)]:
+        print(
+            f"{label}: {values['images']} images, {values['size_bytes'] / 1024:.1f} kB, "
+            f"loaded in {1000 * values['load_seconds']:.1f} ms"
+        )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -41,8 +65,92 @@ if __name__ == "__main__":
         required=False,
         help="Path to your maps",
     )
+    parser.add_argument(
+        "--storage",
+        dest="storage",
+        choices=list(storage_backends),
+        required=False,
+        help="Where to store settings, sqlite is used automatically once it has been chosen",
+    )
+    parser.add_argument(
+        "--max-stored-images",
+        dest="max_stored_images",
+        type=int,
+        default=storage.max_stored_images,
+        help="Forget the settings of the least recently used images beyond this number",
+    )
+    parser.add_argument(
+        "--max-storage-size",
+        dest="max_storage_size",
+        type=int,
+        required=False,
+        help="Forget the settings of the least recently used images beyond this size in kB",
+    )
+    parser.add_argument(
+        "--detection-engine",
+        dest="detection_engine",
+        choices=list(scale_detection.detection_engines),
+        default=scale_detection.default_engine,
+        help="How autoscale detects the grid: by its lines, or by how it repeats",
+    )
+    parser.add_argument(
+        "--max-image-size",
+        dest="max_image_size",
+        type=int,
+        default=image_buffer.max_image_bytes // 1024**2,
+        help="Decode larger maps at a lower resolution, so they take at most this many MB",
+    )
+    parser.add_argument(
+        "--image-cache-size",
+        dest="image_cache_size",
+        type=int,
+        default=image_cache.memory_budget // 1024**2,
+        help="Keep decoded maps in memory up to this size in MB, for switching between them quickly",
+    )
+    parser.add_argument(
+        "--pixel-cache-size",
+        dest="pixel_cache_size",
+        type=int,
+        default=pixel_cache.max_size_bytes // 1024**2,
+        help="Keep decoded maps on disk up to this size in MB, so they open without decoding",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("compact", help="Shrink the stored settings to the limits and exit")
+    detect_parser = subparsers.add_parser(
+        "detect",
+        help="Detect the scale of all maps in a directory ahead of time, so autoscale is instant",
+    )
+    detect_parser.add_argument(
+        "directory",
+        nargs="?",
+        help="Directory with maps, by default the --default-directory",
+    )
+    detect_parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        required=False,
+        help="Number of processes, by default one per core",
+    )
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     Settings.create(default_directory=args.default_directory)
+    storage.max_stored_images = args.max_stored_images
+    if args.max_storage_size is not None:
+        storage.max_storage_size_bytes = 1024 * args.max_storage_size
+    use_storage_backend(args.storage)
+    scale_detection.default_engine = args.detection_engine
+    image_buffer.max_image_bytes = 1024**2 * args.max_image_size
+    image_cache.memory_budget = 1024**2 * args.image_cache_size
+    pixel_cache.max_size_bytes = 1024**2 * args.pixel_cache_size
 
-    main()
+    if args.command == "compact":
+        compact()
+    elif args.command == "detect":
+        directory = args.directory or args.default_directory
+        if directory is None:
+            parser.error("give a directory or a --default-directory to detect")
+        detect_directory(directory, workers=args.workers)
+    else:
+        main()
@@ -19,13 +19,16 @@ class BaseShape(QObject):
     label: QGraphicsTextItem
     label_background: QGraphicsRectItem
     size: float
+    shape_id: Optional[str] = None
     angle_snap_factor = 32 / 2 / math.pi
 
     on_right_click = Signal(object)
+    on_move = Signal(object)
 
     def __init__(self, scene: QGraphicsScene):
         super().__init__()
         self.shape.mousePressEvent = self._mouse_press_event  # type: ignore[method-assign]
+        self.shape.mouseReleaseEvent = self._mouse_release_event  # type: ignore[method-assign]
         self.scene = scene
         self.scene.addItem(self.shape)
 
@@ -42,6 +45,10 @@ class BaseShape(QObject):
             self.remove()
             self.on_right_click.emit(self)
 
+    def _mouse_release_event(self, event: QGraphicsSceneMouseEvent):
+        type(self.shape).mouseReleaseEvent(self.shape, event)
+        self.on_move.emit(self)
+
     def _get_angle_radians(self, x1: int, y1: int, x2: int, y2: int, grid: Grid) -> float:
         angle = math.atan2(y2 - y1, x2 - x1)
         if grid.enable_snap:
@@ -1,4 +1,4 @@
-from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
 
 from PySide6.QtGui import QMouseEvent, Qt
 
@@ -8,6 +8,7 @@ from battle_map_tv.area_of_effect import (
 )
 from battle_map_tv.area_of_effect.base_shape import BaseShape
 from battle_map_tv.grid import Grid
+from battle_map_tv.journal import SessionKeys, session_journal
 
 if TYPE_CHECKING:
     from battle_map_tv.window_image import ImageWindow
@@ -26,6 +27,7 @@ class AreaOfEffectManager:
         self.temp_obj: Optional[BaseShape] = None
         self.callback: Optional[Callable] = None
         self._previous_size: Optional[float] = None
+        self._next_shape_id = 0
 
     def wait_for(self, shape: str, callback: Callable):
         self.waiting_for = shape
@@ -43,6 +45,21 @@ class AreaOfEffectManager:
         for shape_obj in self._store:
             shape_obj.remove()
         self._store = []
+        session_journal.delete(SessionKeys.area_of_effect)
+
+    def restore(self, shapes: Dict[str, Dict[str, Any]]):
+        for shape_id, parameters in shapes.items():
+            shape_obj = self._create_shape(
+                shape=parameters["shape"],
+                rasterize=parameters["rasterize"],
+                color=parameters["color"],
+                points=parameters["points"],
+                size=parameters["size"],
+            )
+            if "position" in parameters:
+                shape_obj.shape.setPos(*parameters["position"])
+            self._add_to_store(shape_obj, shape_id=shape_id)
+            self._next_shape_id = max(self._next_shape_id, int(shape_id) + 1)
 
     def mouse_press_event(self, event: QMouseEvent) -> bool:
         if self.waiting_for is not None:
@@ -54,7 +71,7 @@ class AreaOfEffectManager:
         if self.waiting_for is not None:
             if self.temp_obj is not None:
                 self.temp_obj.remove()
-            self.temp_obj = self._create_shape_obj(event=event)
+            self.temp_obj = self._create_shape(**self._get_shape_parameters(event=event))
             if self.grid.enable_snap:
                 assert self.temp_obj
                 self.temp_obj.add_label(x=event.pos().x(), y=event.pos().y(), grid=self.grid)
@@ -64,36 +81,80 @@ class AreaOfEffectManager:
     def mouse_release_event(self, event: QMouseEvent) -> bool:
         if self.waiting_for is not None:
             assert self.callback
-            shape_obj = self._create_shape_obj(event=event)
-            shape_obj.set_is_movable()
-            self._store.append(shape_obj)
+            parameters = self._get_shape_parameters(event=event)
+            shape_obj = self._create_shape(**parameters)
+            shape_id = str(self._next_shape_id)
+            self._next_shape_id += 1
+            self._add_to_store(shape_obj, shape_id=shape_id)
+            session_journal.record(
+                SessionKeys.area_of_effect,
+                shape_id,
+                value={**parameters, "size": shape_obj.size},
+            )
             self.callback()
             self.cancel()
             return True
         return False
 
-    def _create_shape_obj(self, event):
+    def _get_shape_parameters(self, event) -> Dict[str, Any]:
         assert self.waiting_for
         assert self.start_point
+        x1, y1 = self.start_point
+        if self.grid.enable_snap:
+            x1, y1 = self.grid.snap_to_grid(x=x1, y=y1)
+        return {
+            "shape": self.waiting_for,
+            "rasterize": self.rasterize,
+            "color": self.color,
+            "points": (x1, y1, event.pos().x(), event.pos().y()),
+            "size": self._previous_size if event.modifiers() == Qt.ShiftModifier else None,  # type: ignore[attr-defined]
+        }
+
+    def _create_shape(
+        self,
+        shape: str,
+        rasterize: bool,
+        color: str,
+        points: Tuple[int, int, int, int],
+        size: Optional[float],
+    ) -> BaseShape:
         shapes_dict = (
             area_of_effect_rasterized_shapes_to_class
-            if self.rasterize
+            if rasterize
             else area_of_effect_shapes_to_class
         )
-        shape_cls = shapes_dict[self.waiting_for]
-        x1, y1 = self.start_point
-        if self.grid.enable_snap:
-            x1, y1 = self.grid.snap_to_grid(x=x1, y=y1)
+        shape_cls = shapes_dict[shape]
+        x1, y1, x2, y2 = points
         shape_obj = shape_cls(
             x1=x1,
             y1=y1,
-            x2=event.pos().x(),
-            y2=event.pos().y(),
+            x2=x2,
+            y2=y2,
             grid=self.grid,
             scene=self.scene,
-            size=self._previous_size if event.modifiers() == Qt.ShiftModifier else None,  # type: ignore[attr-defined]
+            size=size,
         )
-        shape_obj.set_color(color=self.color)
-        shape_obj.on_right_click.connect(lambda _shape: self._store.remove(_shape))
+        shape_obj.set_color(color=color)
         self._previous_size = shape_obj.size
         return shape_obj
+
+    def _add_to_store(self, shape_obj: BaseShape, shape_id: str):
+        shape_obj.shape_id = shape_id
+        shape_obj.set_is_movable()
+        shape_obj.on_right_click.connect(self._remove_from_store)
+        shape_obj.on_move.connect(self._store_shape_position)
+        self._store.append(shape_obj)
+
+    def _remove_from_store(self, shape_obj: BaseShape):
+        self._store.remove(shape_obj)
+        assert shape_obj.shape_id is not None
+        session_journal.delete(SessionKeys.area_of_effect, shape_obj.shape_id)
+
+    def _store_shape_position(self, shape_obj: BaseShape):
+        if shape_obj not in self._store:
+            return
+        assert shape_obj.shape_id is not None
+        position = (shape_obj.shape.pos().x(), shape_obj.shape.pos().y())
+        session_journal.record(
+            SessionKeys.area_of_effect, shape_obj.shape_id, "position", value=position
+        )
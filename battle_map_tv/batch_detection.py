@@ -0,0 +1,92 @@
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Set
+
+import cv2
+
+from battle_map_tv import scale_detection
+from battle_map_tv.fingerprint import image_fingerprint
+from battle_map_tv.scale_cache import get_cached_scale, set_cached_scale
+from battle_map_tv.scale_detection import ImageScale, detect_image_scale
+
+image_extensions = {".bmp", ".gif", ".jpeg", ".jpg", ".png", ".tif", ".tiff", ".webp"}
+
+
+def find_images(directory: str) -> List[str]:
+    image_paths = []
+    for root, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() in image_extensions:
+                image_paths.append(os.path.join(root, filename))
+    return sorted(image_paths)
+
+
+def detect_directory(
+    directory: str,
+    engine: Optional[str] = None,
+    workers: Optional[int] = None,
+) -> Dict[str, int]:
+    """Detect the scale of all images in a directory and its subdirectories, and cache it.
+
+    Images with a cached scale are skipped, so an interrupted run continues where it stopped.
+    Returns how many images were detected, skipped and failed.
+    """
+    engine = engine or scale_detection.default_engine
+    counts = {"detected": 0, "skipped": 0, "failed": 0}
+    image_keys: Dict[str, str] = {}
+    keys_to_detect: Set[str] = set()
+    for image_path in find_images(directory):
+        image_key = image_fingerprint(image_path)
+        # copies of the same map only need to be detected once
+        if image_key in keys_to_detect or get_cached_scale(image_key, engine=engine):
+            counts["skipped"] += 1
+        else:
+            image_keys[image_path] = image_key
+            keys_to_detect.add(image_key)
+    n_total = len(image_keys)
+    print(f"{counts['skipped']} images done before, {n_total} to detect")
+    if not image_keys:
+        return counts
+
+    # spawn fresh processes, forking a process that uses Qt and threads is not safe
+    context = multiprocessing.get_context("spawn")
+    executor = ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=_init_worker
+    )
+    futures: Dict[Future, str] = {
+        executor.submit(_detect, image_path, engine): image_path for image_path in image_keys
+    }
+    try:
+        for i, future in enumerate(as_completed(futures), start=1):
+            image_path = futures[future]
+            try:
+                image_scale: ImageScale = future.result()
+            except Exception as e:
+                counts["failed"] += 1
+                print(f"[{i}/{n_total}] {image_path}: failed, {e}")
+                continue
+            set_cached_scale(image_keys[image_path], image_scale, engine=engine)
+            counts["detected"] += 1
+            print(
+                f"[{i}/{n_total}] {image_path}: {image_scale.px_per_inch:.1f} px per inch "
+                f"(confidence {image_scale.best.confidence:.2f})"
+            )
+    except KeyboardInterrupt:
+        print("Interrupted, run again to continue")
+        raise
+    finally:
+        # shutdown waits for the queued images too, only let the running ones finish
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+    return counts
+
+
+def _init_worker():
+    # every core already has a process, don't let OpenCV start threads on top of that
+    cv2.setNumThreads(1)
+
+
+def _detect(image_path: str, engine: str) -> ImageScale:
+    return detect_image_scale(image_path, engine=engine)
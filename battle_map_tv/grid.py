@@ -5,6 +5,7 @@ from PySide6.QtCore import QLineF
 from PySide6.QtGui import QColor, QPen
 from PySide6.QtWidgets import QGraphicsItemGroup
 
+from battle_map_tv.journal import SessionKeys, session_journal
 from battle_map_tv.storage import (
     ImageKeys,
     StorageKeys,
@@ -12,7 +13,7 @@ from battle_map_tv.storage import (
     set_image_in_storage,
     set_in_storage,
 )
-from battle_map_tv.utils import get_image_filename, get_image_window_size_px
+from battle_map_tv.utils import get_image_key, get_image_window_size_px
 
 
 class Grid:
@@ -43,15 +44,16 @@ class Grid:
 
     def set_size(self, value: int):
         self.pixels_per_square = value
-        image_filename = get_image_filename()
-        if image_filename:
+        image_key = get_image_key()
+        if image_key:
             set_image_in_storage(
-                image_filename=image_filename,
+                image_key=image_key,
                 key=ImageKeys.grid_pixels_per_square,
                 value=value,
             )
         else:
             set_in_storage(StorageKeys.pixels_per_square, value)
+        session_journal.record(SessionKeys.grid, "pixels_per_square", value=value)
         self.calculate()
 
     def get_lines(self, axis: int) -> List[Tuple[int, int, int, int]]:
@@ -1,31 +1,224 @@
+import math
 import os.path
-from typing import Tuple
+from collections import OrderedDict
+from functools import partial
+from typing import Callable, Optional, Tuple
 
-from PySide6.QtGui import QPixmap
-from PySide6.QtWidgets import QGraphicsPixmapItem, QGraphicsScene
+from PySide6.QtCore import QPointF, QRect, QRectF, Qt, QTimer
+from PySide6.QtGui import QImage, QPainter, QPixmap, QTransform
+from PySide6.QtWidgets import QGraphicsItem, QGraphicsScene
+from shiboken6 import isValid
 
 from battle_map_tv.events import EventKeys, global_event_dispatcher
+from battle_map_tv.fingerprint import image_fingerprint
 from battle_map_tv.grid import Grid
-from battle_map_tv.scale_detection import find_image_scale
+from battle_map_tv.image_buffer import ImageBuffer
+from battle_map_tv.journal import SessionKeys, session_journal
+from battle_map_tv.scale_cache import get_cached_scale, invalidate_cached_scale, set_cached_scale
+from battle_map_tv.scale_detection import (
+    ImageScale,
+    find_image_scale,
+    read_image_size,
+    scale_image_scale,
+)
 from battle_map_tv.storage import (
     ImageKeys,
     StorageKeys,
     get_image_from_storage,
+    rename_image_in_storage,
     set_image_in_storage,
     set_in_storage,
 )
+from battle_map_tv.workers import Worker
 
+# the tiles of the image pyramid are this many pixels wide and high
+tile_size = 512
+# the last painted tiles are kept up to this many bytes
+tile_cache_bytes = 256 * 1024**2
+# the image is resampled to the screen once it has not moved for this many milliseconds
+resample_delay_ms = 300
 
-class CustomGraphicsPixmapItem(QGraphicsPixmapItem):
-    def __init__(self, image_path: str):
-        pixmap = QPixmap(image_path)
-        if pixmap.isNull():
-            raise ValueError(f"Failed to load '{image_path}'")
-        super().__init__(pixmap)
-        self.image_filename = os.path.basename(image_path)
+
+class TiledPixmapItem(QGraphicsItem):
+    """The image as tiles at several resolutions, in the coordinates of its full resolution pixels.
+
+    Level 0 of the pyramid is the image itself, every next level has half the resolution. Only the
+    tiles that are visible are painted, from the level that still has at least one pixel per pixel
+    on the screen. A tile is made when it is first painted, the last painted tiles are kept.
+
+    The image can be smaller than `image_size`, like the preview while the image loads, it is
+    stretched over the whole image then.
+
+    Once the image stops moving, the part on the screen is resampled in the background to the
+    pixels of the screen. As long as nothing moves, that is painted as is instead of the tiles.
+    """
+
+    def __init__(
+        self,
+        image_key: str,
+        image_size: Tuple[int, int],
+        buffer: Optional[ImageBuffer] = None,
+    ):
+        super().__init__()
+        self.image_key = image_key
+        self.image_size = image_size
+        self.buffer: Optional[ImageBuffer] = None
+        self._tiles: "OrderedDict[Tuple[int, int, int], QPixmap]" = OrderedDict()
+        self._tiles_bytes = 0
+        # the transform, pixel ratio and screen it was made for, where it goes and the pixmap
+        self._screen_pixmap: Optional[Tuple[QTransform, float, QRect, QPointF, QPixmap]] = None
+        self._resample_request: Optional[Tuple[QTransform, float, QRect]] = None
+        self._resample_worker: Optional[Worker] = None
+        self._resample_timer = QTimer()
+        self._resample_timer.setSingleShot(True)
+        self._resample_timer.setInterval(resample_delay_ms)
+        self._resample_timer.timeout.connect(self._resample)
         self.setFlag(self.GraphicsItemFlag.ItemIsMovable)
         self.setFlag(self.GraphicsItemFlag.ItemSendsGeometryChanges)
-        self.setTransformOriginPoint(pixmap.width() / 2, pixmap.height() / 2)
+        # for the exposed rect in paint
+        self.setFlag(self.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+        self.setTransformOriginPoint(self.image_size[0] / 2, self.image_size[1] / 2)
+        if buffer is not None:
+            self.set_buffer(buffer)
+
+    def set_buffer(self, buffer: ImageBuffer):
+        self.buffer = buffer
+        self._tiles.clear()
+        self._tiles_bytes = 0
+        # resample the screen again from these pixels, at the next paint
+        self._screen_pixmap = None
+        self._resample_request = None
+        self._resample_timer.stop()
+        if self._resample_worker is not None:
+            self._resample_worker.cancel()
+            self._resample_worker = None
+        self.update()
+
+    @property
+    def pixmap_factor(self) -> float:
+        """Pixels of the image per pixel of the buffer."""
+        if self.buffer is None:
+            return 1.0
+        return self.image_size[0] / self.buffer.size[0]
+
+    def boundingRect(self) -> QRectF:
+        return QRectF(0, 0, *self.image_size)
+
+    def paint(self, painter, option, widget=None):
+        if self.buffer is None:
+            return
+        request = (
+            painter.worldTransform(),
+            painter.device().devicePixelRatio(),
+            painter.device().rect(),
+        )
+        if self._screen_pixmap is not None and self._screen_pixmap[:3] == request:
+            *_, position, pixmap = self._screen_pixmap
+            painter.save()
+            painter.resetTransform()
+            painter.drawPixmap(position, pixmap)
+            painter.restore()
+            return
+        if request != self._resample_request:
+            self._resample_request = request
+            self._resample_timer.start()
+        buffer_width, buffer_height = self.buffer.size
+        factor = self.pixmap_factor
+        device_pixels = option.levelOfDetailFromTransform(painter.worldTransform())
+        device_pixels *= painter.device().devicePixelRatio()
+        level = max(0, math.floor(math.log2(1 / max(device_pixels * factor, 1e-9))))
+        # source pixels per tile
+        step = tile_size * 2**level
+        # the part of the image on the screen, the exposed rect alone can be the whole image
+        exposed = option.exposedRect.intersected(
+            painter.worldTransform().inverted()[0].mapRect(QRectF(painter.device().rect()))
+        )
+        if painter.hasClipping():
+            exposed = exposed.intersected(painter.clipBoundingRect())
+        columns = range(
+            max(0, int(exposed.left() / factor) // step),
+            min(-(-buffer_width // step), int(exposed.right() / factor) // step + 1),
+        )
+        rows = range(
+            max(0, int(exposed.top() / factor) // step),
+            min(-(-buffer_height // step), int(exposed.bottom() / factor) // step + 1),
+        )
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+        for row in rows:
+            for column in columns:
+                source = QRect(column * step, row * step, step, step).intersected(
+                    QRect(0, 0, buffer_width, buffer_height)
+                )
+                target = QRectF(
+                    source.x() * factor,
+                    source.y() * factor,
+                    source.width() * factor,
+                    source.height() * factor,
+                )
+                pixmap = self._tile(level, column, row, source)
+                painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
+
+    def _tile(self, level: int, column: int, row: int, source: QRect) -> QPixmap:
+        key = (level, column, row)
+        pixmap = self._tiles.get(key)
+        if pixmap is not None:
+            self._tiles.move_to_end(key)
+            return pixmap
+        assert self.buffer is not None
+        pixmap = QPixmap.fromImage(self.buffer.tile(source, factor=2**level))
+        self._tiles[key] = pixmap
+        self._tiles_bytes += pixmap.width() * pixmap.height() * 4
+        while self._tiles_bytes > tile_cache_bytes and len(self._tiles) > 1:
+            _, removed = self._tiles.popitem(last=False)
+            self._tiles_bytes -= removed.width() * removed.height() * 4
+        return pixmap
+
+    def _resample(self):
+        # a deleted scene deletes its items, before the timer or the worker is done
+        if not isValid(self) or self.scene() is None:
+            return
+        if self.buffer is None or self._resample_request is None:
+            return
+        world_transform, ratio, screen = self._resample_request
+        transform = (
+            QTransform.fromScale(self.pixmap_factor, self.pixmap_factor)
+            * world_transform
+            * QTransform.fromScale(ratio, ratio)
+        )
+        target = (
+            transform.mapRect(QRectF(0, 0, *self.buffer.size))
+            .toAlignedRect()
+            .intersected(QTransform.fromScale(ratio, ratio).mapRect(QRectF(screen)).toRect())
+        )
+        if self._resample_worker is not None:
+            self._resample_worker.cancel()
+        worker = Worker(_transform_buffer, self.buffer, transform, target)
+        worker.signals.finished.connect(
+            partial(
+                self._resampled,
+                self.buffer,
+                self._resample_request,
+                QPointF(target.topLeft()) / ratio,
+            ),
+            Qt.ConnectionType.QueuedConnection,
+        )
+        self._resample_worker = worker
+        worker.start()
+
+    def _resampled(
+        self,
+        buffer: ImageBuffer,
+        request: Tuple[QTransform, float, QRect],
+        position: QPointF,
+        qimage: QImage,
+    ):
+        # the image may have been replaced while resampling
+        if not isValid(self) or buffer is not self.buffer:
+            return
+        pixmap = QPixmap.fromImage(qimage)
+        pixmap.setDevicePixelRatio(request[1])
+        self._screen_pixmap = (*request, position, pixmap)
+        self.update()
 
     def wheelEvent(self, event):
         value = self.scale() + event.delta() / 1500
@@ -37,23 +230,33 @@ class CustomGraphicsPixmapItem(QGraphicsPixmapItem):
 
     def set_position(self, position: Tuple[int, int]):
         self.setPos(
-            position[0] - self.pixmap().width() // 2,
-            position[1] - self.pixmap().height() // 2,
+            position[0] - self.image_size[0] // 2,
+            position[1] - self.image_size[1] // 2,
         )
         self.store_position()
 
     def store_position(self):
         position = (
-            self.pos().x() + self.pixmap().width() // 2,
-            self.pos().y() + self.pixmap().height() // 2,
+            self.pos().x() + self.image_size[0] // 2,
+            self.pos().y() + self.image_size[1] // 2,
         )
-        set_image_in_storage(self.image_filename, ImageKeys.position, position)
+        set_image_in_storage(self.image_key, ImageKeys.position, position)
+        session_journal.record(SessionKeys.image, "position", value=position)
 
     def set_scale(self, value: float, dispatch_event: bool = True):
         self.setScale(value)
         if dispatch_event:
             global_event_dispatcher.dispatch_event(EventKeys.change_scale, value)
-        set_image_in_storage(self.image_filename, ImageKeys.scale, value)
+        set_image_in_storage(self.image_key, ImageKeys.scale, value)
+        session_journal.record(SessionKeys.image, "scale", value=value)
+
+
+def _transform_buffer(
+    buffer: ImageBuffer, transform: QTransform, target: QRect, progress: Callable[..., None]
+) -> QImage:
+    # a worker that is replaced before it starts ends here
+    progress()
+    return buffer.transformed(transform, target)
 
 
 class Image:
@@ -63,32 +266,59 @@ class Image:
         scene: QGraphicsScene,
         window_width_px: int,
         window_height_px: int,
+        buffer: Optional[ImageBuffer] = None,
     ):
+        """Show an image, with the scale, position and rotation it had before.
+
+        Without a `buffer` only the size of the image is read, its pixels are shown once they are
+        passed to `set_buffer`, or a preview of them to `set_preview`. The buffer can have a lower
+        resolution, positions and scales are always in the pixels of the image file.
+        """
         self.rotation = 0
 
         image_path = os.path.abspath(image_path)
         self.filepath: str = image_path
         self.image_filename = os.path.basename(image_path)
+        # raises a ValueError for files that are missing or not an image
+        image_size = read_image_size(image_path)
+        try:
+            self.image_key = image_fingerprint(image_path)
+        except OSError as e:
+            raise ValueError(f"Failed to read '{image_path}'") from e
         set_in_storage(key=StorageKeys.previous_image, value=image_path)
+        # settings used to be stored by filename
+        rename_image_in_storage(self.image_filename, self.image_key)
 
         self.scene = scene
+        # the scale that autoscale used last, also when it was not cached, with the candidate it
+        # picked and the scale it set
+        self.image_scale: Optional[ImageScale] = None
+        self._autoscaled: Optional[Tuple[int, float]] = None
 
-        self.pixmap_item = CustomGraphicsPixmapItem(image_path)
+        # decoded once, the tiles and the scale detection are made from its pixels
+        self.buffer = buffer
+        self.pixmap_item = TiledPixmapItem(
+            image_key=self.image_key,
+            image_size=image_size,
+            buffer=buffer,
+        )
         self.scene.addItem(self.pixmap_item)
+        session_journal.record(SessionKeys.image, value={"path": image_path})
 
         try:
             self.rotation = get_image_from_storage(
-                self.image_filename,
+                self.image_key,
                 ImageKeys.rotation,
             )
         except KeyError:
             pass
         else:
             self.pixmap_item.setRotation(self.rotation)
+            session_journal.record(SessionKeys.image, "rotation", value=self.rotation)
 
         try:
             scale = get_image_from_storage(
-                self.image_filename,
+                self.image_key,
                 ImageKeys.scale,
             )
         except KeyError:
@@ -98,7 +328,7 @@ class Image:
 
         try:
             position = get_image_from_storage(
-                self.image_filename,
+                self.image_key,
                 ImageKeys.position,
             )
         except KeyError:
@@ -107,11 +337,20 @@ class Image:
             self.pixmap_item.set_position(position)
 
     def _fit_image_to_window(self, window_width_px: int, window_height_px: int):
-        image_width = self.pixmap_item.pixmap().width()
-        image_height = self.pixmap_item.pixmap().height()
+        image_width, image_height = self.pixmap_item.image_size
         scale = min(window_width_px / image_width, window_height_px / image_height)
         self.scale(scale)
 
+    def set_preview(self, preview: QImage):
+        """Show a smaller version of the image until it is loaded."""
+        if self.buffer is None:
+            self.pixmap_item.set_buffer(ImageBuffer(preview))
+
+    def set_buffer(self, buffer: ImageBuffer):
+        """Show the loaded image, in place of the preview."""
+        self.buffer = buffer
+        self.pixmap_item.set_buffer(buffer)
+
     def delete(self):
         self.scene.removeItem(self.pixmap_item)
 
@@ -120,14 +359,86 @@ class Image:
         self.pixmap_item.set_position(position)
 
     def rotate(self):
-        self.rotation = (self.rotation + 90) % 360
+        self.set_rotation((self.rotation + 90) % 360)
+
+    def set_rotation(self, value: int):
+        self.rotation = value
         self.pixmap_item.setRotation(self.rotation)
-        set_image_in_storage(self.image_filename, ImageKeys.rotation, self.rotation)
+        set_image_in_storage(self.image_key, ImageKeys.rotation, self.rotation)
+        session_journal.record(SessionKeys.image, "rotation", value=self.rotation)
 
     def scale(self, value: float, dispatch_event: bool = True):
         self.pixmap_item.set_scale(value, dispatch_event=dispatch_event)
 
-    def autoscale(self, grid: Grid):
-        image_px_per_square = find_image_scale(self.filepath)
-        scale = grid.pixels_per_square / image_px_per_square
-        self.scale(scale)
+    def cached_image_scale(self, redetect: bool = False) -> Optional[ImageScale]:
+        """The previously detected scale of this image, discarded when `redetect` is set.
+
+        A quick detection that ran out of time is not cached, but is kept until the next one.
+        """
+        if redetect:
+            invalidate_cached_scale(self.image_key)
+            self.image_scale = None
+            return None
+        image_scale = get_cached_scale(self.image_key)
+        return image_scale if image_scale is not None else self.image_scale
+
+    def detect_image_scale(
+        self,
+        progress: Optional[Callable[[str, int], None]] = None,
+        time_budget: Optional[float] = None,
+    ) -> ImageScale:
+        """Detect the scale of the image and cache it, this takes a while.
+
+        A result cut short by the `time_budget` is not cached, so it can be refined later.
+        """
+        image = self.buffer if self.buffer is not None else self.filepath
+        result = find_image_scale(image, progress=progress, time_budget=time_budget)
+        image_scale = result.image_scale
+        if self.buffer is not None and self.buffer.size != self.pixmap_item.image_size:
+            image_scale = scale_image_scale(
+                image_scale, self.pixmap_item.image_size[0] / self.buffer.size[0]
+            )
+        if not result.timed_out:
+            set_cached_scale(self.image_key, image_scale)
+        return image_scale
+
+    def autoscale(self, grid: Grid, image_scale: ImageScale, step: Optional[int] = None):
+        """Scale the image so its grid matches the overlay grid.
+
+        With `step`, the candidate scale that many after the one of the previous autoscale is
+        used, while the image is still at that scale. Otherwise it starts at the detected scale.
+        """
+        candidates = image_scale.candidates or [image_scale.px_per_inch]
+        index = 0
+        if step is not None and self._autoscaled is not None:
+            previous_index, previous_scale = self._autoscaled
+            if abs(self.pixmap_item.scale() - previous_scale) < 1e-6:
+                index = (previous_index + step) % len(candidates)
+        self.scale(grid.pixels_per_square / candidates[index])
+        self.image_scale = image_scale
+        # the scale controls round the scale they pass back
+        self._autoscaled = (index, self.pixmap_item.scale())
+
+    def align(self, grid: Grid, image_scale: ImageScale):
+        """Move the image the least so its grid lines are on the overlay grid, after `autoscale`."""
+        # where a vertical and a horizontal line of the image cross, in the window
+        crossing = self.pixmap_item.mapToScene(
+            QPointF(image_scale.vertical.phase, image_scale.horizontal.phase)
+        )
+        # only move along the axes on which lines were found
+        found = [bool(image_scale.vertical.rhos), bool(image_scale.horizontal.rhos)]
+        if self.rotation % 180:
+            found.reverse()
+        shift = [0.0, 0.0]
+        for axis, value in enumerate((crossing.x(), crossing.y())):
+            if found[axis]:
+                ppi = grid.pixels_per_square
+                shift[axis] = (grid.offset[axis] - value + ppi / 2) % ppi - ppi / 2
+        width, height = self.pixmap_item.image_size
+        position = self.pixmap_item.pos()
+        self.pixmap_item.set_position(
+            (
+                round(position.x() + width // 2 + shift[0]),
+                round(position.y() + height // 2 + shift[1]),
+            )
+        )
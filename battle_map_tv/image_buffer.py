@@ -0,0 +1,296 @@
+import math
+import mmap
+import os.path
+import struct
+from typing import IO, Callable, Optional, Tuple
+
+import cv2
+import numpy as np
+from PySide6.QtCore import QRect, QRectF, QSize, Qt
+from PySide6.QtGui import QImage, QImageIOHandler, QImageReader, QTransform
+
+# the longest side of the preview that is shown while a larger image is loading
+preview_size = 1024
+# an image is decoded at a lower resolution when its pixels would take more memory than this
+max_image_bytes = 512 * 1024**2
+
+# images beyond the allocation limit of Qt are decoded with OpenCV, reduced by a power of two
+reduced_imread_modes = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# the header of a raw image file, followed by its pixels as they are in memory
+_raw_header = struct.Struct("<4s5I8x")
+_raw_magic = b"BMTV"
+_raw_version = 1
+
+
+class ImageBuffer:
+    """The pixels of an image, decoded once and shared by the display and the scale detection.
+
+    The pixels are kept in a `QImage` in the format that Qt paints without converting. `array` is
+    a read-only view on the same memory, with the channels in the BGRA order of OpenCV.
+    """
+
+    def __init__(self, qimage: QImage, filepath: str = ""):
+        if qimage.isNull():
+            raise ValueError(f"Failed to load '{filepath}'")
+        if qimage.hasAlphaChannel():
+            qimage.convertTo(QImage.Format.Format_ARGB32_Premultiplied)
+        else:
+            qimage.convertTo(QImage.Format.Format_RGB32)
+        self.qimage = qimage
+        self.filepath = filepath
+        # the memory the pixels are in, when the image doesn't own them
+        self.mapped: Optional[mmap.mmap] = None
+        array = np.frombuffer(qimage.constBits(), dtype=np.uint8)
+        array = array.reshape(qimage.height(), qimage.bytesPerLine() // 4, 4)
+        self.array = array[:, : qimage.width()]
+
+    @classmethod
+    def from_file(cls, filepath: str, size: Optional[QSize] = None) -> "ImageBuffer":
+        """Decode an image, at a lower resolution when a smaller `size` is given.
+
+        Images beyond the allocation limit of Qt are decoded with OpenCV instead, which reduces
+        JPEG files by a power of two while decoding them.
+        """
+        reader = QImageReader(filepath)
+        if size is None or not size.isValid():
+            size = reader.size()
+        if size.isValid() and not _within_allocation_limit(size, full_size=reader.size()):
+            return cls(_read_with_opencv(filepath, size), filepath=filepath)
+        if size != reader.size():
+            reader.setScaledSize(size)
+        qimage = reader.read()
+        if qimage.isNull():
+            raise ValueError(f"Failed to load '{filepath}': {reader.errorString()}")
+        return cls(qimage, filepath=filepath)
+
+    @classmethod
+    def from_raw_file(cls, raw_filepath: str, filepath: str = "") -> "ImageBuffer":
+        """Map the pixels written by `write_raw` into memory, without reading or copying them."""
+        with open(raw_filepath, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mapped) < _raw_header.size:
+            raise ValueError(f"Not a raw image: '{raw_filepath}'")
+        magic, version, width, height, bytes_per_line, image_format = _raw_header.unpack_from(
+            mapped
+        )
+        if (
+            magic != _raw_magic
+            or version != _raw_version
+            or len(mapped) != _raw_header.size + height * bytes_per_line
+        ):
+            raise ValueError(f"Not a raw image: '{raw_filepath}'")
+        qimage = QImage(
+            memoryview(mapped)[_raw_header.size :],
+            width,
+            height,
+            bytes_per_line,
+            QImage.Format(image_format),
+        )
+        buffer = cls(qimage, filepath=filepath)
+        buffer.mapped = mapped
+        return buffer
+
+    def write_raw(self, f: IO[bytes]):
+        """Write the pixels as they are in memory, after a header, for `from_raw_file`."""
+        qimage = self.qimage
+        f.write(
+            _raw_header.pack(
+                _raw_magic,
+                _raw_version,
+                qimage.width(),
+                qimage.height(),
+                qimage.bytesPerLine(),
+                qimage.format().value,
+            )
+        )
+        f.write(np.frombuffer(qimage.constBits(), dtype=np.uint8).data)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.qimage.width(), self.qimage.height()
+
+    def tile(self, crop: QRect, factor: int = 1) -> QImage:
+        """A part of the image as an image of its own, reduced by `factor`."""
+        if factor == 1:
+            return self.qimage.copy(crop)
+        pixels = self.array[crop.top() : crop.bottom() + 1, crop.left() : crop.right() + 1]
+        height, width = pixels.shape[:2]
+        reduced = cv2.resize(
+            pixels,
+            (-(-width // factor), -(-height // factor)),
+            interpolation=cv2.INTER_AREA,
+        )
+        qimage = QImage(
+            reduced.data,
+            reduced.shape[1],
+            reduced.shape[0],
+            reduced.strides[0],
+            self.qimage.format(),
+        )
+        # the image doesn't own the pixels of the array, give it a copy that it does
+        return qimage.copy()
+
+    def transformed(self, transform: QTransform, target: QRect) -> QImage:
+        """The part `target` of the image mapped by `transform`, with transparent corners.
+
+        The pixels are averaged down to about the target resolution first, then interpolated.
+        """
+        scale = math.sqrt(abs(transform.determinant()))
+        factor = max(1, math.floor(1 / max(scale, 1e-9)))
+        width, height = self.size
+        crop = (
+            transform.inverted()[0]
+            .mapRect(QRectF(target))
+            .toAlignedRect()
+            .adjusted(-2 * factor, -2 * factor, 2 * factor, 2 * factor)
+            .intersected(QRect(0, 0, width, height))
+        )
+        output = QImage(target.size(), QImage.Format.Format_ARGB32_Premultiplied)
+        output.fill(0)
+        if crop.isEmpty() or target.isEmpty():
+            return output
+        pixels: np.ndarray = self.array[
+            crop.top() : crop.bottom() + 1, crop.left() : crop.right() + 1
+        ]
+        if factor > 1:
+            pixels = cv2.resize(
+                pixels,
+                (-(-crop.width() // factor), -(-crop.height() // factor)),
+                interpolation=cv2.INTER_AREA,
+            )
+        reduction_x = crop.width() / pixels.shape[1]
+        reduction_y = crop.height() / pixels.shape[0]
+        # from the centers of the reduced pixels to the centers of the target pixels
+        matrix = (
+            _translation(-target.left() - 0.5, -target.top() - 0.5)
+            @ np.array(
+                [
+                    [transform.m11(), transform.m21(), transform.dx()],
+                    [transform.m12(), transform.m22(), transform.dy()],
+                    [0, 0, 1],
+                ]
+            )
+            @ _translation(crop.left(), crop.top())
+            @ np.diag([reduction_x, reduction_y, 1])
+            @ _translation(0.5, 0.5)
+        )
+        # the opaque pixels of both formats are valid premultiplied pixels
+        warped = cv2.warpAffine(
+            pixels,
+            matrix[:2],
+            (target.width(), target.height()),
+            flags=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=(0, 0, 0, 0),
+        )
+        qimage = QImage(
+            warped.data,
+            warped.shape[1],
+            warped.shape[0],
+            warped.strides[0],
+            QImage.Format.Format_ARGB32_Premultiplied,
+        )
+        return qimage.copy()
+
+    def grey(self, factor: int = 1) -> np.ndarray:
+        """The image in greyscale, reduced by `factor`."""
+        if factor == 1:
+            return cv2.cvtColor(self.array, cv2.COLOR_BGRA2GRAY)
+        width, height = self.size
+        # reduce first, so only the reduced size is converted
+        reduced = cv2.resize(
+            self.array, (width // factor, height // factor), interpolation=cv2.INTER_AREA
+        )
+        return cv2.cvtColor(reduced, cv2.COLOR_BGRA2GRAY)
+
+    def grey_crop(self, crop: QRect) -> np.ndarray:
+        """A part of the image in greyscale, at full resolution."""
+        pixels = self.array[crop.top() : crop.bottom() + 1, crop.left() : crop.right() + 1]
+        return cv2.cvtColor(pixels, cv2.COLOR_BGRA2GRAY)
+
+
+def _translation(x: float, y: float) -> np.ndarray:
+    return np.array([[1, 0, x], [0, 1, y], [0, 0, 1]], dtype=float)
+
+
+def _within_allocation_limit(size: QSize, full_size: QSize) -> bool:
+    limit = QImageReader.allocationLimit()
+    n_bytes = size.width() * size.height() * 4
+    if size != full_size:
+        # JPEG files are reduced by a power of two while decoding and to the exact size after,
+        # which can take up to four times the memory of the result
+        n_bytes *= 4
+    return limit == 0 or n_bytes < limit * 1024**2
+
+
+def _read_with_opencv(filepath: str, size: QSize) -> QImage:
+    """Decode an image at `size` with OpenCV, reduced by a power of two while decoding."""
+    full_size = QImageReader(filepath).size()
+    factor = max(
+        (f for f in reduced_imread_modes if full_size.width() // f >= size.width()),
+        default=1,
+    )
+    pixels = cv2.imread(filepath, reduced_imread_modes[factor] | cv2.IMREAD_IGNORE_ORIENTATION)
+    if pixels is None:
+        raise ValueError(f"Failed to load '{filepath}'")
+    if (pixels.shape[1], pixels.shape[0]) != (size.width(), size.height()):
+        pixels = cv2.resize(pixels, (size.width(), size.height()), interpolation=cv2.INTER_AREA)
+    qimage = QImage(size, QImage.Format.Format_RGB32)
+    # convert straight into the memory of the image, without a copy
+    target = np.frombuffer(qimage.bits(), dtype=np.uint8)
+    target = target.reshape(qimage.height(), qimage.bytesPerLine() // 4, 4)
+    cv2.cvtColor(pixels, cv2.COLOR_BGR2BGRA, dst=target[:, : qimage.width()])
+    return qimage
+
+
+def decode_size(filepath: str) -> QSize:
+    """The size an image is decoded at, within `max_image_bytes`.
+
+    Returns an invalid size when the size of the image can't be read.
+    """
+    size = QImageReader(filepath).size()
+    if not size.isValid():
+        return size
+    width, height = size.width(), size.height()
+    factor = math.sqrt(max_image_bytes / (width * height * 4))
+    if factor >= 1:
+        return size
+    return QSize(max(1, int(width * factor)), max(1, int(height * factor)))
+
+
+def load_image_buffer(filepath: str, progress: Callable[..., None]) -> ImageBuffer:
+    """Decode an image, for a worker. A quick preview is passed to `progress` first.
+
+    The preview is decoded at a reduced size, which JPEG files support without decoding them whole.
+    The image itself is reduced to the `decode_size`, in the same way. Other formats, like PNG,
+    can only be decoded whole, they are refused before decoding when that takes more than
+    `max_image_bytes`.
+    """
+    reader = QImageReader(filepath)
+    size = reader.size()
+    scalable = reader.supportsOption(QImageIOHandler.ImageOption.ScaledSize)
+    if size.isValid() and size.width() * size.height() * 4 > max_image_bytes and not scalable:
+        raise ValueError(
+            f"'{os.path.basename(filepath)}' takes {size.width() * size.height() * 4 // 1024**2} MB "
+            f"to decode, more than the {max_image_bytes // 1024**2} MB of --max-image-size, "
+            f"save it as JPEG to show it at a lower resolution"
+        )
+    if (
+        size.isValid()
+        and max(size.width(), size.height()) > preview_size
+        # Qt refuses to decode a whole image beyond its allocation limit for a preview
+        and (scalable or _within_allocation_limit(size, full_size=size))
+    ):
+        reader.setScaledSize(
+            size.scaled(preview_size, preview_size, Qt.AspectRatioMode.KeepAspectRatio)
+        )
+        preview = reader.read()
+        if not preview.isNull():
+            progress(preview)
+    return ImageBuffer.from_file(filepath, size=decode_size(filepath))
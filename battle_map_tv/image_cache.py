@@ -0,0 +1,152 @@
+import logging
+import os.path
+import threading
+from collections import OrderedDict
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+
+from PySide6.QtCore import Qt
+
+from battle_map_tv.batch_detection import image_extensions
+from battle_map_tv.fingerprint import image_fingerprint
+from battle_map_tv.image_buffer import ImageBuffer, decode_size
+from battle_map_tv.pixel_cache import load_image_pixels
+from battle_map_tv.workers import Worker
+
+logger = logging.getLogger(__name__)
+
+
+class ImageCache:
+    """Decoded images by their fingerprint, for switching between maps without decoding them again.
+
+    Beyond the `memory_budget` the least recently used images are dropped. `prefetch` decodes an
+    image in the background, so that showing it later is a hit. The memory of the images being
+    prefetched counts towards the budget as well.
+    """
+
+    memory_budget = 1024**3
+
+    def __init__(self):
+        self._buffers: "OrderedDict[str, ImageBuffer]" = OrderedDict()
+        self._size_bytes = 0
+        # by image path, the worker and the memory it reserved once the size was known
+        self._prefetching: Dict[str, Worker] = {}
+        self._reserved: Dict[str, int] = {}
+        # prefetch workers check the budget from the thread pool
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size_bytes(self) -> int:
+        return self._size_bytes
+
+    def get(self, image_key: str) -> Optional[ImageBuffer]:
+        with self._lock:
+            buffer = self._buffers.get(image_key)
+            if buffer is not None:
+                self._buffers.move_to_end(image_key)
+        if buffer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        logger.debug(
+            "image cache %s: %d hits, %d misses, %d images, %d MB",
+            "hit" if buffer is not None else "miss",
+            self.hits,
+            self.misses,
+            len(self._buffers),
+            self.size_bytes // 1024**2,
+        )
+        return buffer
+
+    def put(self, image_key: str, buffer: ImageBuffer):
+        with self._lock:
+            previous = self._buffers.pop(image_key, None)
+            if previous is not None:
+                self._size_bytes -= previous.qimage.sizeInBytes()
+            self._buffers[image_key] = buffer
+            self._size_bytes += buffer.qimage.sizeInBytes()
+            while self._buffers and self._size_bytes > self.memory_budget:
+                _, evicted = self._buffers.popitem(last=False)
+                self._size_bytes -= evicted.qimage.sizeInBytes()
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+            self._size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def prefetch(self, image_path: str):
+        """Decode an image in the background, if it fits next to the cached images.
+
+        Even reading its fingerprint and size is left to the worker.
+        """
+        if image_path in self._prefetching:
+            return
+        worker = Worker(self._prefetch, image_path)
+        queued = Qt.ConnectionType.QueuedConnection
+        worker.signals.finished.connect(partial(self._prefetched, image_path), queued)
+        worker.signals.error.connect(lambda _: self._prefetched(image_path, None), queued)
+        self._prefetching[image_path] = worker
+        # after the workers the user waits for
+        worker.start(priority=-1)
+
+    def is_prefetching(self) -> bool:
+        return bool(self._prefetching)
+
+    def _prefetch(
+        self, image_path: str, progress: Callable[..., None]
+    ) -> Optional[Tuple[str, ImageBuffer]]:
+        """For a worker, the fingerprint and pixels of an image, None when it is not decoded."""
+        try:
+            image_key = image_fingerprint(image_path)
+        except OSError:
+            return None
+        size = decode_size(image_path)
+        if not size.isValid():
+            return None
+        n_bytes = size.width() * size.height() * 4
+        with self._lock:
+            reserved_bytes = sum(self._reserved.values())
+            if (
+                image_key in self._buffers
+                or self._size_bytes + reserved_bytes + n_bytes > self.memory_budget
+            ):
+                return None
+            self._reserved[image_path] = n_bytes
+        return image_key, load_image_pixels(image_path, image_key, progress=progress)
+
+    def _prefetched(self, image_path: str, result: Optional[Tuple[str, ImageBuffer]]):
+        self._prefetching.pop(image_path, None)
+        if result is not None:
+            self.put(*result)
+        # only release the memory once the image is in the cache
+        with self._lock:
+            self._reserved.pop(image_path, None)
+
+
+def neighbour_images(image_path: str, directory: Optional[str], n: int = 1) -> List[str]:
+    """The `n` images before and after an image in a directory, sorted by name, closest first."""
+    if directory is None or not os.path.isdir(directory):
+        return []
+    image_paths = sorted(
+        os.path.join(directory, filename)
+        for filename in os.listdir(directory)
+        if os.path.splitext(filename)[1].lower() in image_extensions
+    )
+    image_path = os.path.abspath(image_path)
+    try:
+        i = [os.path.abspath(path) for path in image_paths].index(image_path)
+    except ValueError:
+        return []
+    neighbours = []
+    for distance in range(1, n + 1):
+        for j in (i + distance, i - distance):
+            if 0 <= j < len(image_paths):
+                neighbours.append(image_paths[j])
+    return neighbours
+
+
+image_cache = ImageCache()
@@ -0,0 +1,142 @@
+import copy
+import json
+import logging
+import os.path
+import threading
+from enum import Enum
+from typing import IO, Any, Dict, List, Optional
+
+from battle_map_tv.storage import path
+from battle_map_tv.utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+filepath = os.path.join(path, "session.journal")
+
+
+class SessionKeys(Enum):
+    image = "image"
+    grid = "grid"
+    area_of_effect = "area_of_effect"
+    initiative = "initiative"
+
+
+class SessionJournal:
+    """Append-only log of what is on the table, replayed on startup.
+
+    Every change is a single json line with a key path and a value, appending one is just a
+    buffered write. Once enough lines have been appended the journal is rewritten in a background
+    thread to a single line with the current state.
+    """
+
+    compact_after = 500
+
+    def __init__(self):
+        self.state: Dict[str, Any] = {}
+        self._file: Optional[IO[str]] = None
+        self._filepath: Optional[str] = None
+        self._n_records = 0
+        self._lock = threading.Lock()
+        self._compaction: Optional[threading.Thread] = None
+        self._records_during_compaction: Optional[List[str]] = None
+
+    def open(self, journal_filepath: str = filepath):
+        """Replay an existing journal and start appending to it."""
+        self.close()
+        self._filepath = journal_filepath
+        self.state = {}
+        try:
+            with open(journal_filepath) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line is incomplete if we crashed while writing it
+                        break
+                    self._apply(record)
+        except FileNotFoundError:
+            pass
+        # start with a clean file, without any incomplete line at the end
+        self._write_snapshot(self.state)
+        self._file = open(journal_filepath, "a")
+
+    def close(self):
+        compaction = self._compaction
+        if compaction is not None:
+            compaction.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def get(self, key: SessionKeys, default=None):
+        return self.state.get(key.value, default)
+
+    def record(self, key: SessionKeys, *subkeys: str, value: Any):
+        self._append([[key.value, *subkeys], value])
+
+    def delete(self, key: SessionKeys, *subkeys: str):
+        self._append([[key.value, *subkeys]])
+
+    def _append(self, record: list):
+        if self._file is None:
+            return
+        self._apply(record)
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if self._records_during_compaction is not None:
+                self._records_during_compaction.append(line)
+        self._n_records += 1
+        if self._n_records >= self.compact_after and self._compaction is None:
+            self._start_compaction()
+
+    def _apply(self, record: list):
+        keys = record[0]
+        if not keys:
+            self.state = record[1]
+            return
+        target = self.state
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        if len(record) == 1:
+            target.pop(keys[-1], None)
+        else:
+            target[keys[-1]] = record[1]
+
+    def _start_compaction(self):
+        self._n_records = 0
+        with self._lock:
+            self._records_during_compaction = []
+        state = copy.deepcopy(self.state)
+        self._compaction = threading.Thread(target=self._compact, args=(state,), daemon=True)
+        self._compaction.start()
+
+    def _compact(self, state: Dict[str, Any]):
+        try:
+            with self._lock:
+                # an open file can't be replaced on Windows, so close it first, reopen it after
+                # and add what came in meanwhile
+                assert self._file is not None
+                self._file.close()
+                self._file = None
+                try:
+                    self._write_snapshot(state)
+                finally:
+                    self._file = open(self._filepath, "a")  # type: ignore[arg-type]
+                self._file.writelines(self._records_during_compaction or [])
+                self._file.flush()
+        except Exception:
+            logger.exception("Failed to compact the session journal")
+        finally:
+            with self._lock:
+                self._records_during_compaction = None
+            self._compaction = None
+
+    def _write_snapshot(self, state: Dict[str, Any]):
+        assert self._filepath
+        with atomic_write(self._filepath) as f:
+            f.write(json.dumps([[], state], separators=(",", ":")) + "\n")
+
+
+session_journal = SessionJournal()
@@ -10,10 +10,11 @@ class HorizontalLayout(QHBoxLayout):
         super().__init__()
         self.setSpacing(20)
 
-    def add_button(self, text: str, callback: Callable, **kwargs):
+    def add_button(self, text: str, callback: Callable, **kwargs) -> StyledButton:
         button = StyledButton(text, **kwargs)
         button.clicked.connect(callback)
         self.addWidget(button)
+        return button
 
     def add_label(self, text: str):
         label = QLabel(text)
@@ -1,5 +1,6 @@
 from battle_map_tv.events import EventKeys, global_event_dispatcher
 from battle_map_tv.grid import GridOverlayColor
+from battle_map_tv.journal import SessionKeys, session_journal
 from battle_map_tv.layouts.base import HorizontalLayout
 from battle_map_tv.utils import get_image_window
 from battle_map_tv.widgets.sliders import StyledSlider
@@ -12,11 +13,11 @@ class GridControls(HorizontalLayout):
 
         self.add_label("Grid scale")
 
-        slider_grid_size = StyledSlider(
+        self.slider_grid_size = StyledSlider(
             lower=10, upper=400, default=self.image_window.grid.pixels_per_square
         )
-        slider_grid_size.valueChanged.connect(self.image_window.scale_grid)
-        self.addWidget(slider_grid_size)
+        self.slider_grid_size.valueChanged.connect(self.image_window.scale_grid)
+        self.addWidget(self.slider_grid_size)
 
         self.add_label("Grid color")
 
@@ -26,7 +27,9 @@ class GridControls(HorizontalLayout):
         self.slider_grid_color.valueChanged.connect(self.image_window.change_grid_color)
         self.addWidget(self.slider_grid_color)
 
-        self.add_button("Toggle grid", self.toggle_grid_callback, checkable=True)
+        self.button_toggle_grid = self.add_button(
+            "Toggle grid", self.toggle_grid_callback, checkable=True
+        )
 
     def toggle_grid_callback(self, value: bool):
         if value:
@@ -34,3 +37,12 @@ class GridControls(HorizontalLayout):
         else:
             self.image_window.remove_grid()
         global_event_dispatcher.dispatch_event(EventKeys.toggle_grid, value)
+
+    def restore_session(self):
+        grid_state = session_journal.get(SessionKeys.grid, {})
+        if "pixels_per_square" in grid_state:
+            self.slider_grid_size.setValue(grid_state["pixels_per_square"])
+        if "color" in grid_state:
+            self.slider_grid_color.setValue(grid_state["color"])
+            self.button_toggle_grid.setChecked(True)
+            self.toggle_grid_callback(True)
@@ -21,7 +21,12 @@ class ImageButtonsLayout(HorizontalLayout):
         self.add_button("Restore", self.image_window.restore_image)
         self.add_button("Center", self.image_window.center_image)
         self.add_button("Rotate", self.image_window.rotate_image)
-        self.add_button("Autoscale", self.image_window.autoscale_image)
+        self.button_autoscale = self.add_button("Autoscale", self.autoscale_callback)
+        self.button_align = self.add_button("Align", self.image_window.align_image)
+        self.button_refine = self.add_button("Refine", self.image_window.refine_image_scale)
+
+        self.image_window.autoscale_started.connect(self.autoscale_started)
+        self.image_window.autoscale_finished.connect(self.autoscale_finished)
 
     def add_image_callback(self):
         file_dialog = QFileDialog(
@@ -34,6 +39,22 @@ class ImageButtonsLayout(HorizontalLayout):
             self.image_window.remove_image()
             self.image_window.add_image(image_path=selected_file)
 
+    def autoscale_callback(self):
+        if self.image_window.is_autoscaling():
+            self.image_window.cancel_autoscale()
+        else:
+            self.image_window.autoscale_image()
+
+    def autoscale_started(self):
+        self.button_autoscale.setText("Cancel")
+        self.button_align.setEnabled(False)
+        self.button_refine.setEnabled(False)
+
+    def autoscale_finished(self):
+        self.button_autoscale.setText("Autoscale")
+        self.button_align.setEnabled(True)
+        self.button_refine.setEnabled(True)
+
 
 class ImageScaleSlidersLayout(QVBoxLayout):
     """A horizontal layout with sliders to change the image scale."""
@@ -55,6 +76,11 @@ class ImageScaleSlidersLayout(QVBoxLayout):
         self.scale_edit = StyledLineEdit(max_length=10, width=120, value="1.00000")
         scale_layout.addWidget(self.scale_edit)
         scale_layout.addStretch()
+        self.detection_label = QLabel()
+        scale_layout.addWidget(self.detection_label)
+        image_window.autoscale_progress.connect(self.detection_label.setText)
+        image_window.image_load_failed.connect(self.detection_label.setText)
+        image_window.autoscale_finished.connect(self.detection_label.clear)
 
         coarse_label = QLabel("Coarse")
         self.coarse_slider = StyledSlider(
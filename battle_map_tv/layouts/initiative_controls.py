@@ -1,5 +1,6 @@
 from PySide6.QtWidgets import QVBoxLayout
 
+from battle_map_tv.journal import SessionKeys, session_journal
 from battle_map_tv.layouts.base import HorizontalLayout
 from battle_map_tv.utils import get_image_window
 from battle_map_tv.widgets.text_based import StyledTextEdit
@@ -26,6 +27,12 @@ class InitiativeTextArea(StyledTextEdit):
         if text:
             self.image_window.add_initiative(text)
 
+    def restore_session(self):
+        text = session_journal.get(SessionKeys.initiative)
+        if text:
+            self.setPlainText(text)
+            self.callback()
+
 
 class InitiativeButtons(HorizontalLayout):
     def __init__(self):
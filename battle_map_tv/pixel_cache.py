@@ -0,0 +1,107 @@
+import glob
+import os.path
+import time
+from typing import Callable, Optional
+
+import platformdirs
+
+from battle_map_tv.image_buffer import ImageBuffer, decode_size, load_image_buffer
+from battle_map_tv.utils import atomic_write
+
+path = os.path.join(platformdirs.user_cache_dir("battle-map-tv"), "pixels")
+# the least recently used images are removed beyond this size
+max_size_bytes = 4 * 1024**3
+# a temporary file this much older was left behind by a write that never finished
+stale_temp_seconds = 60 * 60
+
+
+def _cache_filepath(image_key: str) -> str:
+    return os.path.join(path, f"{image_key}.raw")
+
+
+def get_cached_pixels(image_key: str, filepath: str = "") -> Optional[ImageBuffer]:
+    """Return the decoded pixels of an image, mapped into memory, if they were cached before."""
+    cache_filepath = _cache_filepath(image_key)
+    try:
+        buffer = ImageBuffer.from_raw_file(cache_filepath, filepath=filepath)
+        # the modification time is when it was last used
+        os.utime(cache_filepath)
+    except (OSError, ValueError):
+        return None
+    return buffer
+
+
+def set_cached_pixels(image_key: str, buffer: ImageBuffer):
+    cache_filepath = _cache_filepath(image_key)
+    if buffer.qimage.sizeInBytes() > max_size_bytes:
+        return
+    os.makedirs(path, exist_ok=True)
+    try:
+        with atomic_write(cache_filepath, "wb") as f:
+            buffer.write_raw(f)
+    except OSError:
+        # like a full disk, the image is decoded again next time
+        return
+    _evict()
+
+
+def _evict():
+    entries = []
+    for cache_filepath in glob.glob(os.path.join(glob.escape(path), "*.raw")):
+        try:
+            stat = os.stat(cache_filepath)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, cache_filepath))
+    total_bytes = sum(size for _, size, _ in entries)
+    for temp_filepath in glob.glob(os.path.join(glob.escape(path), "*.tmp")):
+        try:
+            stat = os.stat(temp_filepath)
+        except FileNotFoundError:
+            continue
+        if time.time() - stat.st_mtime > stale_temp_seconds:
+            _remove(temp_filepath)
+        else:
+            # still being written, it takes up space all the same
+            total_bytes += stat.st_size
+    for _, size, cache_filepath in sorted(entries):
+        if total_bytes <= max_size_bytes:
+            break
+        if _remove(cache_filepath):
+            total_bytes -= size
+
+
+def _remove(filepath: str) -> bool:
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        # Windows doesn't remove files that are mapped into memory
+        return False
+    return True
+
+
+def load_image_pixels(
+    filepath: str,
+    image_key: str,
+    progress: Callable[..., None],
+    store: bool = True,
+) -> ImageBuffer:
+    """Load an image for a worker, from the pixel cache if it was decoded before at this size.
+
+    With `store` decoded pixels are written to the cache, else that is left to the caller.
+    """
+    buffer = get_cached_pixels(image_key, filepath=filepath)
+    size = decode_size(filepath)
+    if buffer is None or buffer.size != (size.width(), size.height()):
+        buffer = load_image_buffer(filepath, progress=progress)
+        if store:
+            set_cached_pixels(image_key, buffer)
+    return buffer
+
+
+def store_pixels(image_key: str, buffer: ImageBuffer, progress: Callable[..., None]):
+    """Write decoded pixels to the cache, for a worker."""
+    if buffer.mapped is None:
+        set_cached_pixels(image_key, buffer)
@@ -0,0 +1,51 @@
+import glob
+import json
+import os.path
+from typing import Optional
+
+import platformdirs
+
+from battle_map_tv import scale_detection
+from battle_map_tv.scale_detection import DETECTION_VERSION, AxisScale, ImageScale
+from battle_map_tv.utils import atomic_write
+
+path = os.path.join(platformdirs.user_cache_dir("battle-map-tv"), "scale_detection")
+
+
+def _cache_filepath(image_key: str, engine: Optional[str]) -> str:
+    return os.path.join(path, f"{image_key}.{engine or scale_detection.default_engine}.json")
+
+
+def get_cached_scale(image_key: str, engine: Optional[str] = None) -> Optional[ImageScale]:
+    """Return the detected scale of an image, if it was detected before by this version."""
+    try:
+        with open(_cache_filepath(image_key, engine)) as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if data.get("version") != DETECTION_VERSION:
+        return None
+    return ImageScale(
+        horizontal=AxisScale(**data["horizontal"]),
+        vertical=AxisScale(**data["vertical"]),
+    )
+
+
+def set_cached_scale(image_key: str, image_scale: ImageScale, engine: Optional[str] = None):
+    data = {
+        "version": DETECTION_VERSION,
+        "horizontal": image_scale.horizontal._asdict(),
+        "vertical": image_scale.vertical._asdict(),
+    }
+    os.makedirs(path, exist_ok=True)
+    with atomic_write(_cache_filepath(image_key, engine)) as f:
+        json.dump(data, f)
+
+
+def invalidate_cached_scale(image_key: str):
+    """Forget the detected scale of an image, for all engines."""
+    for filepath in glob.glob(os.path.join(glob.escape(path), f"{image_key}.*.json")):
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
@@ -1,74 +1,638 @@
-from typing import List, Optional, Tuple
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 import cv2
 import numpy as np
+from PySide6.QtCore import QRect
+from PySide6.QtGui import QImage, QImageIOHandler, QImageReader
 
+from battle_map_tv.image_buffer import ImageBuffer
 
-def find_image_scale(image_path: str, show_result: bool = False) -> float:
-    image = cv2.imread(image_path)
-    height, width, _ = image.shape
+logger = logging.getLogger(__name__)
 
-    edges = image_to_edges(image)
+# increase when a change to the detection gives different results, so that cached results are ignored
+DETECTION_VERSION = 5
+
+
+class AxisScale(NamedTuple):
+    px_per_inch: float
+    confidence: float
+    rhos: List[float]
+    # position of the first grid line, between 0 and `px_per_inch`
+    phase: float = 0.0
+    # distinct periods seen while searching this axis, the most likely first
+    candidates: Optional[List[float]] = None
+
+
+class ImageScale(NamedTuple):
+    horizontal: AxisScale
+    vertical: AxisScale
+
+    @property
+    def best(self) -> AxisScale:
+        if self.horizontal.confidence > self.vertical.confidence:
+            return self.horizontal
+        return self.vertical
+
+    @property
+    def px_per_inch(self) -> float:
+        return self.best.px_per_inch
+
+    @property
+    def candidates(self) -> List[float]:
+        """Distinct grid sizes to try, the detected one first.
+
+        A grid is most often found at twice or half its size, so those come right after the
+        other axis, followed by the other periods seen while searching.
+        """
+        best = self.best
+        other = self.vertical if best is self.horizontal else self.horizontal
+        periods = [best.px_per_inch]
+        if other.confidence > 0:
+            periods.append(other.px_per_inch)
+        periods += [best.px_per_inch * 2, best.px_per_inch / 2]
+        periods += (best.candidates or []) + (other.candidates or [])
+        return distinct_periods(periods)
+
+
+class DetectionResult(NamedTuple):
+    image_scale: ImageScale
+    engine: str
+    # number of steps per axis
+    steps: Dict[str, int]
+    # time per stage in seconds, summed over both axes: decode, canny, hough or periodicity,
+    # merge and refine
+    seconds: Dict[str, float]
+    # the time budget ran out before the detection was done
+    timed_out: bool = False
+
+    @property
+    def px_per_inch(self) -> float:
+        return self.image_scale.px_per_inch
+
+    @property
+    def confidence(self) -> float:
+        return self.image_scale.best.confidence
+
+
+TraceCallback = Callable[[str, Dict[str, Any]], None]
+
+# an image is detected from its file, or from its pixels when they were decoded already
+ImageSource = Union[str, ImageBuffer]
+
+
+class DetectionTrace:
+    """Counts the steps and adds up the time per stage of a detection, from any thread.
+
+    `progress` is called with the axis and step number before every step. `trace` is called with
+    an event name and its values: "step" after every step, "axis" with the result of each axis.
+    """
+
+    def __init__(
+        self,
+        progress: Optional[Callable[[str, int], None]] = None,
+        trace: Optional[TraceCallback] = None,
+    ):
+        self.progress = progress
+        self.trace = trace
+        self.steps: Dict[str, int] = {}
+        self.seconds: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def start_step(self, axis: str) -> int:
+        with self._lock:
+            step = self.steps[axis] = self.steps.get(axis, 0) + 1
+        if self.progress is not None:
+            self.progress(axis, step)
+        return step
+
+    def event(self, name: str, **values):
+        if self.trace is not None:
+            self.trace(name, values)
+
+
+# engine used when none is given, see `detection_engines`
+default_engine = "hough"
+
+# stop searching the other axis once one axis is detected with this confidence
+stop_confidence = 0.95
+
+# time budget in seconds of autoscale in the gui, a refine detects without it
+quick_time_budget: Optional[float] = 0.5
+
+# images larger than this are detected on a reduced copy, refined on a full resolution crop
+coarse_to_fine_min_size: Optional[int] = 4000
+# the reduced copy is kept at least this large
+coarse_size = 2000
+# with a time budget every image is detected on a reduced copy first, at least this large
+anytime_coarse_size = 1500
+# with a time budget the Hough search starts at the threshold that gives this many lines
+anytime_start_lines = 6
+# the full resolution crop covers this many squares, within the minimum and maximum size in pixels
+refine_crop_squares = 24
+refine_crop_min_size = 1024
+refine_crop_max_size = 3072
+
+# images that need more memory than this for a detection of the whole image are detected in tiles,
+# None to never use tiles
+memory_budget: Optional[int] = 1024**3
+# memory used per pixel when detecting the whole image at once: grey, edges, Canny and Hough
+whole_image_bytes_per_pixel = 20
+# memory used per pixel of a tile while finding its edges, votes and profiles
+tile_bytes_per_pixel = 24
+# tiles are at least this many rows, and overlap by this many rows so their edges match
+min_tile_height = 256
+tile_margin = 128
+
+# the grid period can be this many times smaller than the strongest period
+max_divisor = 8
+
+# candidate periods within this fraction of each other are the same, keep at most this many
+candidate_tolerance = 0.03
+max_candidates = 6
+
+reduced_imread_modes = {
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def detect_image_scale(
+    image: ImageSource,
+    show_result: bool = False,
+    progress: Optional[Callable[[str, int], None]] = None,
+    engine: Optional[str] = None,
+    time_budget: Optional[float] = None,
+) -> ImageScale:
+    """Detect the grid size in pixels, with the confidence and line positions for both axes."""
+    return find_image_scale(
+        image,
+        show_result=show_result,
+        progress=progress,
+        engine=engine,
+        time_budget=time_budget,
+    ).image_scale
+
+
+def find_image_scale(
+    image: ImageSource,
+    show_result: bool = False,
+    progress: Optional[Callable[[str, int], None]] = None,
+    engine: Optional[str] = None,
+    trace: Optional[TraceCallback] = None,
+    tiled: Optional[bool] = None,
+    time_budget: Optional[float] = None,
+) -> DetectionResult:
+    """Detect the grid size in pixels, with the steps and time it took.
+
+    `progress` and `trace` are called from the thread that searches an axis, see `DetectionTrace`.
+    With `tiled` the image is detected in tiles, which gives the same result with less memory.
+    By default tiles are used when a detection of the whole image would need more than
+    `memory_budget`.
+
+    With a `time_budget` in seconds, the most promising work is done first: a reduced copy of the
+    image, searched from the most promising threshold. When the time is up the best result so far
+    is returned, without refining it on the full resolution image.
+    """
+    start_time = time.perf_counter()
+    anytime = time_budget is not None
+    engine = engine or default_engine
+    detect_axis = detection_engines[engine]
+    detection_trace = DetectionTrace(progress=progress, trace=trace)
+    edges: Union[np.ndarray, TiledEdges]
+    with detection_trace.stage("decode"):
+        full_width, full_height = read_image_size(image)
+        factor = reduction_factor(full_width, full_height, anytime=anytime)
+        if factor > 1:
+            # match the orientation of the full resolution crop, which is read with Qt
+            imread_flags = reduced_imread_modes[factor] | cv2.IMREAD_IGNORE_ORIENTATION
+        else:
+            imread_flags = cv2.IMREAD_GRAYSCALE
+        if tiled is None:
+            n_pixels = (full_width // factor) * (full_height // factor)
+            tiled = (
+                memory_budget is not None and n_pixels * whole_image_bytes_per_pixel > memory_budget
+            )
+        full_grey: Optional[np.ndarray] = None
+        if not tiled:
+            grey, full_grey = read_reduced_grey(image, imread_flags=imread_flags, factor=factor)
+
+    if tiled:
+        edges = read_tiled_edges(
+            image,
+            trace=detection_trace,
+            imread_flags=imread_flags,
+            factor=factor,
+            hough=engine == "hough",
+            periodicity=engine == "periodicity",
+        )
+        height, width = edges.shape
+    else:
+        height, width = grey.shape
+        with detection_trace.stage("canny"):
+            image_edges = grey_to_edges(grey)
+        # both axes are searched at the same time, sharing the edges without copying them
+        image_edges.setflags(write=False)
+        edges = image_edges
 
     theta_horizontal = np.pi / 2
     theta_vertical = 0
 
-    print("--- horizontal ---")
-    px_per_inch_horizontal, confidence_horizontal, lines_horizontal = optimization(
-        edges=edges,
-        wanted_theta=theta_horizontal,
-        image_length=width,
-    )
-    print()
-    print("--- vertical ---")
-    px_per_inch_vertical, confidence_vertical, lines_vertical = optimization(
-        edges=edges,
-        wanted_theta=theta_vertical,
-        image_length=height,
-    )
+    stop = threading.Event()
+    timer: Optional[threading.Timer] = None
+    if time_budget is not None:
+        # the searches stop at the next step when the time is up
+        timer_start = time.perf_counter()
+        timer = threading.Timer(time_budget - (timer_start - start_time), stop.set)
+        timer.daemon = True
+        timer.start()
 
-    print()
-    print(
-        f"horizontal: {int(px_per_inch_horizontal)} px/inch (confidence {confidence_horizontal}, "
-        f"vertical: {int(px_per_inch_vertical)} px/inch (confidence {confidence_vertical}"
+    def detect(axis: str, wanted_theta: float, image_length: int) -> AxisScale:
+        try:
+            result = detect_axis(
+                edges=edges,
+                wanted_theta=wanted_theta,
+                image_length=image_length,
+                trace=detection_trace,
+                stop=stop,
+                anytime=anytime,
+            )
+        except BaseException:
+            stop.set()
+            raise
+        if result.confidence >= stop_confidence:
+            stop.set()
+        detection_trace.event(
+            "axis",
+            axis=axis,
+            px_per_inch=result.px_per_inch,
+            confidence=result.confidence,
+            lines=len(result.rhos),
+        )
+        return result
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_horizontal = executor.submit(detect, "horizontal", theta_horizontal, width)
+        future_vertical = executor.submit(detect, "vertical", theta_vertical, height)
+        horizontal = future_horizontal.result()
+        vertical = future_vertical.result()
+    timed_out = False
+    if timer is not None:
+        timer.cancel()
+        remaining = timer.interval - (time.perf_counter() - timer_start)
+        # decoding the full resolution takes about `factor` times as long as the reduced image
+        timed_out = remaining <= 0 or (
+            factor > 1 and remaining < factor * detection_trace.seconds["decode"]
+        )
+
+    # an axis that was stopped early has no lines, place them at the period of the other axis
+    if vertical.confidence >= stop_confidence and horizontal.confidence == 0:
+        horizontal = lines_at_period(edges, vertical.px_per_inch, wanted_theta=theta_horizontal)
+    elif horizontal.confidence >= stop_confidence and vertical.confidence == 0:
+        vertical = lines_at_period(edges, horizontal.px_per_inch, wanted_theta=theta_vertical)
+
+    if factor > 1 and timed_out:
+        horizontal = scale_axis_scale(horizontal, factor)
+        vertical = scale_axis_scale(vertical, factor)
+    elif factor > 1:
+        horizontal, vertical = refine_on_full_resolution(
+            image=image,
+            image_scale=ImageScale(horizontal=horizontal, vertical=vertical),
+            factor=factor,
+            width=full_width,
+            height=full_height,
+            trace=detection_trace,
+            engine=engine,
+            full_grey=full_grey,
+        )
+    horizontal = horizontal._replace(phase=grid_phase(horizontal.rhos, horizontal.px_per_inch))
+    vertical = vertical._replace(phase=grid_phase(vertical.rhos, vertical.px_per_inch))
+
+    logger.info(
+        "horizontal: %.1f px per inch (confidence %.2f), vertical: %.1f px per inch (confidence %.2f)",
+        horizontal.px_per_inch,
+        horizontal.confidence,
+        vertical.px_per_inch,
+        vertical.confidence,
+    )
+    logger.info(
+        "%s: %s",
+        image if isinstance(image, str) else image.filepath,
+        ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in detection_trace.seconds.items()),
     )
 
     if show_result:
+        if tiled:
+            grey = read_grey(image, imread_flags=imread_flags, factor=factor)
+        result_image = cv2.cvtColor(grey, cv2.COLOR_GRAY2BGR)
         add_lines_to_image(
-            image=image, rhos=lines_horizontal, wanted_theta=theta_horizontal, image_length=width
+            image=result_image,
+            rhos=[rho / factor for rho in horizontal.rhos],
+            wanted_theta=theta_horizontal,
+            image_length=width,
         )
         add_lines_to_image(
-            image=image, rhos=lines_vertical, wanted_theta=theta_vertical, image_length=height
+            image=result_image,
+            rhos=[rho / factor for rho in vertical.rhos],
+            wanted_theta=theta_vertical,
+            image_length=height,
         )
-        cv2.imshow("Detected Lines", image)
+        cv2.imshow("Detected Lines", result_image)
         cv2.waitKey(0)
         cv2.destroyAllWindows()
 
-    return (
-        px_per_inch_horizontal
-        if confidence_horizontal > confidence_vertical
-        else px_per_inch_vertical
+    return DetectionResult(
+        image_scale=ImageScale(horizontal=horizontal, vertical=vertical),
+        engine=engine,
+        steps=detection_trace.steps,
+        seconds=detection_trace.seconds,
+        timed_out=timed_out,
     )
 
 
-def optimization(edges, wanted_theta: float, image_length: int) -> Tuple[float, float, List[float]]:
+def read_image_size(image: ImageSource) -> Tuple[int, int]:
+    if isinstance(image, ImageBuffer):
+        return image.size
+    size = QImageReader(image).size()
+    if not size.isValid():
+        raise ValueError(f"Failed to read '{image}'")
+    return size.width(), size.height()
+
+
+def read_grey(image: ImageSource, imread_flags: int, factor: int) -> np.ndarray:
+    """The image in greyscale, reduced by `factor`, which matches the `imread_flags` of a file."""
+    if isinstance(image, ImageBuffer):
+        return image.grey(factor)
+    grey = cv2.imread(image, imread_flags)
+    if grey is None:
+        raise ValueError(f"Failed to read '{image}'")
+    return grey
+
+
+def read_reduced_grey(
+    image: ImageSource, imread_flags: int, factor: int
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """The image in greyscale reduced by `factor`, and at full resolution when that was decoded.
+
+    OpenCV reduces JPEG files while decoding them. Other formats, like PNG, are decoded whole and
+    reduced after, their full resolution is returned too, to refine on without decoding it again.
+    """
+    if factor == 1 or isinstance(image, ImageBuffer) or _reduces_while_decoding(image):
+        return read_grey(image, imread_flags=imread_flags, factor=factor), None
+    full_grey = read_grey(
+        image, imread_flags=cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION, factor=1
+    )
+    height, width = full_grey.shape
+    grey = cv2.resize(full_grey, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+    return grey, full_grey
+
+
+def _reduces_while_decoding(filepath: str) -> bool:
+    return QImageReader(filepath).supportsOption(QImageIOHandler.ImageOption.ScaledSize)
+
+
+def reduction_factor(width: int, height: int, anytime: bool = False) -> int:
+    """How much to reduce an image for a first coarse detection, 1 means not at all.
+
+    A detection with a time budget reduces every image, down to `anytime_coarse_size`.
+    """
+    size = max(width, height)
+    if anytime:
+        min_size = anytime_coarse_size
+    elif coarse_to_fine_min_size is None or size < coarse_to_fine_min_size:
+        return 1
+    else:
+        min_size = coarse_size
+    for factor in sorted(reduced_imread_modes, reverse=True):
+        if size / factor >= min_size:
+            return factor
+    return 1
+
+
+def refine_on_full_resolution(
+    image: ImageSource,
+    image_scale: ImageScale,
+    factor: int,
+    width: int,
+    height: int,
+    trace: DetectionTrace,
+    engine: Optional[str] = None,
+    full_grey: Optional[np.ndarray] = None,
+) -> ImageScale:
+    """Refine a scale detected on an image reduced by `factor`, using a full resolution crop.
+
+    Only a crop from the center of the image is decoded, or taken from `full_grey` when the whole
+    image was decoded already. The period is searched again with the same engine, in a window of
+    `factor` pixels around the coarse result.
+    """
+    refine_axis = refine_engines[engine or default_engine]
+    crop_size = int(refine_crop_squares * factor * image_scale.px_per_inch)
+    crop_size = min(max(crop_size, refine_crop_min_size), refine_crop_max_size)
+    crop = QRect(
+        max(0, (width - crop_size) // 2),
+        max(0, (height - crop_size) // 2),
+        min(width, crop_size),
+        min(height, crop_size),
+    )
+    with trace.stage("decode"):
+        if full_grey is not None:
+            grey = full_grey[crop.top() : crop.bottom() + 1, crop.left() : crop.right() + 1]
+        else:
+            grey = read_grey_crop(image, crop)
+    with trace.stage("canny"):
+        edges = grey_to_edges(grey)
+    with trace.stage("refine"):
+        return ImageScale(
+            horizontal=refine_axis(
+                edges,
+                image_scale.horizontal,
+                factor=factor,
+                wanted_theta=np.pi / 2,
+                offset=crop.top(),
+                length=height,
+            ),
+            vertical=refine_axis(
+                edges,
+                image_scale.vertical,
+                factor=factor,
+                wanted_theta=0,
+                offset=crop.left(),
+                length=width,
+            ),
+        )
+
+
+def read_grey_crop(image: ImageSource, crop: QRect) -> np.ndarray:
+    if isinstance(image, ImageBuffer):
+        return image.grey_crop(crop)
+    reader = QImageReader(image)
+    reader.setClipRect(crop)
+    qimage = reader.read()
+    if qimage.isNull():
+        # Qt refuses formats that can only be decoded whole, like PNG, beyond its allocation
+        # limit, OpenCV decodes them. This is only for tiled detections, the others keep the
+        # full resolution of these formats from the coarse read
+        grey = read_grey(
+            image, imread_flags=cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION, factor=1
+        )
+        return grey[crop.top() : crop.bottom() + 1, crop.left() : crop.right() + 1].copy()
+    qimage = qimage.convertToFormat(QImage.Format.Format_Grayscale8)
+    array = np.frombuffer(qimage.constBits(), dtype=np.uint8)
+    array = array.reshape(qimage.height(), qimage.bytesPerLine())[:, : qimage.width()]
+    return array.copy()
+
+
+def refine_axis_scale(
+    edges,
+    axis_scale: AxisScale,
+    factor: int,
+    wanted_theta: float,
+    offset: int,
+    length: int,
+) -> AxisScale:
+    coarse = scale_axis_scale(axis_scale, factor)
+    estimate = coarse.px_per_inch
+    profile = edges_to_profile(edges, wanted_theta=wanted_theta)
+    # also look at fractions of the estimate, in case the reduced image hid every other line
+    min_period = max(8, int(estimate / max_divisor) - 1)
+    max_period = int(np.ceil(estimate + factor))
+    if axis_scale.confidence == 0 or 2 * max_period >= len(profile):
+        return coarse
+    autocorrelation = profile_autocorrelation(profile, max_period=max_period)
+    periods, scores = periodicity_scores(autocorrelation, min_period, max_period)
+    in_window = np.abs(periods - estimate) <= factor
+    best = int(np.argmax(np.where(in_window, scores, -np.inf)))
+    whole_period, _ = fundamental_period(periods, scores, best=best)
+    period = refine_period(autocorrelation, whole_period)
+    # the crop is a small part of the image, continue its lines over the whole length
+    first_rho = (offset + period_to_rhos(profile, period)[0]) % period
+    rhos = [float(rho) for rho in np.arange(first_rho, length, period)]
+    return AxisScale(period, axis_scale.confidence, rhos, candidates=coarse.candidates)
+
+
+def refine_axis_scale_hough(
+    edges,
+    axis_scale: AxisScale,
+    factor: int,
+    wanted_theta: float,
+    offset: int,
+    length: int,
+) -> AxisScale:
+    """Like `refine_axis_scale`, with the Hough detection of the crop.
+
+    The result is used when it is within `factor` pixels of the coarse result, or of a fraction of
+    it in case the reduced image hid every other line. The period and position of its lines are
+    then fitted to sub-pixel precision.
+    """
+    coarse = scale_axis_scale(axis_scale, factor)
+    estimate = coarse.px_per_inch
+    crop_length = edges.shape[0] if axis_name(wanted_theta) == "horizontal" else edges.shape[1]
+    if axis_scale.confidence == 0 or 2 * estimate >= crop_length:
+        return coarse
+    result = optimization(edges, wanted_theta=wanted_theta, image_length=crop_length)
+    if result.confidence == 0 or not any(
+        abs(result.px_per_inch - estimate / divisor) <= factor
+        for divisor in range(1, max_divisor + 1)
+    ):
+        return coarse
+    lines = np.array(result.rhos)
+    squares = np.rint((lines - lines[0]) / result.px_per_inch)
+    on_grid = np.abs(lines - lines[0] - squares * result.px_per_inch) <= result.px_per_inch / 4
+    period, first_rho = np.polyfit(squares[on_grid], lines[on_grid], 1)
+    # the crop is a small part of the image, continue its lines over the whole length
+    first_rho = (offset + first_rho) % period
+    rhos = [float(rho) for rho in np.arange(first_rho, length, period)]
+    return AxisScale(float(period), axis_scale.confidence, rhos, candidates=coarse.candidates)
+
+
+def scale_axis_scale(axis_scale: AxisScale, factor: float) -> AxisScale:
+    """The scale of an axis detected on an image reduced by `factor`, at full resolution."""
+    return AxisScale(
+        axis_scale.px_per_inch * factor,
+        axis_scale.confidence,
+        [rho * factor for rho in axis_scale.rhos],
+        phase=axis_scale.phase * factor,
+        candidates=[period * factor for period in axis_scale.candidates or []],
+    )
+
+
+def scale_image_scale(image_scale: ImageScale, factor: float) -> ImageScale:
+    return ImageScale(
+        horizontal=scale_axis_scale(image_scale.horizontal, factor),
+        vertical=scale_axis_scale(image_scale.vertical, factor),
+    )
+
+
+def axis_name(wanted_theta: float) -> str:
+    """The name of the axis along which lines with this angle repeat."""
+    return "vertical" if abs(wanted_theta) < 0.01 else "horizontal"
+
+
+def optimization(
+    edges,
+    wanted_theta: float,
+    image_length: int,
+    trace: Optional[DetectionTrace] = None,
+    stop: Optional[threading.Event] = None,
+    anytime: bool = False,
+) -> AxisScale:
+    trace = trace or DetectionTrace()
+    axis = axis_name(wanted_theta)
     hough_lines_threshold = 1500
     i = 0
     n_hits = 0
     results: List[Tuple[Optional[float], float, List[float]]] = []
+    with trace.stage("hough"):
+        if isinstance(edges, TiledEdges):
+            accumulator = edges.accumulators[axis]
+        else:
+            accumulator = HoughAccumulator(edges, wanted_theta=wanted_theta)
+    if anytime:
+        # skip the steps without lines, start where there are enough lines to see a grid
+        hough_lines_threshold = accumulator.threshold_for_lines(anytime_start_lines)
 
     def do_step(_i, _threshold):
         _i += 1
+        trace.start_step(axis)
         results.append(
             px_per_inch_detection(
-                edges=edges,
+                accumulator=accumulator,
                 hough_lines_threshold=_threshold,
-                wanted_theta=wanted_theta,
                 image_length=image_length,
+                trace=trace,
             )
         )
-        print(
-            f"Step {i}: {len(results[-1][2])} lines, threshold {_threshold}, confidence {results[-1][1]}"
+        _, confidence, rhos = results[-1]
+        logger.debug(
+            "%s step %d: %d lines, threshold %d, confidence %.3f",
+            axis,
+            _i,
+            len(rhos),
+            _threshold,
+            confidence,
+        )
+        trace.event(
+            "step",
+            axis=axis,
+            step=_i,
+            threshold=_threshold,
+            lines=len(rhos),
+            confidence=confidence,
         )
         return _i
 
@@ -101,26 +665,37 @@ def optimization(edges, wanted_theta: float, image_length: int) -> Tuple[float,
             break
         if n_lines > 20 and confidence > 0.9:
             break
+        if stop is not None and stop.is_set():
+            # the other axis was detected with high confidence
+            break
 
     best_result = max(results, key=lambda x: x[1])
     px_per_inch, confidence, rhos = best_result
-    print(f"px per inch {px_per_inch}, {len(rhos)} lines, confidence {confidence}")
-    return px_per_inch or 10.0, confidence, rhos
+    ranked = sorted(results, key=lambda x: x[1], reverse=True)
+    candidates = [result[0] for result in ranked if result[0] is not None and result[1] > 0]
+    return AxisScale(px_per_inch or 10.0, confidence, rhos, candidates=distinct_periods(candidates))
 
 
 def px_per_inch_detection(
-    edges,
+    accumulator: "HoughAccumulator",
     hough_lines_threshold: int,
-    wanted_theta: float,
     image_length: int,
+    trace: Optional[DetectionTrace] = None,
 ) -> Tuple[Optional[float], float, List[float]]:
-    lines = edges_to_lines(edges, threshold=hough_lines_threshold)
-
-    rhos = keep_only_lines_with_certain_orientation(lines=lines, wanted_theta=wanted_theta)
+    trace = trace or DetectionTrace()
+    with trace.stage("hough"):
+        rhos = accumulator.rhos(threshold=hough_lines_threshold)
 
     if not rhos:
         return None, 0.0, []
 
+    with trace.stage("merge"):
+        return _lines_to_px_per_inch(rhos, image_length=image_length)
+
+
+def _lines_to_px_per_inch(
+    rhos: List[float], image_length: int
+) -> Tuple[Optional[float], float, List[float]]:
     rhos = merge_close_together_lines(lines=rhos, threshold_px=image_length / 250)
 
     if len(rhos) <= 1:
@@ -142,7 +717,10 @@ def px_per_inch_detection(
 
 def image_to_edges(image):
     grey = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return grey_to_edges(grey)
+
 
+def grey_to_edges(grey):
     # determine upper threshold for Canny (https://stackoverflow.com/a/16047590)
     upper_threshold, _ = cv2.threshold(grey, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
 
@@ -153,21 +731,218 @@ def image_to_edges(image):
     return edges
 
 
-def edges_to_lines(edges, threshold: float) -> List[Tuple[float, float]]:
-    lines = cv2.HoughLines(image=edges, rho=1, theta=np.pi / 180, threshold=threshold)  # type: ignore
-    if lines is None:
-        return []
-    lines = [tuple(line[0]) for line in lines]
-    return lines
+def otsu_threshold(histogram: np.ndarray) -> float:
+    """The threshold `cv2.threshold` picks with `THRESH_OTSU`, from the histogram of an image."""
+    n_pixels = float(histogram.sum())
+    probabilities = histogram.astype(np.float64) / n_pixels
+    mean = float(np.dot(np.arange(256), probabilities))
+    epsilon = float(np.finfo(np.float32).eps)
+    q1 = mean1 = max_sigma = best = 0.0
+    # the same loop as OpenCV, to get the exact same threshold
+    for i in range(256):
+        p_i = float(probabilities[i])
+        mean1 *= q1
+        q1 += p_i
+        q2 = 1.0 - q1
+        if min(q1, q2) < epsilon or max(q1, q2) > 1.0 - epsilon:
+            continue
+        mean1 = (mean1 + i * p_i) / q1
+        mean2 = (mean - q1 * mean1) / q2
+        sigma = q1 * q2 * (mean1 - mean2) ** 2
+        if sigma > max_sigma:
+            max_sigma = sigma
+            best = i
+    return best
 
 
-def keep_only_lines_with_certain_orientation(
-    lines: List[Tuple[float, float]],
-    wanted_theta: float,
-) -> List[float]:
-    lines_selected = [line[0] for line in lines if abs(line[1] - wanted_theta) < 0.01]
-    lines_selected = sorted(lines_selected)
-    return lines_selected
+class TiledEdges:
+    """What the engines need from the edges of an image, summed over tiles of the image.
+
+    Holds the Hough votes and the line profiles of both axes, each only when the engine uses
+    them, so that the edges of the whole image never have to be in memory at the same time.
+    """
+
+    def __init__(self, width: int, height: int):
+        self.shape = (height, width)
+        self.accumulators: Dict[str, HoughAccumulator] = {}
+        self.profiles: Dict[str, np.ndarray] = {}
+
+    def add_tile(
+        self,
+        accumulators: Dict[str, "HoughAccumulator"],
+        profiles: Dict[str, np.ndarray],
+        top: int,
+    ):
+        for axis, accumulator in accumulators.items():
+            if axis in self.accumulators:
+                self.accumulators[axis] += accumulator
+            else:
+                self.accumulators[axis] = accumulator
+        for axis, profile in profiles.items():
+            if axis not in self.profiles:
+                self.profiles[axis] = np.zeros(self._length(axis), dtype=np.float64)
+            if axis == "horizontal":
+                self.profiles[axis][top : top + len(profile)] += profile
+            else:
+                self.profiles[axis] += profile
+
+    def profile(self, axis: str) -> np.ndarray:
+        """The line profile of an axis, or the Hough votes at its angle without a profile."""
+        if axis in self.profiles:
+            return self.profiles[axis]
+        accumulator = self.accumulators[axis]
+        center = (accumulator.n_rhos - 1) // 2
+        return accumulator.votes[1, center : center + self._length(axis)].astype(np.float64)
+
+    def _length(self, axis: str) -> int:
+        return self.shape[0] if axis == "horizontal" else self.shape[1]
+
+
+def read_tiled_edges(
+    image: ImageSource,
+    trace: DetectionTrace,
+    imread_flags: int = cv2.IMREAD_GRAYSCALE,
+    factor: int = 1,
+    hough: bool = True,
+    periodicity: bool = True,
+) -> TiledEdges:
+    """Find the edges of an image in tiles of rows, processed in parallel.
+
+    With `hough` the Hough votes are counted, with `periodicity` the line profiles are made.
+    Only the grey image is kept whole. The tiles are sized so that the ones being processed fit
+    in what the grey image leaves of the `memory_budget`, which does not bound the grey image
+    itself. Without room left, one tile of `min_tile_height` rows is processed at a time. The
+    tiles overlap, and use the threshold of the whole image, so they give the same edges.
+    """
+    with trace.stage("decode"):
+        grey = read_grey(image, imread_flags=imread_flags, factor=factor)
+    grey.setflags(write=False)
+    height, width = grey.shape
+
+    with trace.stage("canny"):
+        histogram = cv2.calcHist([grey], [0], None, [256], [0, 256]).ravel()
+        upper_threshold = otsu_threshold(histogram)
+
+    available = max(0, (memory_budget or 0) - grey.nbytes)
+    tile_row_bytes = width * tile_bytes_per_pixel
+    n_workers = max(1, min(os.cpu_count() or 1, available // (min_tile_height * tile_row_bytes)))
+    tile_height = max(min_tile_height, available // (n_workers * tile_row_bytes))
+
+    def process_tile(top: int):
+        bottom = min(top + tile_height, height)
+        start, end = max(0, top - tile_margin), min(height, bottom + tile_margin)
+        with trace.stage("canny"):
+            edges = cv2.Canny(
+                grey[start:end], upper_threshold / 10, upper_threshold, apertureSize=3
+            )
+        core = edges[top - start : bottom - start]
+        accumulators = {}
+        if hough:
+            with trace.stage("hough"):
+                for axis, wanted_theta in [("horizontal", np.pi / 2), ("vertical", 0)]:
+                    accumulators[axis] = HoughAccumulator(
+                        core, wanted_theta=wanted_theta, offset=(0, top), image_size=(width, height)
+                    )
+        profiles = {}
+        if periodicity:
+            with trace.stage("periodicity"):
+                for axis, wanted_theta in [("horizontal", np.pi / 2), ("vertical", 0)]:
+                    lines = cv2.morphologyEx(edges, cv2.MORPH_OPEN, _line_kernel(wanted_theta))
+                    # the opening looks at neighbouring rows, so take the core after it
+                    profiles[axis] = (
+                        lines[top - start : bottom - start]
+                        .sum(axis=0 if axis == "vertical" else 1, dtype=np.int64)
+                        .astype(np.float64)
+                    )
+        return accumulators, profiles, top
+
+    tiled_edges = TiledEdges(width=width, height=height)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for accumulators, profiles, top in executor.map(
+            process_tile, range(0, height, tile_height)
+        ):
+            tiled_edges.add_tile(accumulators, profiles, top=top)
+    logger.debug("%s: %d tiles of %d rows", image, -(-height // tile_height), tile_height)
+    return tiled_edges
+
+
+def _hough_angles(n_angles: int = 180) -> np.ndarray:
+    # OpenCV adds up the angle in single precision, do the same to get the exact same votes
+    angles = np.zeros(n_angles, dtype=np.float32)
+    for i in range(1, n_angles):
+        angles[i] = angles[i - 1] + np.float32(np.pi / n_angles)
+    return angles
+
+
+class HoughAccumulator:
+    """The votes of `cv2.HoughLines` with a resolution of 1 px and 1 degree, for one orientation.
+
+    Only the wanted angle and its two neighbours are counted, in a single pass over the edges.
+    Finding the lines for a threshold is then a cheap cut, which gives the same lines as
+    `cv2.HoughLines` with that threshold, at the wanted angle.
+    """
+
+    angles = _hough_angles()
+
+    def __init__(
+        self,
+        edges,
+        wanted_theta: float,
+        offset: Tuple[int, int] = (0, 0),
+        image_size: Optional[Tuple[int, int]] = None,
+    ):
+        """Count the votes of `edges`, or of a tile at `offset` in an image of `image_size`."""
+        width, height = image_size or edges.shape[::-1]
+        self.n_rhos = (width + height) * 2 + 1
+        i_wanted = round(wanted_theta / (np.pi / len(self.angles)))
+        rows, columns = np.nonzero(edges)
+        xs = columns.astype(np.float32) + np.float32(offset[0])
+        ys = rows.astype(np.float32) + np.float32(offset[1])
+        votes = np.zeros((3, self.n_rhos), dtype=np.int64)
+        for row, i_angle in enumerate((i_wanted - 1, i_wanted, i_wanted + 1)):
+            # like OpenCV, angles don't wrap around
+            if 0 <= i_angle < len(self.angles):
+                angle = np.float64(self.angles[i_angle])
+                cos, sin = np.float32(np.cos(angle)), np.float32(np.sin(angle))
+                rhos = np.rint(xs * cos + ys * sin).astype(np.int64) + (self.n_rhos - 1) // 2
+                votes[row] = np.bincount(rhos, minlength=self.n_rhos)
+        self.votes = votes
+        self._peaks: Optional[np.ndarray] = None
+
+    def __iadd__(self, other: "HoughAccumulator") -> "HoughAccumulator":
+        """Add the votes of another part of the same image."""
+        self.votes += other.votes
+        self._peaks = None
+        return self
+
+    def _find_peaks(self):
+        # local maxima, compared to the neighbours the same way as OpenCV
+        previous_angle, votes, next_angle = self.votes
+        left = np.concatenate(([0], votes[:-1]))
+        right = np.concatenate((votes[1:], [0]))
+        is_peak = (
+            (votes > left) & (votes >= right) & (votes > previous_angle) & (votes >= next_angle)
+        )
+        self._peaks = np.flatnonzero(is_peak)
+        self._peak_votes = votes[self._peaks]
+
+    def threshold_for_lines(self, n_lines: int) -> int:
+        """The threshold at which at most `n_lines` lines are found, before merging them."""
+        if self._peaks is None:
+            self._find_peaks()
+        assert self._peaks is not None
+        if len(self._peak_votes) == 0:
+            return 0
+        votes = np.sort(self._peak_votes)[::-1]
+        return int(votes[min(n_lines, len(votes) - 1)])
+
+    def rhos(self, threshold: float) -> List[float]:
+        """The positions of the lines with more than `threshold` votes, sorted."""
+        if self._peaks is None:
+            self._find_peaks()
+        assert self._peaks is not None
+        peaks = self._peaks[self._peak_votes > threshold]
+        return (peaks - (self.n_rhos - 1) / 2).tolist()
 
 
 def merge_close_together_lines(lines: List[float], threshold_px: float) -> List[float]:
@@ -184,6 +959,198 @@ def merge_close_together_lines(lines: List[float], threshold_px: float) -> List[
     return lines_combined
 
 
+def periodicity(
+    edges,
+    wanted_theta: float,
+    image_length: int,
+    trace: Optional[DetectionTrace] = None,
+    stop: Optional[threading.Event] = None,
+    anytime: bool = False,
+) -> AxisScale:
+    """Find the grid period from the edges projected on one axis, without any Hough transform.
+
+    Grid lines repeat at a fixed distance, which shows up as peaks in the autocorrelation of the
+    projection. The period is refined to sub-pixel precision using the peaks at its multiples.
+    """
+    trace = trace or DetectionTrace()
+    axis = axis_name(wanted_theta)
+    trace.start_step(axis)
+    with trace.stage("periodicity"):
+        result = _periodicity(edges, wanted_theta=wanted_theta)
+    period, confidence, rhos = result.px_per_inch, result.confidence, result.rhos
+    logger.debug("%s: period %.2f, %d lines, confidence %.3f", axis, period, len(rhos), confidence)
+    trace.event("step", axis=axis, step=1, period=period, lines=len(rhos), confidence=confidence)
+    return result
+
+
+def _periodicity(edges, wanted_theta: float) -> AxisScale:
+    profile = edges_to_profile(edges, wanted_theta=wanted_theta)
+    n = len(profile)
+    # same bounds as the Hough detection: between 8 and 120 squares
+    min_period = max(8, int(n / 120))
+    max_period = int(n / 8)
+    if max_period <= min_period:
+        return AxisScale(10.0, 0.0, [])
+
+    autocorrelation = profile_autocorrelation(profile, max_period=max_period)
+    periods, scores = periodicity_scores(autocorrelation, min_period, max_period)
+    whole_period, confidence = fundamental_period(periods, scores)
+    period = refine_period(autocorrelation, whole_period)
+    rhos = period_to_rhos(profile, period)
+    # the other periods that score well, the peaks of the scores
+    is_peak = (scores >= np.roll(scores, 1)) & (scores >= np.roll(scores, -1)) & (scores > 0)
+    ranked = np.flatnonzero(is_peak)[np.argsort(-scores[is_peak], kind="stable")]
+    candidates = distinct_periods([float(periods[i]) for i in ranked])
+    return AxisScale(period, min(confidence, 1.0), rhos, candidates=candidates)
+
+
+def edges_to_profile(edges, wanted_theta: float, min_line_length: int = 5) -> np.ndarray:
+    """Count the edge pixels per row or column, only counting pieces of lines in that direction."""
+    if isinstance(edges, TiledEdges):
+        return edges.profile(axis_name(wanted_theta))
+    vertical = axis_name(wanted_theta) == "vertical"
+    # remove texture, keeping only edges that are at least a few pixels long in this direction
+    lines = cv2.morphologyEx(edges, cv2.MORPH_OPEN, _line_kernel(wanted_theta, min_line_length))
+    return lines.sum(axis=0 if vertical else 1, dtype=np.int64).astype(np.float64)
+
+
+def _line_kernel(wanted_theta: float, min_line_length: int = 5) -> np.ndarray:
+    vertical = axis_name(wanted_theta) == "vertical"
+    return np.ones((min_line_length, 1) if vertical else (1, min_line_length), np.uint8)
+
+
+def profile_autocorrelation(profile: np.ndarray, max_period: int) -> np.ndarray:
+    n = len(profile)
+    # remove slow changes, like dark and light areas, that are wider than a square
+    window = 2 * max_period + 1
+    padded = np.pad(profile, window // 2, mode="reflect")
+    baseline = np.convolve(padded, np.ones(window) / window, mode="valid")
+    profile = profile - baseline
+    # zero padding to avoid the circular correlation
+    spectrum = np.fft.rfft(profile, 2 * n)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum))[:n]
+    autocorrelation /= n - np.arange(n)
+    if autocorrelation[0] <= 0:
+        return np.zeros(n)
+    return autocorrelation / autocorrelation[0]
+
+
+def periodicity_scores(
+    autocorrelation: np.ndarray,
+    min_period: int,
+    max_period: int,
+    n_multiples: int = 8,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Score every period by the average autocorrelation at its first multiples."""
+    n = len(autocorrelation)
+    # allow a pixel of slack, so that periods that are not a whole number still hit their peaks
+    peaks = np.maximum.reduce(
+        [autocorrelation, np.roll(autocorrelation, 1), np.roll(autocorrelation, -1)]
+    )
+    periods = np.arange(min_period, max_period + 1)
+    lags = np.rint(np.outer(periods, np.arange(1, n_multiples + 1))).astype(int)
+    valid = lags < n // 2
+    values = np.where(valid, peaks[np.minimum(lags, n - 1)], 0.0)
+    scores = values.sum(axis=1) / np.maximum(valid.sum(axis=1), 1)
+    return periods, scores
+
+
+def fundamental_period(
+    periods: np.ndarray,
+    scores: np.ndarray,
+    min_ratio: float = 0.6,
+    best: Optional[int] = None,
+) -> Tuple[int, float]:
+    """Take the best scoring period, unless a fraction of it scores almost as well.
+
+    Multiples of the grid period score high as well, for example when every fourth line is
+    thicker, so prefer the smallest fraction of the best period that still has a decent score.
+    """
+    if best is None:
+        best = int(np.argmax(scores))
+    for divisor in range(max_divisor, 1, -1):
+        i = int(round(periods[best] / divisor)) - int(periods[0])
+        if i < 0:
+            continue
+        i_start = max(i - 1, 0)
+        i_candidate = i_start + int(np.argmax(scores[i_start : i + 2]))
+        if scores[i_candidate] >= min_ratio * scores[best]:
+            return int(periods[i_candidate]), float(scores[i_candidate])
+    return int(periods[best]), float(scores[best])
+
+
+def refine_period(autocorrelation: np.ndarray, period: int, max_multiples: int = 20) -> float:
+    """Get a sub-pixel period from the positions of the autocorrelation peaks at its multiples."""
+    n = len(autocorrelation)
+    search_radius = max(1, round(period / 10))
+    multiples: List[int] = []
+    positions: List[float] = []
+    refined = float(period)
+    for multiple in range(1, max_multiples + 1):
+        center = round(multiple * refined)
+        if center + search_radius + 1 >= n // 2:
+            break
+        start = center - search_radius
+        i = start + int(np.argmax(autocorrelation[start : center + search_radius + 1]))
+        # fit a parabola through the peak and its neighbours
+        y0, y1, y2 = autocorrelation[i - 1 : i + 2]
+        curvature = y0 - 2 * y1 + y2
+        offset = 0.5 * (y0 - y2) / curvature if curvature < 0 else 0.0
+        multiples.append(multiple)
+        positions.append(i + offset)
+        refined = float(np.dot(multiples, positions) / np.dot(multiples, multiples))
+    if abs(refined - period) > 1:
+        return float(period)
+    return refined
+
+
+def period_to_rhos(profile: np.ndarray, period: float) -> List[float]:
+    """Place lines at the given period, at the offset where the profile lines up best."""
+    x = np.arange(len(profile))
+    phase = np.angle(np.sum(profile * np.exp(-2j * np.pi * x / period)))
+    offset = (-phase * period / (2 * np.pi)) % period
+    return [float(rho) for rho in np.arange(offset, len(profile), period)]
+
+
+def lines_at_period(edges, period: float, wanted_theta: float) -> AxisScale:
+    """The lines of an axis that was not searched, at the period found for the other axis."""
+    profile = edges_to_profile(edges, wanted_theta=wanted_theta)
+    return AxisScale(period, 0.0, period_to_rhos(profile, period))
+
+
+def distinct_periods(periods: List[float]) -> List[float]:
+    """The first `max_candidates` periods that differ by more than `candidate_tolerance`."""
+    distinct: List[float] = []
+    for period in periods:
+        if all(abs(period - other) > candidate_tolerance * other for other in distinct):
+            distinct.append(period)
+            if len(distinct) == max_candidates:
+                break
+    return distinct
+
+
+def grid_phase(rhos: List[float], period: float) -> float:
+    """Where the grid lines start, the average position of the lines modulo the period."""
+    if not rhos:
+        return 0.0
+    # average as angles, so that lines just before and after a multiple of the period agree
+    angles = 2 * np.pi * np.asarray(rhos) / period
+    angle = np.angle(np.mean(np.exp(1j * angles)))
+    return float(angle * period / (2 * np.pi) % period)
+
+
+detection_engines: Dict[str, Callable[..., AxisScale]] = {
+    "hough": optimization,
+    "periodicity": periodicity,
+}
+
+# how each engine refines its coarse result on a full resolution crop
+refine_engines: Dict[str, Callable[..., AxisScale]] = {
+    "hough": refine_axis_scale_hough,
+    "periodicity": refine_axis_scale,
+}
+
+
 def add_lines_to_image(image, rhos, wanted_theta, image_length):
     for rho in sorted(rhos):
         point1, point2 = polar_to_cartesian(rho=rho, theta=wanted_theta, image_length=image_length)
@@ -25,4 +25,4 @@ class Settings:
 
     @classproperty
     def default_directory(cls) -> Optional[str]:
-        return cls._values["default_directory"]
+        return cls._values.get("default_directory")
@@ -1,27 +1,173 @@
-import json
+import atexit
+import logging
 import os.path
 from enum import Enum
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
 
 import platformdirs
+from PySide6.QtCore import QCoreApplication, QTimer
+
+from battle_map_tv.storage_backends import (
+    SqliteBackend,
+    StorageBackend,
+    StorageStats,
+    storage_backends,
+)
+
+logger = logging.getLogger(__name__)
 
 path = platformdirs.user_data_dir("battle-map-tv", ensure_exists=True)
 filepath = os.path.join(path, "config.json")
+sqlite_filepath = os.path.join(path, "config.sqlite3")
+
+# changes are collected in memory and written to disk at most once per interval
+flush_interval_ms = 1000
+
+# least recently used images are forgotten when there are more, or they take up more space
+max_stored_images: Optional[int] = 1000
+max_storage_size_bytes: Optional[int] = None
+
+storage_stats = StorageStats()
+
+
+class _Cache:
+    backend_name: Optional[str] = None
+    backend: Optional[StorageBackend] = None
+    timer: Optional[QTimer] = None
+
+
+def use_storage_backend(name: Optional[str] = None):
+    """Select the 'json' or 'sqlite' backend, the choice is remembered for the next time.
+
+    Without a name the remembered backend is used. When none was chosen yet, the sqlite backend
+    is used if its database exists, otherwise json.
+    An existing json config is imported when the sqlite database is created. When switching
+    between backends, what was stored with the other one since is carried over.
+    """
+    if _Cache.backend is not None:
+        _Cache.backend.close()
+        _Cache.backend = None
+    previous_name = _remembered_backend_name() or _default_backend_name()
+    _Cache.backend_name = name
+    if name is not None:
+        _remember_backend_name(name)
+    else:
+        name = previous_name
+    if name == "sqlite":
+        is_new = not os.path.exists(sqlite_filepath)
+        backend = SqliteBackend(filepath=sqlite_filepath, stats=storage_stats)
+        if os.path.exists(filepath):
+            if is_new or (previous_name == "json" and _is_newer(filepath, sqlite_filepath)):
+                backend.import_json(filepath)
+            elif _is_newer(filepath, sqlite_filepath):
+                logger.warning(
+                    "%s changed after %s, start with --storage json to use it",
+                    filepath,
+                    sqlite_filepath,
+                )
+        _Cache.backend = backend
+    else:
+        if previous_name == "sqlite" and _is_newer(sqlite_filepath, filepath):
+            sqlite_backend = SqliteBackend(filepath=sqlite_filepath, stats=StorageStats())
+            sqlite_backend.export_json(filepath)
+            sqlite_backend.close()
+        _Cache.backend = storage_backends[name](filepath=filepath, stats=storage_stats)
+    _Cache.backend.max_images = max_stored_images
+    _Cache.backend.max_size_bytes = max_storage_size_bytes
+
+
+def _default_backend_name() -> str:
+    return "sqlite" if os.path.exists(sqlite_filepath) else "json"
+
+
+def _is_newer(filepath_a: str, filepath_b: str) -> bool:
+    """Whether the first file exists and was changed after the second, or the second is missing."""
+    try:
+        mtime_a = os.stat(filepath_a).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    try:
+        return mtime_a > os.stat(filepath_b).st_mtime_ns
+    except FileNotFoundError:
+        return True
+
 
+def _backend_name_filepath() -> str:
+    # next to the config, the backend is known before any config is read
+    return os.path.join(os.path.dirname(filepath), "storage_backend")
 
-def _load() -> Dict[str, Any]:
+
+def _remember_backend_name(name: str):
     try:
-        with open(filepath) as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
+        with open(_backend_name_filepath(), "w") as f:
+            f.write(name)
+    except OSError:
+        pass
+
+
+def _remembered_backend_name() -> Optional[str]:
+    try:
+        with open(_backend_name_filepath()) as f:
+            name = f.read().strip()
+    except OSError:
+        return None
+    return name if name in storage_backends else None
+
+
+def _get_backend() -> StorageBackend:
+    if _Cache.backend is None:
+        use_storage_backend(_Cache.backend_name)
+    return _Cache.backend  # type: ignore[return-value]
 
 
-def _dump(data: Dict[str, Any]):
-    # catch errors before start writing to the file
-    json_str = json.dumps(data, indent=2)
-    with open(filepath, "w") as f:
-        f.write(json_str)
+def _schedule_flush():
+    if QCoreApplication.instance() is None:
+        # no event loop to run a timer on, write through
+        flush_storage()
+        return
+    if _Cache.timer is None:
+        _Cache.timer = QTimer()
+        _Cache.timer.setSingleShot(True)
+        _Cache.timer.timeout.connect(flush_storage)
+    if not _Cache.timer.isActive():
+        _Cache.timer.start(flush_interval_ms)
+
+
+def flush_storage():
+    """Write pending changes to disk, if there are any."""
+    if _Cache.backend is not None:
+        _Cache.backend.flush()
+
+
+def reset_storage_cache():
+    """Forget the in-memory state, the next access reads from disk again."""
+    if _Cache.backend is not None:
+        _Cache.backend.close()
+        _Cache.backend = None
+
+
+def compact_storage() -> Tuple[Dict[str, float], Dict[str, float]]:
+    """Evict images that don't fit the limits and rewrite the storage on disk.
+
+    Returns the number of images, size and load time before and after.
+    """
+    before = _measure_storage()
+    _get_backend().compact()
+    after = _measure_storage()
+    return before, after
+
+
+def _measure_storage() -> Dict[str, float]:
+    reset_storage_cache()
+    n_images = _get_backend().count_images()
+    return {
+        "images": n_images,
+        "size_bytes": storage_stats.size_bytes,
+        "load_seconds": storage_stats.load_seconds,
+    }
+
+
+atexit.register(reset_storage_cache)
 
 
 class StorageKeys(Enum):
@@ -36,9 +182,8 @@ class Undefined:
 
 
 def get_from_storage(key: StorageKeys, default=Undefined):
-    data = _load()
     try:
-        return data[key.value]
+        return _get_backend().get_setting(key.value)
     except KeyError:
         if default is Undefined:
             raise
@@ -46,15 +191,13 @@ def get_from_storage(key: StorageKeys, default=Undefined):
 
 
 def set_in_storage(key: StorageKeys, value: Any):
-    data = _load()
-    data[key.value] = value
-    _dump(data)
+    _get_backend().set_setting(key.value, value)
+    _schedule_flush()
 
 
 def remove_from_storage(key: StorageKeys):
-    data = _load()
-    data.pop(key.value, None)
-    _dump(data)
+    _get_backend().remove_setting(key.value)
+    _schedule_flush()
 
 
 class ImageKeys(Enum):
@@ -65,22 +208,29 @@ class ImageKeys(Enum):
 
 
 def get_image_from_storage(
-    image_filename: str,
+    image_key: str,
     key: ImageKeys,
     default=Undefined,
 ):
-    data = _load()
+    backend = _get_backend()
     try:
-        image_data = data[image_filename]
-        return image_data[key.value]
+        return backend.get_image(image_key)[key.value]
     except KeyError:
         if default is Undefined:
             raise
         return default
+    finally:
+        # using an image changes which images are evicted first
+        if backend.dirty:
+            _schedule_flush()
+
+
+def set_image_in_storage(image_key: str, key: ImageKeys, value):
+    _get_backend().set_image(image_key, key.value, value)
+    _schedule_flush()
 
 
-def set_image_in_storage(image_filename: str, key: ImageKeys, value):
-    data = _load()
-    image_data = data.setdefault(image_filename, {})
-    image_data[key.value] = value
-    _dump(data)
+def rename_image_in_storage(old_image_key: str, new_image_key: str):
+    """Move the settings of an image to a new key, unless there are settings there already."""
+    if _get_backend().rename_image(old_image_key, new_image_key):
+        _schedule_flush()
@@ -0,0 +1,433 @@
+import json
+import os.path
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Set
+
+from battle_map_tv.utils import atomic_write
+
+
+class StorageStats:
+    def __init__(self):
+        self.reads = 0
+        self.reads_avoided = 0
+        self.writes = 0
+        self.writes_avoided = 0
+        self.evicted = 0
+        self.load_seconds = 0.0
+        self.size_bytes = 0
+
+    def __repr__(self) -> str:
+        return (
+            f"StorageStats(reads={self.reads}, reads_avoided={self.reads_avoided}, "
+            f"writes={self.writes}, writes_avoided={self.writes_avoided}, "
+            f"evicted={self.evicted}, load_seconds={self.load_seconds:.4f}, "
+            f"size_bytes={self.size_bytes})"
+        )
+
+
+class StorageBackend(ABC):
+    """Keeps stored values in memory, changes are written to disk on flush.
+
+    Images that were used least recently are evicted on flush when there are more than
+    `max_images`, or when they take up more than `max_size_bytes`.
+    """
+
+    def __init__(self, filepath: str, stats: StorageStats):
+        self.filepath = filepath
+        self.stats = stats
+        self.dirty = False
+        self.max_images: Optional[int] = None
+        self.max_size_bytes: Optional[int] = None
+
+    def _mark_dirty(self):
+        if self.dirty:
+            self.stats.writes_avoided += 1
+        self.dirty = True
+
+    @abstractmethod
+    def get_setting(self, key: str) -> Any: ...
+
+    @abstractmethod
+    def set_setting(self, key: str, value: Any): ...
+
+    @abstractmethod
+    def remove_setting(self, key: str): ...
+
+    @abstractmethod
+    def get_image(self, image_key: str) -> Dict[str, Any]: ...
+
+    @abstractmethod
+    def set_image(self, image_key: str, key: str, value: Any): ...
+
+    @abstractmethod
+    def rename_image(self, old_image_key: str, new_image_key: str) -> bool:
+        """Move an image to a new key if that one is free, return whether it was moved."""
+
+    @abstractmethod
+    def count_images(self) -> int: ...
+
+    @abstractmethod
+    def evict(self) -> int:
+        """Remove the least recently used images that don't fit, return how many."""
+
+    @abstractmethod
+    def flush(self): ...
+
+    @abstractmethod
+    def compact(self):
+        """Evict and rewrite the storage on disk as small as possible."""
+
+    def close(self):
+        self.flush()
+
+
+class JsonBackend(StorageBackend):
+    """Everything in a single json file, settings and images side by side at the top level.
+
+    Images are kept in order of use, the least recently used first.
+    """
+
+    def __init__(self, filepath: str, stats: StorageStats):
+        super().__init__(filepath=filepath, stats=stats)
+        self._data: Optional[Dict[str, Any]] = None
+
+    def _load(self) -> Dict[str, Any]:
+        if self._data is not None:
+            self.stats.reads_avoided += 1
+            return self._data
+        self.stats.reads += 1
+        start = time.perf_counter()
+        try:
+            with open(self.filepath) as f:
+                self._data = json.load(f)
+            self.stats.size_bytes = os.path.getsize(self.filepath)
+        except FileNotFoundError:
+            self._data = {}
+            self.stats.size_bytes = 0
+        self.stats.load_seconds = time.perf_counter() - start
+        return self._data  # type: ignore[return-value]
+
+    def _image_keys(self) -> List[str]:
+        # image entries are the only values that are objects
+        return [key for key, value in self._load().items() if isinstance(value, dict)]
+
+    def get_setting(self, key: str) -> Any:
+        return self._load()[key]
+
+    def set_setting(self, key: str, value: Any):
+        self._load()[key] = value
+        self._mark_dirty()
+
+    def remove_setting(self, key: str):
+        self._load().pop(key, None)
+        self._mark_dirty()
+
+    def get_image(self, image_key: str) -> Dict[str, Any]:
+        data = self._load()
+        if data and next(reversed(data)) != image_key:
+            # move to the end to mark it as most recently used, which is written on flush
+            data[image_key] = data.pop(image_key)
+            self.dirty = True
+        return data[image_key]
+
+    def set_image(self, image_key: str, key: str, value: Any):
+        data = self._load()
+        image_data = data.pop(image_key, {})
+        image_data[key] = value
+        data[image_key] = image_data
+        self._mark_dirty()
+
+    def rename_image(self, old_image_key: str, new_image_key: str) -> bool:
+        data = self._load()
+        if new_image_key in data or not isinstance(data.get(old_image_key), dict):
+            return False
+        data[new_image_key] = data.pop(old_image_key)
+        self._mark_dirty()
+        return True
+
+    def count_images(self) -> int:
+        return len(self._image_keys())
+
+    def evict(self) -> int:
+        data = self._load()
+        image_keys = self._image_keys()
+        n_evict = 0
+        if self.max_images is not None:
+            n_evict = max(len(image_keys) - self.max_images, 0)
+        if self.max_size_bytes is not None:
+            sizes = [len(json.dumps({key: data[key]})) for key in image_keys]
+            size = len(json.dumps(data))
+            for entry_size in sizes[:n_evict]:
+                size -= entry_size
+            while size > self.max_size_bytes and n_evict < len(image_keys):
+                size -= sizes[n_evict]
+                n_evict += 1
+        for key in image_keys[:n_evict]:
+            del data[key]
+        self.stats.evicted += n_evict
+        return n_evict
+
+    def flush(self):
+        if not self.dirty or self._data is None:
+            return
+        self.evict()
+        self._write()
+
+    def compact(self):
+        self.evict()
+        self._write()
+
+    def _write(self):
+        # catch errors before start writing to the file
+        json_str = json.dumps(self._load())
+        with atomic_write(self.filepath, fsync=True) as f:
+            f.write(json_str)
+        self.dirty = False
+        self.stats.writes += 1
+        self.stats.size_bytes = len(json_str)
+
+
+class SqliteBackend(StorageBackend):
+    """Settings and images in separate tables, images are looked up one at a time by key."""
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY,
+            image_key TEXT NOT NULL,
+            data TEXT NOT NULL,
+            last_used REAL NOT NULL DEFAULT 0
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS images_image_key ON images (image_key);
+        CREATE INDEX IF NOT EXISTS images_last_used ON images (last_used);
+    """
+
+    def __init__(self, filepath: str, stats: StorageStats):
+        super().__init__(filepath=filepath, stats=stats)
+        start = time.perf_counter()
+        self.connection = sqlite3.connect(filepath)
+        self._upgrade_schema()
+        self.connection.executescript(self.schema)
+        self._settings: Dict[str, Any] = {}
+        self._removed_settings: Set[str] = set()
+        self._images: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._dirty_images: Set[str] = set()
+        self._removed_images: Set[str] = set()
+        self._used_images: Dict[str, float] = {}
+        self._last_used = 0.0
+        self._load_settings()
+        self.stats.load_seconds = time.perf_counter() - start
+        self.stats.size_bytes = self._size()
+
+    def _upgrade_schema(self):
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(images)")]
+        if columns and "last_used" not in columns:
+            self.connection.execute(
+                "ALTER TABLE images ADD COLUMN last_used REAL NOT NULL DEFAULT 0"
+            )
+
+    def _load_settings(self):
+        self.stats.reads += 1
+        self._settings = {
+            key: json.loads(value)
+            for key, value in self.connection.execute("SELECT key, value FROM settings")
+        }
+
+    def _size(self) -> int:
+        page_count = self.connection.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self.connection.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def import_json(self, json_filepath: str):
+        """Replace everything in the database with a json config."""
+        with open(json_filepath) as f:
+            data = json.load(f)
+        with self.connection:
+            self.connection.execute("DELETE FROM settings")
+            self.connection.execute("DELETE FROM images")
+            # the json config is ordered from least to most recently used
+            for i, (key, value) in enumerate(data.items()):
+                # image entries are the only values that are objects
+                if isinstance(value, dict):
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO images (image_key, data, last_used) "
+                        "VALUES (?, ?, ?)",
+                        (key, json.dumps(value), i),
+                    )
+                else:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                        (key, json.dumps(value)),
+                    )
+        self._images = {}
+        self._load_settings()
+
+    def export_json(self, json_filepath: str):
+        """Replace a json config with everything in the database."""
+        self.flush()
+        data: Dict[str, Any] = dict(self._settings)
+        # the json config is ordered from least to most recently used
+        for image_key, image_data in self.connection.execute(
+            "SELECT image_key, data FROM images ORDER BY last_used"
+        ):
+            data[image_key] = json.loads(image_data)
+        json_backend = JsonBackend(filepath=json_filepath, stats=StorageStats())
+        json_backend._data = data
+        json_backend.compact()
+
+    def get_setting(self, key: str) -> Any:
+        self.stats.reads_avoided += 1
+        return self._settings[key]
+
+    def set_setting(self, key: str, value: Any):
+        self._settings[key] = value
+        self._removed_settings.discard(key)
+        self._mark_dirty()
+
+    def remove_setting(self, key: str):
+        self._settings.pop(key, None)
+        self._removed_settings.add(key)
+        self._mark_dirty()
+
+    def _load_image(self, image_key: str) -> Optional[Dict[str, Any]]:
+        # strictly increasing, also when the clock has a coarse resolution
+        self._last_used = max(time.time(), self._last_used + 1e-6)
+        self._used_images[image_key] = self._last_used
+        if image_key in self._images:
+            self.stats.reads_avoided += 1
+            return self._images[image_key]
+        self.stats.reads += 1
+        row = self.connection.execute(
+            "SELECT data FROM images WHERE image_key = ?", (image_key,)
+        ).fetchone()
+        image_data = json.loads(row[0]) if row else None
+        self._images[image_key] = image_data
+        return image_data
+
+    def get_image(self, image_key: str) -> Dict[str, Any]:
+        image_data = self._load_image(image_key)
+        if image_data is None:
+            raise KeyError(image_key)
+        # the time it was used is written on flush
+        self.dirty = True
+        return image_data
+
+    def set_image(self, image_key: str, key: str, value: Any):
+        image_data = self._load_image(image_key)
+        if image_data is None:
+            image_data = self._images[image_key] = {}
+        image_data[key] = value
+        self._dirty_images.add(image_key)
+        self._removed_images.discard(image_key)
+        self._mark_dirty()
+
+    def rename_image(self, old_image_key: str, new_image_key: str) -> bool:
+        if self._load_image(new_image_key) is not None:
+            return False
+        image_data = self._load_image(old_image_key)
+        if image_data is None:
+            return False
+        self._images[new_image_key] = image_data
+        self._images[old_image_key] = None
+        self._dirty_images.add(new_image_key)
+        self._removed_images.add(old_image_key)
+        self._mark_dirty()
+        return True
+
+    def count_images(self) -> int:
+        # images that were only set in memory are not in the table yet
+        self.flush()
+        return self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def evict(self) -> int:
+        evicted: List[str] = []
+        if self.max_images is not None:
+            evicted += [
+                row[0]
+                for row in self.connection.execute(
+                    "SELECT image_key FROM images ORDER BY last_used DESC LIMIT -1 OFFSET ?",
+                    (self.max_images,),
+                )
+            ]
+        if self.max_size_bytes is not None:
+            rows = self.connection.execute(
+                "SELECT image_key, LENGTH(image_key) + LENGTH(data) FROM images "
+                "ORDER BY last_used DESC"
+            ).fetchall()
+            size = 0
+            for image_key, entry_size in rows:
+                size += entry_size
+                if size > self.max_size_bytes and image_key not in evicted:
+                    evicted.append(image_key)
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM images WHERE image_key = ?", [(key,) for key in evicted]
+            )
+        for image_key in evicted:
+            self._images.pop(image_key, None)
+            self._used_images.pop(image_key, None)
+        self.stats.evicted += len(evicted)
+        return len(evicted)
+
+    def flush(self):
+        if not self.dirty:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO settings (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                [(key, json.dumps(value)) for key, value in self._settings.items()],
+            )
+            self.connection.executemany(
+                "DELETE FROM settings WHERE key = ?",
+                [(key,) for key in self._removed_settings],
+            )
+            self.connection.executemany(
+                "INSERT INTO images (image_key, data, last_used) VALUES (?, ?, ?) "
+                "ON CONFLICT(image_key) DO UPDATE SET data = excluded.data, "
+                "last_used = excluded.last_used",
+                [
+                    (image_key, json.dumps(self._images[image_key]), self._used_images[image_key])
+                    for image_key in self._dirty_images
+                ],
+            )
+            self.connection.executemany(
+                "DELETE FROM images WHERE image_key = ?",
+                [(image_key,) for image_key in self._removed_images],
+            )
+            self.connection.executemany(
+                "UPDATE images SET last_used = ? WHERE image_key = ?",
+                [
+                    (last_used, image_key)
+                    for image_key, last_used in self._used_images.items()
+                    if image_key not in self._dirty_images
+                ],
+            )
+        self._removed_settings = set()
+        self._dirty_images = set()
+        self._removed_images = set()
+        self._used_images = {}
+        self.evict()
+        self.dirty = False
+        self.stats.writes += 1
+
+    def compact(self):
+        self.dirty = True
+        self.flush()
+        self.connection.execute("VACUUM")
+        self.stats.size_bytes = self._size()
+
+    def close(self):
+        super().close()
+        self.connection.close()
+
+
+storage_backends = {
+    "json": JsonBackend,
+    "sqlite": SqliteBackend,
+}
@@ -1,4 +1,7 @@
-from typing import TYPE_CHECKING, Optional, Tuple, Type
+import os.path
+import tempfile
+from contextlib import contextmanager
+from typing import IO, TYPE_CHECKING, Iterator, Optional, Tuple, Type
 
 from PySide6.QtCore import QObject, QSize
 from PySide6.QtWidgets import QApplication
@@ -28,9 +31,9 @@ def get_image_window_size_px() -> Tuple[int, int]:
     return size_to_tuple(image_window.size())
 
 
-def get_image_filename() -> Optional[str]:
+def get_image_key() -> Optional[str]:
     image_window = get_image_window()
-    return image_window.image.image_filename if image_window.image else None
+    return image_window.image.image_key if image_window.image else None
 
 
 def find_child_by_attribute(parent: QObject, child_type: Type[QObject], text: Optional[str] = None):
@@ -44,3 +47,28 @@ def find_child_by_attribute(parent: QObject, child_type: Type[QObject], text: Op
     raise AttributeError(
         f"Could not find child of type {child_type} with text '{text}' in {parent}"
     )
+
+
+@contextmanager
+def atomic_write(filepath: str, mode: str = "w", fsync: bool = False) -> Iterator[IO]:
+    """Write to a temporary file next to `filepath`, which replaces it once it is complete.
+
+    A crash never leaves a half-written file behind, and on errors the temporary file is removed.
+    With `fsync` the contents are on disk before the file is replaced.
+    """
+    f = tempfile.NamedTemporaryFile(
+        mode, dir=os.path.dirname(filepath), suffix=".tmp", delete=False
+    )
+    try:
+        with f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(f.name, filepath)
+    except BaseException:
+        try:
+            os.remove(f.name)
+        except OSError:
+            pass
+        raise
@@ -9,7 +9,8 @@ from battle_map_tv.layouts.app_controls import AppControlsLayout
 from battle_map_tv.layouts.area_of_effect_controls import AreaOfEffectControls
 from battle_map_tv.layouts.grid_controls import GridControls
 from battle_map_tv.layouts.image_controls import ImageButtonsLayout, ImageScaleSlidersLayout
-from battle_map_tv.layouts.initiative_controls import InitiativeControls
+from battle_map_tv.layouts.initiative_controls import InitiativeControls, InitiativeTextArea
+from battle_map_tv.utils import find_child_by_attribute
 from battle_map_tv.widgets import get_window_icon
 
 
@@ -33,6 +34,10 @@ class GuiWindow(QWidget):
         # take focus away from the text area
         self.setFocus()
 
+    def restore_session(self):
+        find_child_by_attribute(self, GridControls).restore_session()
+        find_child_by_attribute(self, InitiativeTextArea).restore_session()
+
     def mousePressEvent(self, event):
         # user clicked in the blank space of the GUI, take focus away from other elements
         self.setFocus()
@@ -1,18 +1,37 @@
+from functools import partial
 from typing import Callable, Optional
 
-from PySide6.QtCore import Qt
-from PySide6.QtGui import QImageReader, QMouseEvent
+from PySide6.QtCore import Qt, Signal
+from PySide6.QtGui import QMouseEvent
 from PySide6.QtWidgets import QGraphicsScene, QGraphicsView
 
+from battle_map_tv import scale_detection
 from battle_map_tv.area_of_effect.manager import AreaOfEffectManager
+from battle_map_tv.fingerprint import image_fingerprint
 from battle_map_tv.grid import Grid, GridOverlay
 from battle_map_tv.image import Image
+from battle_map_tv.image_buffer import ImageBuffer
+from battle_map_tv.image_cache import image_cache, neighbour_images
 from battle_map_tv.initiative import InitiativeOverlayManager
+from battle_map_tv.journal import SessionKeys, session_journal
+from battle_map_tv.pixel_cache import load_image_pixels, store_pixels
+from battle_map_tv.scale_detection import ImageScale
+from battle_map_tv.settings import Settings
 from battle_map_tv.storage import ImageKeys, StorageKeys, get_from_storage, get_image_from_storage
 from battle_map_tv.widgets import get_window_icon
+from battle_map_tv.workers import Worker
+
+# the images before and after the shown image in the default directory that are decoded ahead
+prefetch_neighbours = 1
 
 
 class ImageWindow(QGraphicsView):
+    autoscale_started = Signal()
+    autoscale_progress = Signal(str)
+    autoscale_finished = Signal()
+    image_loaded = Signal()
+    image_load_failed = Signal(str)
+
     def __init__(self):
         super().__init__()
         self.setObjectName("image_window")
@@ -27,8 +46,6 @@ class ImageWindow(QGraphicsView):
         self.setAlignment(Qt.AlignCenter)  # type: ignore[attr-defined]
         self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)  # type: ignore[attr-defined]
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)  # type: ignore[attr-defined]
-        # allow for large size images
-        QImageReader.setAllocationLimit(0)
 
         scene = QGraphicsScene()
         scene.setSceneRect(0, 0, self.size().width(), self.size().height())
@@ -39,6 +56,9 @@ class ImageWindow(QGraphicsView):
         self.grid_overlay: Optional[GridOverlay] = None
         self.initiative_overlay_manager = InitiativeOverlayManager(scene=scene)
         self.area_of_effect_manager = AreaOfEffectManager(window=self, grid=self.grid)
+        self._autoscale_worker: Optional[Worker] = None
+        self._load_worker: Optional[Worker] = None
+        self._previous_image_path: Optional[str] = None
 
     def toggle_fullscreen(self):
         if self.isFullScreen():
@@ -47,19 +67,86 @@ class ImageWindow(QGraphicsView):
             self.showFullScreen()
 
     def add_image(self, image_path: str):
+        """Show an image right away, its pixels are decoded in the background.
+
+        A preview is shown as soon as it is decoded, then the full image. Images that were shown
+        or prefetched before are taken from the image cache instead, or mapped from the pixel
+        cache on disk without decoding them. Raises a ValueError when the image can't be read.
+        """
+        try:
+            buffer = image_cache.get(image_fingerprint(image_path))
+        except OSError as e:
+            raise ValueError(f"Failed to read '{image_path}'") from e
         self.image = Image(
             image_path=image_path,
             scene=self.scene(),
             window_width_px=self.width(),
             window_height_px=self.height(),
+            buffer=buffer,
         )
+        image = self.image
         if self.grid_overlay is not None:
             self.add_grid(color_value=self.grid_overlay.color_value)
+        if buffer is not None:
+            self._prefetch_images(image)
+            self.image_loaded.emit()
+            return
+        worker = Worker(load_image_pixels, image.filepath, image.image_key, store=False)
+        queued = Qt.ConnectionType.QueuedConnection
+        worker.signals.progress.connect(partial(self._image_preview, image), queued)
+        worker.signals.finished.connect(partial(self._image_loaded, image, worker), queued)
+        worker.signals.cancelled.connect(partial(self._image_load_stopped, worker), queued)
+        worker.signals.error.connect(partial(self._image_load_failed, worker), queued)
+        self._load_worker = worker
+        worker.start()
+
+    def is_loading_image(self) -> bool:
+        return self._load_worker is not None
+
+    def _image_preview(self, image: Image, args: tuple):
+        (preview,) = args
+        image.set_preview(preview)
+
+    def _image_loaded(self, image: Image, worker: Worker, buffer: ImageBuffer):
+        image_cache.put(image.image_key, buffer)
+        # after the image is shown, decoding it again is skipped next time
+        Worker(store_pixels, image.image_key, buffer).start(priority=-1)
+        # the image may have been replaced while loading
+        if image is self.image:
+            image.set_buffer(buffer)
+            self._prefetch_images(image)
+        self._image_load_stopped(worker)
+
+    def _prefetch_images(self, image: Image):
+        """Decode the previous image and the images next to this one, for switching quickly."""
+        image_paths = neighbour_images(
+            image.filepath, Settings.default_directory, n=prefetch_neighbours
+        )
+        if self._previous_image_path is not None:
+            image_paths.insert(0, self._previous_image_path)
+        for image_path in image_paths:
+            if image_path != image.filepath:
+                image_cache.prefetch(image_path)
+
+    def _image_load_failed(self, worker: Worker, error: Exception):
+        if worker is self._load_worker:
+            self.image_load_failed.emit(str(error))
+        self._image_load_stopped(worker)
+
+    def _image_load_stopped(self, worker: Worker, *_):
+        # a cancelled worker can stop after the next one started
+        if worker is self._load_worker:
+            self._load_worker = None
+            self.image_loaded.emit()
 
     def remove_image(self):
+        if self._load_worker is not None:
+            self._load_worker.cancel()
         if self.image is not None:
+            self._previous_image_path = self.image.filepath
             self.image.delete()
             self.image = None
+            session_journal.delete(SessionKeys.image)
 
     def restore_image(self):
         try:
@@ -68,7 +155,30 @@ class ImageWindow(QGraphicsView):
             pass
         else:
             self.remove_image()
-            self.add_image(image_path=previous_image)
+            try:
+                self.add_image(image_path=previous_image)
+            except ValueError:
+                pass
+
+    def restore_session(self):
+        image_state = session_journal.get(SessionKeys.image)
+        if image_state:
+            try:
+                self.add_image(image_path=image_state["path"])
+            except ValueError:
+                pass
+            else:
+                assert self.image is not None
+                if "rotation" in image_state:
+                    self.image.set_rotation(image_state["rotation"])
+                if "scale" in image_state:
+                    self.image.scale(image_state["scale"])
+                if "position" in image_state:
+                    self.image.pixmap_item.set_position(image_state["position"])
+        grid_state = session_journal.get(SessionKeys.grid, {})
+        if "pixels_per_square" in grid_state:
+            self.grid.set_size(grid_state["pixels_per_square"])
+        self.area_of_effect_manager.restore(session_journal.get(SessionKeys.area_of_effect, {}))
 
     def center_image(self):
         if self.image is not None:
@@ -78,9 +188,67 @@ class ImageWindow(QGraphicsView):
         if self.image is not None:
             self.image.rotate()
 
-    def autoscale_image(self):
-        if self.image is not None:
-            self.image.autoscale(grid=self.grid)
+    def autoscale_image(self, refine: bool = False, align: bool = False):
+        """Scale the image to the grid, detecting its scale in the background if needed.
+
+        The detection is quick, within `scale_detection.quick_time_budget`. With `refine` the
+        scale is detected again without a time budget.
+        With `align` the image is also moved so its grid lines are on the overlay grid.
+        Autoscaling a detected image again moves on to the next candidate scale, without
+        detecting again.
+        """
+        if self.image is None or self.is_autoscaling():
+            return
+        image = self.image
+        image_scale = image.cached_image_scale(redetect=refine)
+        if image_scale is not None:
+            # align keeps the candidate scale, autoscale moves on to the next
+            self._apply_image_scale(image, image_scale, align=align, step=0 if align else 1)
+            return
+        time_budget = None if refine else scale_detection.quick_time_budget
+        worker = Worker(image.detect_image_scale, time_budget=time_budget)
+        queued = Qt.ConnectionType.QueuedConnection
+        worker.signals.progress.connect(self._autoscale_progress, queued)
+        worker.signals.finished.connect(partial(self._autoscale_done, image, align), queued)
+        worker.signals.cancelled.connect(self._autoscale_stopped, queued)
+        worker.signals.error.connect(self._autoscale_stopped, queued)
+        self._autoscale_worker = worker
+        worker.start()
+        self.autoscale_started.emit()
+
+    def refine_image_scale(self):
+        self.autoscale_image(refine=True)
+
+    def align_image(self):
+        self.autoscale_image(align=True)
+
+    def is_autoscaling(self) -> bool:
+        return self._autoscale_worker is not None
+
+    def cancel_autoscale(self):
+        if self._autoscale_worker is not None:
+            self._autoscale_worker.cancel()
+
+    def _autoscale_progress(self, args: tuple):
+        axis, step = args
+        self.autoscale_progress.emit(f"Detecting {axis} lines, step {step}")
+
+    def _autoscale_done(self, image: Image, align: bool, image_scale: ImageScale):
+        # the image may have been replaced while detecting
+        if image is self.image:
+            self._apply_image_scale(image, image_scale, align=align)
+        self._autoscale_stopped()
+
+    def _apply_image_scale(
+        self, image: Image, image_scale: ImageScale, align: bool, step: Optional[int] = None
+    ):
+        image.autoscale(grid=self.grid, image_scale=image_scale, step=step)
+        if align:
+            image.align(grid=self.grid, image_scale=image_scale)
+
+    def _autoscale_stopped(self, *_):
+        self._autoscale_worker = None
+        self.autoscale_finished.emit()
 
     def scale_image(self, value: int, dispatch_event: bool = False):
         if self.image is not None:
@@ -91,7 +259,7 @@ class ImageWindow(QGraphicsView):
             self.remove_grid()
         if self.image is not None:
             pixels_per_square = get_image_from_storage(
-                image_filename=self.image.image_filename,
+                image_key=self.image.image_key,
                 key=ImageKeys.grid_pixels_per_square,
                 default=None,
             )
@@ -99,6 +267,7 @@ class ImageWindow(QGraphicsView):
                 self.grid.set_size(pixels_per_square)
         self.grid_overlay = GridOverlay(window=self, grid=self.grid, color_value=color_value)
         self.grid.enable_snap = True
+        session_journal.record(SessionKeys.grid, "color", value=color_value)
 
     def scale_grid(self, value: int):
         self.grid.set_size(value)
@@ -108,15 +277,18 @@ class ImageWindow(QGraphicsView):
     def change_grid_color(self, value: int):
         if self.grid_overlay is not None:
             self.grid_overlay.update_color(value)
+            session_journal.record(SessionKeys.grid, "color", value=value)
 
     def remove_grid(self):
         if self.grid_overlay is not None:
             self.grid_overlay.delete()
             self.grid_overlay = None
             self.grid.enable_snap = False
+            session_journal.delete(SessionKeys.grid, "color")
 
     def add_initiative(self, text: str):
         self.initiative_overlay_manager.create(text=text)
+        session_journal.record(SessionKeys.initiative, value=text)
 
     def initiative_change_font_size(self, by: int):
         self.initiative_overlay_manager.change_font_size(by=by)
@@ -126,6 +298,7 @@ class ImageWindow(QGraphicsView):
 
     def remove_initiative(self):
         self.initiative_overlay_manager.clear()
+        session_journal.delete(SessionKeys.initiative)
 
     def add_area_of_effect(self, shape: str, callback: Callable):
         self.area_of_effect_manager.wait_for(
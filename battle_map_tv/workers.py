@@ -0,0 +1,92 @@
+import gc
+import threading
+import traceback
+from typing import Callable, Optional
+
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, QTimer, Signal
+
+
+class WorkerCancelled(Exception):
+    pass
+
+
+class WorkerSignals(QObject):
+    progress = Signal(tuple)
+    finished = Signal(object)
+    cancelled = Signal()
+    error = Signal(Exception)
+
+
+class Worker(QRunnable):
+    """Run a function on the thread pool and report back through signals.
+
+    The function is called with a `progress` keyword argument. Calling it emits the `progress`
+    signal with its arguments, after `cancel()` it raises `WorkerCancelled` instead, which ends
+    the function at the next progress report.
+
+    The signals are emitted from the thread pool, connect them with
+    `Qt.ConnectionType.QueuedConnection` to handle them on the gui thread.
+    """
+
+    def __init__(self, function: Callable, *args, **kwargs):
+        super().__init__()
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = WorkerSignals()
+        self._cancel = threading.Event()
+
+    def start(self, priority: int = 0):
+        """Queue the worker, ahead of the queued workers with a lower `priority`."""
+        QThreadPool.globalInstance().start(self, priority)
+
+    def cancel(self):
+        self._cancel.set()
+
+    def is_cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def run(self):
+        try:
+            result = self.function(*self.args, progress=self._progress, **self.kwargs)
+        except WorkerCancelled:
+            self.signals.cancelled.emit()
+        except Exception as e:
+            traceback.print_exc()
+            self.signals.error.emit(e)
+        else:
+            self.signals.finished.emit(result)
+
+    def _progress(self, *args):
+        if self._cancel.is_set():
+            raise WorkerCancelled()
+        self.signals.progress.emit(args)
+
+
+_garbage_collection_timer: Optional[QTimer] = None
+
+
+def collect_garbage_on_gui_thread(interval_ms: int = 1000):
+    """Collect reference cycles on a timer on the gui thread, instead of on any thread.
+
+    Python collects garbage on the thread that happens to allocate, which is often a worker. A
+    cycle with Qt objects in it, like a removed image and its pixmap item, would then be deleted
+    outside the thread it belongs to, which crashes.
+    """
+    global _garbage_collection_timer
+    if _garbage_collection_timer is not None:
+        return
+    gc.disable()
+    _garbage_collection_timer = QTimer()
+    _garbage_collection_timer.timeout.connect(_collect_garbage)
+    _garbage_collection_timer.start(interval_ms)
+
+
+def _collect_garbage():
+    # the oldest generation that automatic collection would have collected by now
+    threshold = gc.get_threshold()
+    count = gc.get_count()
+    for generation in (2, 1, 0):
+        if count[generation] > threshold[generation]:
+            gc.collect(generation)
+            return
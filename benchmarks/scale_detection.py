@@ -0,0 +1,332 @@
+"""Benchmark the scale detection for speed, memory use and accuracy.
+
+Runs the detection on the maps in tests/images and on generated grid maps with a known scale,
+each in a fresh process, and writes the results to json. Compare two result files to find
+regressions between commits:
+
+    python -m benchmarks.scale_detection --output before.json
+    python -m benchmarks.scale_detection --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None  # type: ignore[assignment]
+
+repository_path = Path(__file__).parents[1]
+images_path = repository_path / "tests" / "images"
+maps_path = Path(tempfile.gettempdir()) / "battle-map-tv-benchmark"
+
+# the maps used in the tests, with the scale they should be detected at
+test_images = {
+    "19d33097089ed961c4660b3a0bf671e1.png": 45,
+    "27995b4c0d372367142ddf0ead558bac.png": 24,
+    "f46702b17442d0be4acc06cb7aa25ab8.jpg": 34,
+    "67ce2ff0f7dfbff87d767d2c3da67662.jpg": 35,
+    "6932a173690af4b593f8a6b52df3bd31.jpg": 72,
+    "675a18475269c17cfa20c980e7c05ea0.jpg": 100,
+    "58fed75f78a991251930918a5793051d.jpg": 70,
+    "7b1071f5cddcfa565d89dbdce45b9e39.jpg": 50,
+    "e586d099df4e4c0eb82726f6373d964f.jpg": 72,
+    "pux2idlwle65yipahqnmukisnss54cyv.jpg": 73,
+}
+
+default_sizes = [1000, 2000, 4000, 8000, 16000]
+
+# a case is slower when it takes this much more time, and at least this many seconds more
+time_tolerance = 0.2
+min_time_difference = 0.05
+# a case is less accurate when its error grows beyond this many pixels
+error_tolerance = 1.0
+
+
+def generate_map(size: int, seed: int) -> Dict[str, Any]:
+    """Write a map with a grid, some features, noise and jpeg artifacts, if it doesn't exist yet.
+
+    The longest side is `size` pixels and the grid has 20 to 50 squares along it.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size, size * 2 // 3
+    period = size / rng.uniform(20, 50)
+    filepath = maps_path / f"grid-{size}-{seed}.jpg"
+    if not filepath.exists():
+        maps_path.mkdir(parents=True, exist_ok=True)
+        # smooth colored background, like floors and terrain
+        coarse = rng.integers(60, 200, size=(height // 64 + 2, width // 64 + 2, 3), dtype=np.uint8)
+        image = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+        # walls, furniture and trees
+        for _ in range(int(width * height / period**2 / 4)):
+            center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            color = tuple(int(c) for c in rng.integers(0, 255, size=3))
+            radius = int(rng.uniform(0.1, 1.5) * period)
+            if rng.random() < 0.5:
+                cv2.circle(image, center, radius, color, thickness=-1)
+            else:
+                corner = (center[0] + radius, center[1] + int(rng.uniform(0.1, 1.5) * period))
+                cv2.rectangle(image, center, corner, color, thickness=-1)
+        # the grid, at sub-pixel positions
+        shift = 4
+        thickness = max(1, round(period / 40))
+        offset_x, offset_y = rng.uniform(0, period, size=2)
+        for x in np.arange(offset_x, width, period):
+            x_fixed = int(x * 2**shift)
+            cv2.line(
+                image,
+                (x_fixed, 0),
+                (x_fixed, height << shift),
+                (30, 30, 30),
+                thickness,
+                shift=shift,
+            )
+        for y in np.arange(offset_y, height, period):
+            y_fixed = int(y * 2**shift)
+            cv2.line(
+                image, (0, y_fixed), (width << shift, y_fixed), (30, 30, 30), thickness, shift=shift
+            )
+        # sensor like noise, added in strips to limit memory use
+        for top in range(0, height, 1024):
+            strip = image[top : top + 1024]
+            noise = rng.normal(0, 10, size=strip.shape).astype(np.int16)
+            strip[:] = np.clip(strip.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+        cv2.imwrite(str(filepath), image, [cv2.IMWRITE_JPEG_QUALITY, 70])
+    return {
+        "name": f"synthetic-{size}px",
+        "path": str(filepath),
+        "expected": period,
+        "width": width,
+        "height": height,
+    }
+
+
+def run_case(
+    case: Dict[str, Any], engine: str, tiled: Optional[bool], time_budget: Optional[float]
+) -> Dict[str, Any]:
+    """Detect the scale of one map, in a fresh process."""
+    from battle_map_tv import scale_detection
+
+    memory_before = _reset_peak_memory()
+    start = time.perf_counter()
+    result = scale_detection.find_image_scale(
+        case["path"], engine=engine, tiled=tiled, time_budget=time_budget
+    )
+    seconds = time.perf_counter() - start
+    memory_after = _peak_memory()
+
+    return {
+        **case,
+        "detected": result.px_per_inch,
+        "error": abs(result.px_per_inch - case["expected"]),
+        "confidence": result.confidence,
+        "seconds": seconds,
+        "seconds_per_stage": result.seconds,
+        "peak_memory_bytes": (
+            memory_after - memory_before
+            if memory_before is not None and memory_after is not None
+            else None
+        ),
+        "steps": sum(result.steps.values()),
+        "timed_out": result.timed_out,
+    }
+
+
+def _reset_peak_memory() -> Optional[int]:
+    """Reset the peak memory use of this process where possible, returns the current use."""
+    try:
+        # a spawned process inherits the peak of its parent in ru_maxrss, Linux can reset it
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _proc_status_bytes("VmRSS")
+    except OSError:
+        return _peak_memory()
+
+
+def _peak_memory() -> Optional[int]:
+    try:
+        return _proc_status_bytes("VmHWM")
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def _proc_status_bytes(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) * 1024
+    raise OSError(f"No {field} in /proc/self/status")
+
+
+def collect_cases(sizes: List[int], include_test_images: bool) -> List[Dict[str, Any]]:
+    from battle_map_tv.scale_detection import read_image_size
+
+    cases = []
+    if include_test_images:
+        for filename, expected in test_images.items():
+            width, height = read_image_size(str(images_path / filename))
+            cases.append(
+                {
+                    "name": filename,
+                    "path": str(images_path / filename),
+                    "expected": expected,
+                    "width": width,
+                    "height": height,
+                }
+            )
+    for size in sizes:
+        print(f"Generating a {size} px map")
+        cases.append(generate_map(size, seed=size))
+    return cases
+
+
+def run(
+    cases: List[Dict[str, Any]],
+    engine: str,
+    tiled: Optional[bool],
+    time_budget: Optional[float] = None,
+) -> Dict[str, Any]:
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for case in cases:
+        # a new process for every case, so the peak memory use is of that case alone
+        with context.Pool(1) as pool:
+            result = pool.apply(run_case, (case, engine, tiled, time_budget))
+        print(
+            f"{result['name']}: {result['detected']:.2f} px (expected {result['expected']:.2f}), "
+            f"{result['seconds']:.2f} s, {_format_bytes(result['peak_memory_bytes'])}, "
+            f"{result['steps']} steps, "
+            f"{result['seconds_per_stage'].get('hough', 0):.2f} s counting Hough votes"
+            + (", timed out" if result["timed_out"] else "")
+        )
+        results.append(result)
+    return {
+        "commit": _git_commit(),
+        "engine": engine,
+        "tiled": tiled,
+        "time_budget": time_budget,
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "total_seconds": sum(result["seconds"] for result in results),
+        "max_error": max(result["error"] for result in results),
+        "cases": results,
+    }
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> List[str]:
+    """Print the differences per case, returns the regressions."""
+    old_cases = {case["name"]: case for case in old["cases"]}
+    regressions = []
+    print(f"Comparing {new.get('commit')} to {old.get('commit')}")
+    for case in new["cases"]:
+        old_case = old_cases.get(case["name"])
+        if old_case is None:
+            continue
+        ratio = case["seconds"] / old_case["seconds"] if old_case["seconds"] else float("inf")
+        print(
+            f"{case['name']}: {old_case['seconds']:.2f} s -> {case['seconds']:.2f} s ({ratio:.2f}x), "
+            f"error {old_case['error']:.2f} -> {case['error']:.2f} px"
+        )
+        if (
+            ratio > 1 + time_tolerance
+            and case["seconds"] - old_case["seconds"] > min_time_difference
+        ):
+            regressions.append(f"{case['name']} is {ratio:.2f}x slower")
+        if case["error"] > max(old_case["error"], error_tolerance):
+            regressions.append(f"{case['name']} is off by {case['error']:.2f} px")
+    return regressions
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=repository_path,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _format_bytes(n_bytes: Optional[int]) -> str:
+    if n_bytes is None:
+        return "unknown memory"
+    return f"{n_bytes / 1024**2:.0f} MB"
+
+
+def main():
+    from battle_map_tv.scale_detection import default_engine, detection_engines
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--engine", choices=list(detection_engines), default=default_engine)
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="*",
+        default=default_sizes,
+        help="Sizes of the generated maps in pixels",
+    )
+    parser.add_argument(
+        "--no-test-images",
+        dest="include_test_images",
+        action="store_false",
+        help="Only use generated maps",
+    )
+    parser.add_argument(
+        "--tiled",
+        dest="tiled",
+        action="store_const",
+        const=True,
+        help="Detect every map in tiles, by default only maps larger than the memory budget",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        help="Detect within this many seconds, like autoscale in the gui",
+    )
+    parser.add_argument("--output", help="Write the results to this json file")
+    parser.add_argument("--compare", help="Compare with the results in this json file")
+    args = parser.parse_args()
+
+    results = run(
+        collect_cases(args.sizes, args.include_test_images),
+        engine=args.engine,
+        tiled=args.tiled,
+        time_budget=args.time_budget,
+    )
+    print(f"Total {results['total_seconds']:.2f} s, max error {results['max_error']:.2f} px")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,30 @@
 import pytest
 from PySide6.QtWidgets import QApplication
 
+from battle_map_tv import storage
 from battle_map_tv.window_gui import GuiWindow
 from battle_map_tv.window_image import ImageWindow
+from battle_map_tv.workers import collect_garbage_on_gui_thread
+
+
+@pytest.fixture
+def config_filepath(tmp_path, monkeypatch):
+    """Keep the settings of a test in its own files."""
+    filepath = tmp_path / "config.json"
+    monkeypatch.setattr(storage, "filepath", str(filepath))
+    monkeypatch.setattr(storage, "sqlite_filepath", str(tmp_path / "config.sqlite3"))
+    monkeypatch.setattr(storage._Cache, "backend_name", None)
+    monkeypatch.setattr(storage._Cache, "backend", None)
+    monkeypatch.setattr(storage._Cache, "timer", None)
+    monkeypatch.setattr(storage, "storage_stats", storage.StorageStats())
+    yield filepath
+    storage.reset_storage_cache()
 
 
 @pytest.fixture
 def app_instance(qtbot):
     app = QApplication.instance() or QApplication([])
+    collect_garbage_on_gui_thread()
     return app
 
 
@@ -18,6 +35,9 @@ def image_window(app_instance, qtbot):
     image_window.move(image_window.screen().geometry().center())
     yield image_window
     image_window.close()
+    # closed windows are still top level widgets, make sure get_image_window doesn't find this one
+    image_window.setObjectName("")
+    image_window.deleteLater()
 
 
 @pytest.fixture
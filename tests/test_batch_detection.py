@@ -0,0 +1,40 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from battle_map_tv import scale_cache
+from battle_map_tv.batch_detection import detect_directory
+from battle_map_tv.fingerprint import image_fingerprint
+from battle_map_tv.scale_cache import get_cached_scale
+
+images_path = Path(__file__).parent / "images"
+
+
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(scale_cache, "path", str(tmp_path / "scale_detection"))
+
+
+def test_detect_directory(tmp_path):
+    maps_path = tmp_path / "maps"
+    (maps_path / "dungeons").mkdir(parents=True)
+    shutil.copy(images_path / "67ce2ff0f7dfbff87d767d2c3da67662.jpg", maps_path / "cave.jpg")
+    shutil.copy(images_path / "67ce2ff0f7dfbff87d767d2c3da67662.jpg", maps_path / "copy.jpg")
+    shutil.copy(
+        images_path / "19d33097089ed961c4660b3a0bf671e1.png", maps_path / "dungeons" / "crypt.png"
+    )
+    (maps_path / "notes.txt").write_text("not a map")
+
+    counts = detect_directory(str(maps_path), engine="periodicity", workers=1)
+    assert counts == {"detected": 2, "skipped": 1, "failed": 0}
+    image_scale = get_cached_scale(
+        image_fingerprint(str(maps_path / "dungeons" / "crypt.png")), engine="periodicity"
+    )
+    assert image_scale is not None
+    assert image_scale.px_per_inch == pytest.approx(45, abs=1)
+
+    # a second run resumes, only new maps are detected
+    shutil.copy(images_path / "f46702b17442d0be4acc06cb7aa25ab8.jpg", maps_path / "forest.jpg")
+    counts = detect_directory(str(maps_path), engine="periodicity", workers=1)
+    assert counts == {"detected": 1, "skipped": 3, "failed": 0}
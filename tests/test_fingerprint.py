@@ -0,0 +1,32 @@
+import os
+import shutil
+from pathlib import Path
+
+from battle_map_tv.fingerprint import image_fingerprint
+
+images_path = Path(__file__).parent / "images"
+
+
+def test_image_fingerprint_follows_content(tmp_path):
+    image_a = images_path / "58fed75f78a991251930918a5793051d.jpg"
+    image_b = images_path / "675a18475269c17cfa20c980e7c05ea0.jpg"
+    (tmp_path / "one").mkdir()
+    (tmp_path / "two").mkdir()
+    shutil.copy(image_a, tmp_path / "one" / "map.jpg")
+    shutil.copy(image_b, tmp_path / "two" / "map.jpg")
+    shutil.copy(image_a, tmp_path / "renamed.jpg")
+
+    fingerprint = image_fingerprint(str(tmp_path / "one" / "map.jpg"))
+    assert fingerprint == image_fingerprint(str(image_a))
+    assert fingerprint == image_fingerprint(str(tmp_path / "renamed.jpg"))
+    assert fingerprint != image_fingerprint(str(tmp_path / "two" / "map.jpg"))
+
+
+def test_image_fingerprint_changes_with_file(tmp_path):
+    filepath = tmp_path / "map.png"
+    filepath.write_bytes(b"a" * 1_000_000)
+    fingerprint = image_fingerprint(str(filepath))
+    with open(filepath, "r+b") as f:
+        f.write(b"b")
+    os.utime(filepath, ns=(0, 1))
+    assert image_fingerprint(str(filepath)) != fingerprint
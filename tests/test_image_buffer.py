@@ -0,0 +1,130 @@
+from pathlib import Path
+from typing import List
+
+import cv2
+import numpy as np
+import pytest
+from PySide6.QtCore import QRect, QSize
+from PySide6.QtGui import QImage, QImageReader, QTransform
+
+from battle_map_tv import image_buffer
+from battle_map_tv.image_buffer import ImageBuffer, decode_size, load_image_buffer
+
+image_path = Path(__file__).parent / "images" / "7b1071f5cddcfa565d89dbdce45b9e39.jpg"
+
+
+def test_image_buffer_shares_pixels(app_instance):
+    buffer = ImageBuffer.from_file(str(image_path))
+    width, height = buffer.size
+    assert buffer.array.shape == (height, width, 4)
+    assert not buffer.array.flags.writeable
+    color = buffer.qimage.pixelColor(12, 34)
+    assert tuple(buffer.array[34, 12, :3]) == (color.blue(), color.green(), color.red())
+
+    tile = buffer.tile(QRect(0, 0, 100, 60), factor=4)
+    assert (tile.width(), tile.height()) == (25, 15)
+    assert tile.format() == buffer.qimage.format()
+
+
+def test_image_buffer_grey(app_instance):
+    buffer = ImageBuffer.from_file(str(image_path))
+    expected = cv2.imread(str(image_path), cv2.IMREAD_GRAYSCALE)
+    assert expected is not None
+    grey = buffer.grey()
+    assert grey.shape == expected.shape
+    assert np.mean(np.abs(grey.astype(int) - expected)) < 2
+    assert buffer.grey(factor=2).shape == (expected.shape[0] // 2, expected.shape[1] // 2)
+    crop = buffer.grey_crop(QRect(10, 20, 30, 40))
+    assert np.array_equal(crop, grey[20:60, 10:40])
+
+
+def test_image_buffer_transformed(app_instance):
+    buffer = ImageBuffer.from_file(str(image_path))
+    width, height = buffer.size
+    reduced = buffer.transformed(
+        QTransform.fromScale(0.25, 0.25), QRect(0, 0, width // 4, height // 4)
+    )
+    expected = cv2.resize(
+        np.ascontiguousarray(buffer.array[: height // 4 * 4, : width // 4 * 4]),
+        (width // 4, height // 4),
+        interpolation=cv2.INTER_AREA,
+    )
+    assert np.abs(_pixels(reduced).astype(int) - expected).mean() < 1
+
+    # a quarter turn to the right, only the part in the target
+    rotated = buffer.transformed(
+        QTransform().translate(height, 0).rotate(90), QRect(10, 20, 100, 50)
+    )
+    expected_array = np.rot90(buffer.array, k=-1)[20:70, 10:110]
+    assert np.array_equal(_pixels(rotated), expected_array)
+
+    # outside the image is transparent
+    outside = buffer.transformed(QTransform(), QRect(width - 10, 0, 20, 10))
+    assert (_pixels(outside)[:, 10:, 3] == 0).all()
+    assert (_pixels(outside)[:, :10, 3] == 255).all()
+
+
+def _pixels(qimage: QImage) -> np.ndarray:
+    array = np.frombuffer(qimage.constBits(), dtype=np.uint8)
+    return array.reshape(qimage.height(), qimage.bytesPerLine() // 4, 4)[:, : qimage.width()]
+
+
+def test_image_buffer_invalid_file(tmp_path):
+    filepath = tmp_path / "map.png"
+    filepath.write_text("not an image")
+    with pytest.raises(ValueError):
+        ImageBuffer.from_file(str(filepath))
+
+
+def test_load_image_buffer_preview(app_instance, monkeypatch):
+    monkeypatch.setattr(image_buffer, "preview_size", 200)
+    previews: List[QImage] = []
+    buffer = load_image_buffer(str(image_path), progress=previews.append)
+    assert len(previews) == 1
+    assert max(previews[0].width(), previews[0].height()) == 200
+    assert max(buffer.size) > 200
+
+    # no preview for images that are small already
+    monkeypatch.setattr(image_buffer, "preview_size", max(buffer.size))
+    previews.clear()
+    load_image_buffer(str(image_path), progress=previews.append)
+    assert previews == []
+
+
+def test_decode_size(monkeypatch):
+    buffer_size = QImageReader(str(image_path)).size()
+    width, height = buffer_size.width(), buffer_size.height()
+    assert decode_size(str(image_path)) == buffer_size
+    monkeypatch.setattr(image_buffer, "max_image_bytes", width * height)
+    assert decode_size(str(image_path)) == QSize(width // 2, height // 2)
+    assert not decode_size("missing.jpg").isValid()
+
+
+def test_load_png_beyond_budget(app_instance, monkeypatch):
+    png_path = str(image_path.parent / "19d33097089ed961c4660b3a0bf671e1.png")
+    size = QImageReader(png_path).size()
+    monkeypatch.setattr(image_buffer, "max_image_bytes", size.width() * size.height())
+    # PNG files can't be reduced while decoding, they are refused instead of decoded whole
+    previews: List[QImage] = []
+    with pytest.raises(ValueError, match="save it as JPEG"):
+        load_image_buffer(png_path, progress=previews.append)
+    assert previews == []
+
+
+def test_load_beyond_allocation_limit(app_instance, monkeypatch):
+    expected = ImageBuffer.from_file(str(image_path))
+    allocation_limit = QImageReader.allocationLimit()
+    # the image takes more than 1 MB, Qt refuses it and OpenCV decodes it instead
+    QImageReader.setAllocationLimit(1)
+    try:
+        buffer = load_image_buffer(str(image_path), progress=lambda *_: None)
+        assert buffer.size == expected.size
+        assert np.abs(buffer.array.astype(int) - expected.array).mean() < 2
+
+        width, height = expected.size
+        monkeypatch.setattr(image_buffer, "max_image_bytes", width * height)
+        reduced = load_image_buffer(str(image_path), progress=lambda *_: None)
+        assert reduced.size == (width // 2, height // 2)
+        assert np.abs(reduced.grey().astype(int) - expected.grey(2)).mean() < 5
+    finally:
+        QImageReader.setAllocationLimit(allocation_limit)
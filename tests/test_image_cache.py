@@ -0,0 +1,78 @@
+import shutil
+from pathlib import Path
+
+from PySide6.QtGui import QImage
+
+from battle_map_tv import pixel_cache
+from battle_map_tv.fingerprint import image_fingerprint
+from battle_map_tv.image_buffer import ImageBuffer, decode_size
+from battle_map_tv.image_cache import ImageCache, neighbour_images
+
+image_path = Path(__file__).parent / "images" / "7b1071f5cddcfa565d89dbdce45b9e39.jpg"
+
+
+def _buffer(width: int = 100, height: int = 100) -> ImageBuffer:
+    return ImageBuffer(QImage(width, height, QImage.Format.Format_RGB32))
+
+
+def test_image_cache_evicts_least_recently_used(app_instance):
+    cache = ImageCache()
+    cache.memory_budget = 3 * 100 * 100 * 4
+    for key in "abc":
+        cache.put(key, _buffer())
+    assert cache.get("a") is not None
+    cache.put("d", _buffer())
+    assert cache.get("b") is None
+    assert all(cache.get(key) is not None for key in "acd")
+    assert (cache.hits, cache.misses) == (4, 1)
+
+    # an image larger than the budget is not kept at all
+    cache.put("e", _buffer(200, 200))
+    assert cache.size_bytes == 0
+
+
+def test_image_cache_prefetch(app_instance, qtbot, tmp_path, monkeypatch):
+    monkeypatch.setattr(pixel_cache, "path", str(tmp_path))
+    cache = ImageCache()
+    cache.prefetch(str(image_path))
+    assert cache.is_prefetching()
+    qtbot.waitUntil(lambda: not cache.is_prefetching(), timeout=30000)
+    buffer = cache.get(image_fingerprint(str(image_path)))
+    assert buffer is not None
+    assert buffer.filepath == str(image_path)
+
+    # images that don't fit next to the cached images are not prefetched
+    cache.clear()
+    cache.memory_budget = 1024
+    cache.prefetch(str(image_path))
+    qtbot.waitUntil(lambda: not cache.is_prefetching(), timeout=30000)
+    assert cache.size_bytes == 0
+
+
+def test_image_cache_prefetch_counts_running_prefetches(app_instance, qtbot, tmp_path, monkeypatch):
+    monkeypatch.setattr(pixel_cache, "path", str(tmp_path))
+    image_paths = [str(image_path), str(image_path.parent / "67ce2ff0f7dfbff87d767d2c3da67662.jpg")]
+    n_bytes = [decode_size(path).width() * decode_size(path).height() * 4 for path in image_paths]
+    cache = ImageCache()
+    # room for either image, but not for both
+    cache.memory_budget = max(n_bytes) + min(n_bytes) // 2
+    for path in image_paths:
+        cache.prefetch(path)
+    qtbot.waitUntil(lambda: not cache.is_prefetching(), timeout=30000)
+    cached = [cache.get(image_fingerprint(path)) is not None for path in image_paths]
+    assert cached.count(True) == 1
+
+
+def test_neighbour_images(tmp_path):
+    for name in ["a.jpg", "b.png", "c.txt", "d.JPG", "e.jpg"]:
+        shutil.copy(image_path, tmp_path / name)
+    assert neighbour_images(str(tmp_path / "b.png"), str(tmp_path)) == [
+        str(tmp_path / "d.JPG"),
+        str(tmp_path / "a.jpg"),
+    ]
+    assert neighbour_images(str(tmp_path / "a.jpg"), str(tmp_path), n=2) == [
+        str(tmp_path / "b.png"),
+        str(tmp_path / "d.JPG"),
+    ]
+    assert neighbour_images(str(tmp_path / "c.txt"), str(tmp_path)) == []
+    assert neighbour_images(str(tmp_path / "a.jpg"), None) == []
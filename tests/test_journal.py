@@ -0,0 +1,129 @@
+import json
+import os
+from typing import List
+
+import pytest
+
+from battle_map_tv import journal as journal_module
+from battle_map_tv.journal import SessionJournal, SessionKeys
+
+
+@pytest.fixture
+def journal_filepath(tmp_path):
+    return str(tmp_path / "session.journal")
+
+
+def test_journal_replays_records(journal_filepath):
+    journal = SessionJournal()
+    journal.open(journal_filepath)
+    journal.record(SessionKeys.image, value={"path": "map.jpg"})
+    journal.record(SessionKeys.image, "scale", value=0.5)
+    journal.record(SessionKeys.area_of_effect, "0", value={"shape": "circle"})
+    journal.record(SessionKeys.area_of_effect, "1", value={"shape": "cone"})
+    journal.record(SessionKeys.area_of_effect, "1", "position", value=[10, 20])
+    journal.delete(SessionKeys.area_of_effect, "0")
+    journal.record(SessionKeys.initiative, value="20 heroes")
+    journal.close()
+
+    replayed = SessionJournal()
+    replayed.open(journal_filepath)
+    assert replayed.get(SessionKeys.image) == {"path": "map.jpg", "scale": 0.5}
+    assert replayed.get(SessionKeys.area_of_effect) == {
+        "1": {"shape": "cone", "position": [10, 20]}
+    }
+    assert replayed.get(SessionKeys.initiative) == "20 heroes"
+    assert replayed.get(SessionKeys.grid) is None
+    replayed.close()
+
+
+def test_journal_ignores_incomplete_record(journal_filepath):
+    with open(journal_filepath, "w") as f:
+        f.write(json.dumps([["initiative"], "1 a"]) + "\n")
+        f.write('[["initiative"], "2')
+    journal = SessionJournal()
+    journal.open(journal_filepath)
+    assert journal.get(SessionKeys.initiative) == "1 a"
+    journal.record(SessionKeys.initiative, value="3 c")
+    journal.close()
+
+    journal.open(journal_filepath)
+    assert journal.get(SessionKeys.initiative) == "3 c"
+    journal.close()
+
+
+def test_journal_compacts(journal_filepath):
+    journal = SessionJournal()
+    journal.compact_after = 10
+    journal.open(journal_filepath)
+    for i in range(25):
+        journal.record(SessionKeys.image, "scale", value=i)
+    journal.close()
+    with open(journal_filepath) as f:
+        n_lines = len(f.readlines())
+    assert n_lines < 25
+
+    journal.open(journal_filepath)
+    assert journal.get(SessionKeys.image) == {"scale": 24}
+    journal.close()
+
+
+def test_journal_compacts_with_closed_file(journal_filepath, monkeypatch):
+    journal = SessionJournal()
+    journal.compact_after = 10
+    replace = os.replace
+
+    def replace_closed_file(src, dst):
+        # Windows refuses to replace a file that is still open
+        if journal._file is not None:
+            raise PermissionError(dst)
+        replace(src, dst)
+
+    monkeypatch.setattr(journal_module.os, "replace", replace_closed_file)
+    journal.open(journal_filepath)
+    for i in range(25):
+        journal.record(SessionKeys.image, "scale", value=i)
+        compaction = journal._compaction
+        if compaction is not None:
+            compaction.join()
+    journal.record(SessionKeys.initiative, value="1 a")
+    journal.close()
+    with open(journal_filepath) as f:
+        n_lines = len(f.readlines())
+    assert n_lines < 10
+
+    journal.open(journal_filepath)
+    assert journal.get(SessionKeys.image) == {"scale": 24}
+    assert journal.get(SessionKeys.initiative) == "1 a"
+    journal.close()
+
+
+def test_journal_keeps_appending_after_failed_compaction(journal_filepath, monkeypatch):
+    journal = SessionJournal()
+    journal.compact_after = 10
+    journal.open(journal_filepath)
+    replace = os.replace
+    failures: List[str] = []
+
+    def replace_once_failing(src, dst):
+        if not failures:
+            failures.append(dst)
+            raise PermissionError(dst)
+        replace(src, dst)
+
+    monkeypatch.setattr(journal_module.os, "replace", replace_once_failing)
+    for i in range(25):
+        journal.record(SessionKeys.image, "scale", value=i)
+        compaction = journal._compaction
+        if compaction is not None:
+            compaction.join()
+    assert failures
+    assert journal._compaction is None
+    assert journal._records_during_compaction is None
+    journal.close()
+    with open(journal_filepath) as f:
+        n_lines = len(f.readlines())
+    assert n_lines < 25
+
+    journal.open(journal_filepath)
+    assert journal.get(SessionKeys.image) == {"scale": 24}
+    journal.close()
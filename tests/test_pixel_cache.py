@@ -0,0 +1,81 @@
+import os
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pytest
+from PySide6.QtGui import QImage
+
+from battle_map_tv import pixel_cache
+from battle_map_tv.image_buffer import ImageBuffer
+from battle_map_tv.pixel_cache import get_cached_pixels, load_image_pixels, set_cached_pixels
+
+image_path = Path(__file__).parent / "images" / "19d33097089ed961c4660b3a0bf671e1.png"
+
+
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(pixel_cache, "path", str(tmp_path))
+    return tmp_path
+
+
+def _buffer(width: int = 100, height: int = 100) -> ImageBuffer:
+    qimage = QImage(width, height, QImage.Format.Format_RGB32)
+    qimage.fill(0xFF336699)
+    return ImageBuffer(qimage)
+
+
+def test_pixel_cache_maps_pixels(app_instance):
+    assert get_cached_pixels("abc") is None
+    buffer = ImageBuffer.from_file(str(image_path))
+    set_cached_pixels("abc", buffer)
+
+    cached = get_cached_pixels("abc", filepath=str(image_path))
+    assert cached is not None
+    assert cached.mapped is not None
+    assert cached.filepath == str(image_path)
+    assert cached.qimage.format() == buffer.qimage.format()
+    assert np.array_equal(cached.array, buffer.array)
+    assert np.shares_memory(cached.array, np.frombuffer(cached.mapped, dtype=np.uint8))
+
+
+def test_pixel_cache_invalid_file(app_instance, cache_path):
+    (cache_path / "abc.raw").write_bytes(b"BMTV not an image")
+    assert get_cached_pixels("abc") is None
+
+
+def test_pixel_cache_evicts_least_recently_used(app_instance, cache_path, monkeypatch):
+    monkeypatch.setattr(pixel_cache, "max_size_bytes", 3 * 100 * 100 * 4 + 100)
+    for i, key in enumerate("abc"):
+        set_cached_pixels(key, _buffer())
+        os.utime(cache_path / f"{key}.raw", (i, i))
+    assert get_cached_pixels("a") is not None
+    set_cached_pixels("d", _buffer())
+    assert sorted(os.listdir(cache_path)) == ["a.raw", "c.raw", "d.raw"]
+
+    # an image larger than the whole cache is not written
+    set_cached_pixels("e", _buffer(200, 200))
+    assert not (cache_path / "e.raw").exists()
+
+
+def test_pixel_cache_removes_stale_temporary_files(app_instance, cache_path, monkeypatch):
+    monkeypatch.setattr(pixel_cache, "max_size_bytes", 2 * 100 * 100 * 4 + 100)
+    stale = cache_path / "stale.tmp"
+    stale.write_bytes(b"0" * 100)
+    os.utime(stale, (0, 0))
+    # another write that is still going on, which counts towards the size
+    (cache_path / "writing.tmp").write_bytes(b"0" * 100 * 100 * 4)
+    set_cached_pixels("a", _buffer())
+    os.utime(cache_path / "a.raw", (1, 1))
+    set_cached_pixels("b", _buffer())
+    assert sorted(os.listdir(cache_path)) == ["b.raw", "writing.tmp"]
+
+
+def test_load_image_pixels(app_instance):
+    previews: List[QImage] = []
+    decoded = load_image_pixels(str(image_path), "abc", progress=previews.append)
+    assert decoded.mapped is None
+    # decoded before, it is mapped from the cache
+    cached = load_image_pixels(str(image_path), "abc", progress=previews.append)
+    assert cached.mapped is not None
+    assert np.array_equal(cached.array, decoded.array)
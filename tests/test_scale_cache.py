@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from battle_map_tv import scale_cache
+from battle_map_tv.scale_cache import get_cached_scale, invalidate_cached_scale, set_cached_scale
+from battle_map_tv.scale_detection import AxisScale, ImageScale
+
+
+@pytest.fixture(autouse=True)
+def cache_path(tmp_path, monkeypatch):
+    path = tmp_path / "scale_detection"
+    monkeypatch.setattr(scale_cache, "path", str(path))
+    return path
+
+
+@pytest.fixture
+def image_scale():
+    return ImageScale(
+        horizontal=AxisScale(
+            px_per_inch=50.0, confidence=0.9, rhos=[10.0, 60.0, 110.0], candidates=[50.0, 25.0]
+        ),
+        vertical=AxisScale(px_per_inch=48.0, confidence=0.5, rhos=[5.0, 53.0]),
+    )
+
+
+def test_cached_scale_roundtrip(image_scale):
+    assert get_cached_scale("abc") is None
+    set_cached_scale("abc", image_scale)
+    cached = get_cached_scale("abc")
+    assert cached is not None
+    assert cached == image_scale
+    assert cached.px_per_inch == 50.0
+    assert get_cached_scale("def") is None
+
+
+def test_cached_scale_ignores_other_detection_version(image_scale, cache_path):
+    set_cached_scale("abc", image_scale)
+    filepath = next(cache_path.glob("abc.*.json"))
+    data = json.loads(filepath.read_text())
+    data["version"] -= 1
+    filepath.write_text(json.dumps(data))
+    assert get_cached_scale("abc") is None
+
+
+def test_cached_scale_per_engine(image_scale):
+    set_cached_scale("abc", image_scale, engine="periodicity")
+    assert get_cached_scale("abc", engine="periodicity") == image_scale
+    assert get_cached_scale("abc", engine="hough") is None
+
+
+def test_invalidate_cached_scale(image_scale):
+    set_cached_scale("abc", image_scale, engine="hough")
+    set_cached_scale("abc", image_scale, engine="periodicity")
+    invalidate_cached_scale("abc")
+    assert get_cached_scale("abc", engine="hough") is None
+    assert get_cached_scale("abc", engine="periodicity") is None
+    invalidate_cached_scale("abc")
@@ -1,8 +1,28 @@
+import logging
 from pathlib import Path
 
+import cv2
+import numpy as np
 import pytest
+from PySide6.QtCore import QRect
+from PySide6.QtGui import QImageReader
 
-from battle_map_tv.scale_detection import find_image_scale, merge_close_together_lines
+from battle_map_tv import scale_detection
+from battle_map_tv.image_buffer import ImageBuffer
+from battle_map_tv.scale_detection import (
+    AxisScale,
+    HoughAccumulator,
+    ImageScale,
+    detection_engines,
+    distinct_periods,
+    find_image_scale,
+    grid_phase,
+    image_to_edges,
+    merge_close_together_lines,
+    otsu_threshold,
+    read_grey_crop,
+    refine_engines,
+)
 
 
 def test_merge_close_together_lines():
@@ -12,6 +32,71 @@ def test_merge_close_together_lines():
     assert result == pytest.approx(expected, abs=0.001)
 
 
+@pytest.mark.parametrize("wanted_theta", [0, np.pi / 2])
+def test_hough_accumulator_matches_opencv(wanted_theta):
+    filepath = Path(__file__).parent / "images" / "7b1071f5cddcfa565d89dbdce45b9e39.jpg"
+    edges = image_to_edges(cv2.imread(str(filepath)))
+    accumulator = HoughAccumulator(edges, wanted_theta=wanted_theta)
+    for threshold in [100, 300, 500]:
+        lines = cv2.HoughLines(edges, rho=1, theta=np.pi / 180, threshold=threshold)
+        expected = sorted(rho for rho, theta in lines[:, 0] if abs(theta - wanted_theta) < 0.01)
+        assert accumulator.rhos(threshold) == expected
+
+
+def test_grid_phase():
+    assert grid_phase([13.0, 63.5, 112.5, 163.0], period=50) == pytest.approx(13.0)
+    # lines on either side of a multiple of the period
+    assert grid_phase([49.0, 101.0, 149.0], period=50) in (
+        pytest.approx(49.667, abs=0.01),
+        pytest.approx(0.333, abs=0.01),
+    )
+    assert grid_phase([], period=50) == 0.0
+
+
+def test_distinct_periods(monkeypatch):
+    monkeypatch.setattr(scale_detection, "max_candidates", 3)
+    assert distinct_periods([50.0, 50.5, 100.0, 25.0, 24.9, 12.5]) == [50.0, 100.0, 25.0]
+
+
+def test_image_scale_candidates():
+    image_scale = ImageScale(
+        horizontal=AxisScale(50.0, 0.9, [], candidates=[50.0, 16.0, 49.0]),
+        vertical=AxisScale(33.0, 0.0, [], candidates=[33.0]),
+    )
+    assert image_scale.candidates == [50.0, 100.0, 25.0, 16.0, 33.0]
+
+
+@pytest.mark.parametrize("engine", list(detection_engines))
+def test_detection_candidates(engine):
+    filepath = Path(__file__).parent / "images" / "67ce2ff0f7dfbff87d767d2c3da67662.jpg"
+    candidates = find_image_scale(str(filepath), engine=engine).image_scale.candidates
+    assert candidates[0] == pytest.approx(35, abs=1)
+    assert candidates[1:3] == [pytest.approx(70, abs=2), pytest.approx(17.5, abs=1)]
+
+
+def test_hough_accumulator_of_tiles():
+    filepath = Path(__file__).parent / "images" / "7b1071f5cddcfa565d89dbdce45b9e39.jpg"
+    edges = image_to_edges(cv2.imread(str(filepath)))
+    height, width = edges.shape
+    whole = HoughAccumulator(edges, wanted_theta=0)
+    tiles = HoughAccumulator(edges[:300], wanted_theta=0, image_size=(width, height))
+    tiles += HoughAccumulator(
+        edges[300:], wanted_theta=0, offset=(0, 300), image_size=(width, height)
+    )
+    assert np.array_equal(tiles.votes, whole.votes)
+    assert tiles.rhos(300) == whole.rhos(300)
+
+
+def test_otsu_threshold():
+    filepath = Path(__file__).parent / "images" / "f46702b17442d0be4acc06cb7aa25ab8.jpg"
+    grey = cv2.imread(str(filepath), cv2.IMREAD_GRAYSCALE)
+    assert grey is not None
+    expected, _ = cv2.threshold(grey, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    histogram = cv2.calcHist([grey], [0], None, [256], [0, 256]).ravel()
+    assert otsu_threshold(histogram) == expected
+
+
+@pytest.mark.parametrize("engine", list(detection_engines))
 @pytest.mark.parametrize(
     "image_filename, expected_px_per_inch",
     [
@@ -27,8 +112,153 @@ def test_merge_close_together_lines():
         ("pux2idlwle65yipahqnmukisnss54cyv.jpg", 73),
     ],
 )
-def test_addition(image_filename, expected_px_per_inch):
+def test_addition(image_filename, expected_px_per_inch, engine):
     filepath = Path(__file__).parent / "images" / image_filename
     assert filepath.exists()
-    px_per_inch = find_image_scale(str(filepath))
-    assert abs(px_per_inch - expected_px_per_inch) <= 1
+    result = find_image_scale(str(filepath), engine=engine)
+    assert abs(result.px_per_inch - expected_px_per_inch) <= 1
+
+
+@pytest.mark.parametrize("engine", list(detection_engines))
+@pytest.mark.parametrize(
+    "image_filename, expected_px_per_inch",
+    [
+        ("6932a173690af4b593f8a6b52df3bd31.jpg", 72),
+        ("58fed75f78a991251930918a5793051d.jpg", 70),
+        ("e586d099df4e4c0eb82726f6373d964f.jpg", 72),
+    ],
+)
+@pytest.mark.parametrize("from_buffer", [False, True])
+def test_coarse_to_fine(
+    image_filename, expected_px_per_inch, engine, from_buffer, monkeypatch, app_instance
+):
+    monkeypatch.setattr(scale_detection, "coarse_to_fine_min_size", 0)
+    monkeypatch.setattr(scale_detection, "coarse_size", 1000)
+    filepath = Path(__file__).parent / "images" / image_filename
+    image = ImageBuffer.from_file(str(filepath)) if from_buffer else str(filepath)
+    assert scale_detection.reduction_factor(*scale_detection.read_image_size(image)) > 1
+    result = find_image_scale(image, engine=engine)
+    assert abs(result.px_per_inch - expected_px_per_inch) <= 1
+
+
+def test_coarse_to_fine_png_is_decoded_once(monkeypatch, app_instance):
+    filepath = str(Path(__file__).parent / "images" / "19d33097089ed961c4660b3a0bf671e1.png")
+    expected = find_image_scale(filepath, tiled=False)
+    monkeypatch.setattr(scale_detection, "coarse_to_fine_min_size", 0)
+    monkeypatch.setattr(scale_detection, "coarse_size", 300)
+
+    # the refine crops the full resolution of the coarse read, instead of decoding it again
+    def read_grey_crop(*_):
+        raise AssertionError("decoded again")
+
+    monkeypatch.setattr(scale_detection, "read_grey_crop", read_grey_crop)
+    assert scale_detection.reduction_factor(*scale_detection.read_image_size(filepath)) > 1
+    result = find_image_scale(filepath, tiled=False)
+    assert result.px_per_inch == pytest.approx(expected.px_per_inch, abs=0.5)
+
+
+@pytest.mark.parametrize("engine", list(refine_engines))
+def test_refine_engines(engine):
+    period = 37.3
+    edges = np.zeros((1024, 1024), dtype=np.uint8)
+    for rho in np.arange(5, 1024, period):
+        edges[round(rho), :] = 255
+    # detected on an image reduced by 4, at half the period
+    coarse = AxisScale(18.5, 1.0, [float(rho) for rho in np.arange(1.25, 256, 18.5)])
+    refined = refine_engines[engine](
+        edges, coarse, factor=4, wanted_theta=np.pi / 2, offset=0, length=2048
+    )
+    assert refined.px_per_inch == pytest.approx(period, abs=0.1)
+    assert refined.rhos[-1] > 2000
+
+
+def test_read_grey_crop_beyond_allocation_limit(app_instance):
+    filepath = str(Path(__file__).parent / "images" / "19d33097089ed961c4660b3a0bf671e1.png")
+    crop = QRect(100, 50, 300, 200)
+    allocation_limit = QImageReader.allocationLimit()
+    QImageReader.setAllocationLimit(1)
+    try:
+        grey = read_grey_crop(filepath, crop)
+        # the limit is not lifted to read the whole image
+        assert QImageReader.allocationLimit() == 1
+    finally:
+        QImageReader.setAllocationLimit(allocation_limit)
+    expected = cv2.imread(filepath, cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION)
+    assert expected is not None
+    assert np.array_equal(grey, expected[50:250, 100:400])
+
+
+def test_time_budget():
+    filepath = Path(__file__).parent / "images" / "58fed75f78a991251930918a5793051d.jpg"
+    result = find_image_scale(str(filepath), time_budget=60)
+    assert not result.timed_out
+    assert abs(result.px_per_inch - 70) <= 1
+    assert "refine" in result.seconds
+
+    # out of time right away, the coarse result is not refined
+    result = find_image_scale(str(filepath), time_budget=0)
+    assert result.timed_out
+    assert result.steps == {"horizontal": 1, "vertical": 1}
+    assert "refine" not in result.seconds
+
+
+def test_find_image_scale_result():
+    filepath = Path(__file__).parent / "images" / "7b1071f5cddcfa565d89dbdce45b9e39.jpg"
+    events = []
+    result = find_image_scale(
+        str(filepath), engine="hough", trace=lambda name, values: events.append((name, values))
+    )
+    assert result.engine == "hough"
+    assert result.px_per_inch == result.image_scale.px_per_inch
+    assert set(result.steps) == {"horizontal", "vertical"}
+    assert list(result.seconds) == ["decode", "canny", "hough", "merge"]
+    steps = [values for name, values in events if name == "step"]
+    assert len(steps) == sum(result.steps.values())
+    axes = {values["axis"]: values for name, values in events if name == "axis"}
+    assert axes["horizontal"]["px_per_inch"] == result.image_scale.horizontal.px_per_inch
+    assert axes["vertical"]["lines"] == len(result.image_scale.vertical.rhos)
+
+
+@pytest.mark.parametrize("engine", list(detection_engines))
+@pytest.mark.parametrize(
+    "image_filename",
+    ["6932a173690af4b593f8a6b52df3bd31.jpg", "e586d099df4e4c0eb82726f6373d964f.jpg"],
+)
+def test_tiled(image_filename, engine, monkeypatch):
+    monkeypatch.setattr(scale_detection, "coarse_to_fine_min_size", None)
+    monkeypatch.setattr(scale_detection, "memory_budget", 0)
+    # search both axes to the end, so that which axis finishes first doesn't matter
+    monkeypatch.setattr(scale_detection, "stop_confidence", 2.0)
+    filepath = Path(__file__).parent / "images" / image_filename
+    whole = find_image_scale(str(filepath), engine=engine, tiled=False)
+    tiled = find_image_scale(str(filepath), engine=engine, tiled=True)
+    for whole_axis, tiled_axis in zip(whole.image_scale, tiled.image_scale):
+        assert tiled_axis.px_per_inch == pytest.approx(whole_axis.px_per_inch, abs=0.01)
+
+
+def test_tiled_edges_only_for_the_engine(monkeypatch):
+    monkeypatch.setattr(scale_detection, "memory_budget", 0)
+    filepath = str(Path(__file__).parent / "images" / "6932a173690af4b593f8a6b52df3bd31.jpg")
+    trace = scale_detection.DetectionTrace()
+    edges = scale_detection.read_tiled_edges(filepath, trace=trace, periodicity=False)
+    assert edges.profiles == {}
+    assert "periodicity" not in trace.seconds
+
+    # the lines of an axis that was not searched are placed with the Hough votes instead
+    whole_edges = image_to_edges(cv2.imread(filepath))
+    for wanted_theta in (np.pi / 2, 0):
+        tiled = scale_detection.lines_at_period(edges, 72, wanted_theta=wanted_theta)
+        whole = scale_detection.lines_at_period(whole_edges, 72, wanted_theta=wanted_theta)
+        difference = (tiled.rhos[0] - whole.rhos[0] + 36) % 72 - 36
+        assert abs(difference) <= 4
+
+
+def test_tiled_edges_beyond_budget(monkeypatch, caplog):
+    # the grey image alone takes up more than the budget
+    monkeypatch.setattr(scale_detection, "memory_budget", 1)
+    monkeypatch.setattr(scale_detection, "min_tile_height", 100)
+    filepath = str(Path(__file__).parent / "images" / "6932a173690af4b593f8a6b52df3bd31.jpg")
+    with caplog.at_level(logging.DEBUG, logger=scale_detection.__name__):
+        edges = scale_detection.read_tiled_edges(filepath, trace=scale_detection.DetectionTrace())
+    assert "tiles of 100 rows" in caplog.text
+    assert set(edges.profiles) == {"horizontal", "vertical"}
@@ -0,0 +1,206 @@
+import json
+
+import pytest
+
+from battle_map_tv import storage
+from battle_map_tv.storage import (
+    ImageKeys,
+    StorageKeys,
+    flush_storage,
+    get_from_storage,
+    get_image_from_storage,
+    set_image_in_storage,
+    set_in_storage,
+)
+from battle_map_tv.storage_backends import JsonBackend, SqliteBackend, StorageStats
+
+
+def test_storage_reads_file_once(config_filepath):
+    config_filepath.write_text(json.dumps({"pixels_per_square": 33}))
+    for _ in range(10):
+        assert get_from_storage(StorageKeys.pixels_per_square) == 33
+    assert storage.storage_stats.reads == 1
+    assert storage.storage_stats.reads_avoided == 9
+
+
+def test_storage_coalesces_writes(config_filepath, qapp):
+    for value in range(10):
+        set_image_in_storage("map.jpg", ImageKeys.scale, value)
+    set_in_storage(StorageKeys.pixels_per_square, 50)
+    assert not config_filepath.exists()
+    assert storage.storage_stats.writes_avoided == 10
+
+    flush_storage()
+    assert storage.storage_stats.writes == 1
+    data = json.loads(config_filepath.read_text())
+    assert data == {"map.jpg": {"scale": 9}, "pixels_per_square": 50}
+    assert not list(config_filepath.parent.glob("*.tmp"))
+
+
+def test_storage_flushes_on_timer(config_filepath, qtbot, monkeypatch):
+    monkeypatch.setattr(storage, "flush_interval_ms", 10)
+    set_image_in_storage("map.jpg", ImageKeys.rotation, 90)
+    qtbot.waitUntil(config_filepath.exists, timeout=1000)
+    storage.reset_storage_cache()
+    assert get_image_from_storage("map.jpg", ImageKeys.rotation) == 90
+
+
+def test_sqlite_backend_migrates_json_config(config_filepath, qapp):
+    config_filepath.write_text(
+        json.dumps({"pixels_per_square": 33, "map.jpg": {"scale": 0.5, "rotation": 90}})
+    )
+    storage.use_storage_backend("sqlite")
+    assert get_from_storage(StorageKeys.pixels_per_square) == 33
+    assert get_image_from_storage("map.jpg", ImageKeys.scale) == 0.5
+
+    set_image_in_storage("map.jpg", ImageKeys.scale, 0.75)
+    set_image_in_storage("other.jpg", ImageKeys.rotation, 180)
+    storage.reset_storage_cache()
+
+    # the database is used from now on, also without asking for it
+    storage.use_storage_backend()
+    assert isinstance(storage._Cache.backend, storage.SqliteBackend)
+    assert get_image_from_storage("map.jpg", ImageKeys.scale) == 0.75
+    assert get_image_from_storage("map.jpg", ImageKeys.rotation) == 90
+    assert get_image_from_storage("other.jpg", ImageKeys.rotation) == 180
+    with pytest.raises(KeyError):
+        get_image_from_storage("unknown.jpg", ImageKeys.rotation)
+
+
+def test_storage_backend_is_remembered(config_filepath, qapp):
+    storage.use_storage_backend("sqlite")
+    set_in_storage(StorageKeys.pixels_per_square, 33)
+    storage.use_storage_backend("json")
+    set_in_storage(StorageKeys.pixels_per_square, 44)
+    storage.reset_storage_cache()
+
+    # back to json, even though the database exists
+    storage.use_storage_backend()
+    assert isinstance(storage._Cache.backend, JsonBackend)
+    assert get_from_storage(StorageKeys.pixels_per_square) == 44
+
+
+def test_storage_backend_switch_carries_over(config_filepath, qapp, caplog):
+    storage.use_storage_backend("json")
+    set_image_in_storage("map.jpg", ImageKeys.scale, 0.5)
+    set_image_in_storage("gone.jpg", ImageKeys.scale, 0.5)
+    storage.use_storage_backend("sqlite")
+    set_image_in_storage("map.jpg", ImageKeys.scale, 0.75)
+    set_in_storage(StorageKeys.pixels_per_square, 33)
+
+    # what was stored in the database is written to the json config
+    storage.use_storage_backend("json")
+    assert get_image_from_storage("map.jpg", ImageKeys.scale) == 0.75
+    assert get_from_storage(StorageKeys.pixels_per_square) == 33
+    set_image_in_storage("map.jpg", ImageKeys.scale, 1.0)
+    storage.reset_storage_cache()
+    data = json.loads(config_filepath.read_text())
+    del data["gone.jpg"]
+    config_filepath.write_text(json.dumps(data))
+
+    # and back, the database is replaced with the json config
+    storage.use_storage_backend("sqlite")
+    assert get_image_from_storage("map.jpg", ImageKeys.scale) == 1.0
+    assert get_image_from_storage("gone.jpg", ImageKeys.scale, default=None) is None
+    storage.reset_storage_cache()
+
+    # a json config that changed while the database is in use is not imported, but reported
+    config_filepath.write_text(json.dumps({"map.jpg": {"scale": 2.0}}))
+    storage.use_storage_backend()
+    assert get_image_from_storage("map.jpg", ImageKeys.scale) == 1.0
+    assert "--storage json" in caplog.text
+
+
+def test_sqlite_backend_counts_pending_images(tmp_path):
+    backend = SqliteBackend(filepath=str(tmp_path / "config.sqlite3"), stats=StorageStats())
+    backend.set_image("map.jpg", "scale", 0.5)
+    assert backend.count_images() == 1
+    backend.close()
+
+
+def test_storage_backend_is_abstract():
+    with pytest.raises(TypeError):
+        storage.StorageBackend(filepath="config.json", stats=storage.StorageStats())  # type: ignore[abstract]
+
+
+@pytest.mark.parametrize("backend_name", ["json", "sqlite"])
+def test_storage_evicts_least_recently_used_images(config_filepath, monkeypatch, backend_name):
+    monkeypatch.setattr(storage, "max_stored_images", 3)
+    storage.use_storage_backend(backend_name)
+    for i in range(5):
+        set_image_in_storage(f"map{i}.jpg", ImageKeys.scale, i)
+    # use the oldest image again, so it is kept
+    get_image_from_storage("map0.jpg", ImageKeys.scale)
+    set_image_in_storage("map5.jpg", ImageKeys.scale, 5)
+    set_in_storage(StorageKeys.pixels_per_square, 50)
+    storage.reset_storage_cache()
+
+    assert get_from_storage(StorageKeys.pixels_per_square) == 50
+    for i in (0, 4, 5):
+        assert get_image_from_storage(f"map{i}.jpg", ImageKeys.scale) == i
+    for i in (1, 2, 3):
+        with pytest.raises(KeyError):
+            get_image_from_storage(f"map{i}.jpg", ImageKeys.scale)
+
+
+@pytest.mark.parametrize("backend_name", ["json", "sqlite"])
+def test_storage_without_images(config_filepath, backend_name):
+    storage.use_storage_backend(backend_name)
+    assert get_image_from_storage("map.jpg", ImageKeys.scale, default=None) is None
+    with pytest.raises(KeyError):
+        get_image_from_storage("map.jpg", ImageKeys.scale)
+
+
+@pytest.mark.parametrize("backend_name", ["json", "sqlite"])
+def test_storage_remembers_images_that_are_only_read(config_filepath, monkeypatch, backend_name):
+    monkeypatch.setattr(storage, "max_stored_images", 3)
+    storage.use_storage_backend(backend_name)
+    for i in range(3):
+        set_image_in_storage(f"map{i}.jpg", ImageKeys.scale, i)
+    storage.reset_storage_cache()
+    get_image_from_storage("map0.jpg", ImageKeys.scale)
+    storage.reset_storage_cache()
+
+    set_image_in_storage("map3.jpg", ImageKeys.scale, 3)
+    storage.reset_storage_cache()
+    assert get_image_from_storage("map0.jpg", ImageKeys.scale) == 0
+    with pytest.raises(KeyError):
+        get_image_from_storage("map1.jpg", ImageKeys.scale)
+
+
+@pytest.mark.parametrize("backend_name", ["json", "sqlite"])
+def test_compact_storage(config_filepath, monkeypatch, qapp, backend_name):
+    storage.use_storage_backend(backend_name)
+    for i in range(500):
+        set_image_in_storage(f"map{i}.jpg", ImageKeys.position, [i, i])
+    flush_storage()
+
+    monkeypatch.setattr(storage, "max_stored_images", 10)
+    before, after = storage.compact_storage()
+    assert before["images"] == 500
+    assert after["images"] == 10
+    assert after["size_bytes"] < before["size_bytes"]
+    assert get_image_from_storage("map499.jpg", ImageKeys.position) == [499, 499]
+
+    # the next write keeps it as small
+    size_bytes = after["size_bytes"]
+    set_image_in_storage("map499.jpg", ImageKeys.position, [1, 1])
+    flush_storage()
+    storage.reset_storage_cache()
+    storage._get_backend()
+    assert storage.storage_stats.size_bytes <= size_bytes
+
+
+@pytest.mark.parametrize("backend_name", ["json", "sqlite"])
+def test_rename_image_in_storage(config_filepath, backend_name):
+    storage.use_storage_backend(backend_name)
+    set_image_in_storage("map.jpg", ImageKeys.scale, 0.5)
+    set_image_in_storage("taken", ImageKeys.scale, 2)
+    storage.rename_image_in_storage("map.jpg", "abc123")
+    storage.rename_image_in_storage("abc123", "taken")
+    storage.reset_storage_cache()
+
+    assert get_image_from_storage("abc123", ImageKeys.scale) == 0.5
+    assert get_image_from_storage("taken", ImageKeys.scale) == 2
+    with pytest.raises(KeyError):
+        get_image_from_storage("map.jpg", ImageKeys.scale)
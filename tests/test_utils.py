@@ -0,0 +1,27 @@
+import os
+
+import pytest
+
+from battle_map_tv.utils import atomic_write
+
+
+def test_atomic_write(tmp_path):
+    filepath = str(tmp_path / "file.json")
+    with atomic_write(filepath) as f:
+        f.write("new")
+    with open(filepath) as f:
+        assert f.read() == "new"
+    assert os.listdir(tmp_path) == ["file.json"]
+
+
+def test_atomic_write_error_keeps_file(tmp_path):
+    filepath = str(tmp_path / "file.json")
+    with open(filepath, "w") as f:
+        f.write("old")
+    with pytest.raises(ValueError):
+        with atomic_write(filepath) as f:
+            f.write("half")
+            raise ValueError
+    with open(filepath) as f:
+        assert f.read() == "old"
+    assert os.listdir(tmp_path) == ["file.json"]
@@ -0,0 +1,312 @@
+from pathlib import Path
+
+import pytest
+from PySide6.QtCore import QEvent, QPointF, QRectF, Qt
+from PySide6.QtGui import QImage, QMouseEvent
+from PySide6.QtWidgets import QLabel, QPushButton
+
+from battle_map_tv import (
+    image_buffer,
+    pixel_cache,
+    scale_cache,
+    scale_detection,
+    window_image,
+)
+from battle_map_tv.image_cache import image_cache
+from battle_map_tv.journal import session_journal
+from battle_map_tv.layouts.grid_controls import GridControls
+from battle_map_tv.layouts.initiative_controls import InitiativeTextArea
+from battle_map_tv.scale_cache import get_cached_scale
+from battle_map_tv.settings import Settings
+from battle_map_tv.utils import find_child_by_attribute
+from battle_map_tv.window_gui import GuiWindow
+from battle_map_tv.window_image import ImageWindow
+
+image_path = Path(__file__).parents[1] / "images" / "67ce2ff0f7dfbff87d767d2c3da67662.jpg"
+
+
+@pytest.fixture(autouse=True)
+def isolated_storage(config_filepath, tmp_path, monkeypatch, qtbot):
+    monkeypatch.setattr(scale_cache, "path", str(tmp_path / "scale_detection"))
+    monkeypatch.setattr(pixel_cache, "path", str(tmp_path / "pixels"))
+    # a result that ran out of time is not cached, which a busy machine should not change,
+    # test_autoscale_time_budget runs with a budget
+    monkeypatch.setattr(scale_detection, "quick_time_budget", None)
+    image_cache.clear()
+    yield
+    # prefetches that are still running would end up in the next test
+    qtbot.waitUntil(lambda: not image_cache.is_prefetching(), timeout=30000)
+    image_cache.clear()
+
+
+def test_add_image_in_background(image_window, qtbot):
+    with qtbot.waitSignal(image_window.image_loaded, timeout=30000):
+        image_window.add_image(str(image_path))
+        image = image_window.image
+        width, height = image.pixmap_item.image_size
+        # a preview is stretched over the whole image
+        image.set_preview(QImage(width // 4, height // 4, QImage.Format.Format_RGB32))
+        assert image.pixmap_item.pixmap_factor == pytest.approx(4, abs=0.1)
+        assert image.pixmap_item.boundingRect() == QRectF(0, 0, width, height)
+    assert image.buffer is not None
+    assert image.pixmap_item.pixmap_factor == 1
+    assert image.pixmap_item.buffer is image.buffer
+
+
+def test_missing_image(image_window, tmp_path, monkeypatch):
+    missing_path = str(tmp_path / "missing.jpg")
+    with pytest.raises(ValueError):
+        image_window.add_image(missing_path)
+    assert image_window.image is None
+
+    monkeypatch.setattr(window_image.session_journal, "state", {"image": {"path": missing_path}})
+    image_window.restore_session()
+    assert image_window.image is None
+
+
+def test_image_load_failed(image_window, gui_window, qtbot, tmp_path):
+    # the size can be read, but not the pixels
+    broken_path = tmp_path / "broken.png"
+    broken_path.write_bytes(
+        (image_path.parent / "19d33097089ed961c4660b3a0bf671e1.png").read_bytes()[:200]
+    )
+    with qtbot.waitSignal(image_window.image_load_failed, timeout=30000):
+        image_window.add_image(str(broken_path))
+    assert not image_window.is_loading_image()
+    assert image_window.image.buffer is None
+    # the error is shown in the controls
+    assert any("broken.png" in label.text() for label in gui_window.findChildren(QLabel))
+
+
+def test_switch_back_from_cache(image_window, gui_window, qtbot):
+    with qtbot.waitSignal(image_window.image_loaded, timeout=30000):
+        image_window.add_image(str(image_path))
+    buffer = image_window.image.buffer
+    other_path = image_path.parent / "7b1071f5cddcfa565d89dbdce45b9e39.jpg"
+    image_window.remove_image()
+    with qtbot.waitSignal(image_window.image_loaded, timeout=30000):
+        image_window.add_image(str(other_path))
+
+    # the previous image is still decoded, it is shown right away
+    image_window.remove_image()
+    image_window.add_image(str(image_path))
+    assert not image_window.is_loading_image()
+    assert image_window.image.buffer is buffer
+    assert image_cache.hits == 1
+
+
+def test_open_from_pixel_cache(image_window, gui_window, qtbot):
+    with qtbot.waitSignal(image_window.image_loaded, timeout=30000):
+        image_window.add_image(str(image_path))
+    assert image_window.image.buffer.mapped is None
+    image_key = image_window.image.image_key
+    qtbot.waitUntil(lambda: pixel_cache.get_cached_pixels(image_key) is not None, timeout=30000)
+
+    # not decoded again when it is no longer in memory
+    image_window.remove_image()
+    image_cache.clear()
+    with qtbot.waitSignal(image_window.image_loaded, timeout=30000):
+        image_window.add_image(str(image_path))
+    assert image_window.image.buffer.mapped is not None
+
+
+def test_prefetch_neighbours(image_window, gui_window, qtbot, monkeypatch):
+    monkeypatch.setitem(Settings._values, "default_directory", str(image_path.parent))
+    monkeypatch.setattr(window_image, "prefetch_neighbours", 1)
+    with qtbot.waitSignal(image_window.image_loaded, timeout=30000):
+        image_window.add_image(str(image_path))
+    qtbot.waitUntil(lambda: not image_cache.is_prefetching(), timeout=30000)
+
+    # the next image in the directory is decoded already
+    image_window.remove_image()
+    image_window.add_image(str(image_path.parent / "675a18475269c17cfa20c980e7c05ea0.jpg"))
+    assert not image_window.is_loading_image()
+    assert image_window.image.buffer is not None
+
+
+def test_autoscale_in_background(image_window, gui_window, qtbot):
+    image_window.add_image(str(image_path))
+    image_window.grid.set_size(70)
+    button = find_child_by_attribute(gui_window, QPushButton, "Autoscale")
+
+    with qtbot.waitSignal(image_window.autoscale_finished, timeout=30000):
+        qtbot.mouseClick(button, Qt.LeftButton)  # type: ignore[attr-defined]
+        assert button.text() == "Cancel"
+    assert button.text() == "Autoscale"
+    assert image_window.image.pixmap_item.scale() == pytest.approx(2.0, abs=0.1)
+    assert get_cached_scale(image_window.image.image_key) is not None
+
+    # the second time the cached result is used right away
+    image_window.image.scale(1.0)
+    qtbot.mouseClick(button, Qt.LeftButton)  # type: ignore[attr-defined]
+    assert not image_window.is_autoscaling()
+    assert image_window.image.pixmap_item.scale() == pytest.approx(2.0, abs=0.1)
+
+
+def test_autoscale_reduced_image(image_window, gui_window, qtbot, monkeypatch):
+    # decoded at 0.7 times the resolution
+    monkeypatch.setattr(image_buffer, "max_image_bytes", int(800 * 555 * 4 * 0.49))
+    with qtbot.waitSignal(image_window.image_loaded, timeout=30000):
+        image_window.add_image(str(image_path))
+    assert image_window.image.pixmap_item.pixmap_factor == pytest.approx(1 / 0.7, rel=0.01)
+    image_window.grid.set_size(70)
+
+    # the scale is of the image file, like that of the full resolution
+    with qtbot.waitSignal(image_window.autoscale_finished, timeout=30000):
+        image_window.autoscale_image()
+    assert image_window.image.pixmap_item.scale() == pytest.approx(2.0, abs=0.1)
+    image_scale = get_cached_scale(image_window.image.image_key)
+    assert image_scale is not None
+    assert image_scale.px_per_inch == pytest.approx(35, abs=1)
+
+
+def test_autoscale_next_candidate(image_window, gui_window, qtbot):
+    image_window.add_image(str(image_path))
+    image_window.grid.set_size(70)
+    button = find_child_by_attribute(gui_window, QPushButton, "Autoscale")
+    with qtbot.waitSignal(image_window.autoscale_finished, timeout=30000):
+        qtbot.mouseClick(button, Qt.LeftButton)  # type: ignore[attr-defined]
+    assert image_window.image.pixmap_item.scale() == pytest.approx(2.0, abs=0.1)
+
+    # pressed again, the grid may be twice or half the detected size
+    qtbot.mouseClick(button, Qt.LeftButton)  # type: ignore[attr-defined]
+    assert not image_window.is_autoscaling()
+    assert image_window.image.pixmap_item.scale() == pytest.approx(1.0, abs=0.05)
+    qtbot.mouseClick(button, Qt.LeftButton)  # type: ignore[attr-defined]
+    assert image_window.image.pixmap_item.scale() == pytest.approx(4.0, abs=0.2)
+
+
+def test_autoscale_cancel(image_window, gui_window, qtbot):
+    image_window.add_image(str(image_path))
+    button = find_child_by_attribute(gui_window, QPushButton, "Autoscale")
+
+    with qtbot.waitSignal(image_window.autoscale_finished, timeout=30000):
+        qtbot.mouseClick(button, Qt.LeftButton)  # type: ignore[attr-defined]
+        qtbot.mouseClick(button, Qt.LeftButton)  # type: ignore[attr-defined]
+    assert button.text() == "Autoscale"
+    assert get_cached_scale(image_window.image.image_key) is None
+
+
+def test_refine(image_window, gui_window, qtbot):
+    image_window.add_image(str(image_path))
+    image_window.grid.set_size(70)
+    image_window.autoscale_image()
+    qtbot.waitUntil(lambda: not image_window.is_autoscaling(), timeout=30000)
+    image_window.image.scale(1.0)
+    button = find_child_by_attribute(gui_window, QPushButton, "Refine")
+
+    with qtbot.waitSignal(image_window.autoscale_finished, timeout=30000):
+        qtbot.mouseClick(button, Qt.LeftButton)  # type: ignore[attr-defined]
+    assert image_window.image.pixmap_item.scale() == pytest.approx(2.0, abs=0.1)
+    assert get_cached_scale(image_window.image.image_key) is not None
+
+
+def test_align(image_window, gui_window, qtbot):
+    image_window.add_image(str(image_path))
+    image_window.grid.set_size(70)
+    image_window.image.rotate()
+    button = find_child_by_attribute(gui_window, QPushButton, "Align")
+
+    with qtbot.waitSignal(image_window.autoscale_finished, timeout=30000):
+        qtbot.mouseClick(button, Qt.LeftButton)  # type: ignore[attr-defined]
+    image_scale = get_cached_scale(image_window.image.image_key)
+    assert image_scale is not None
+    assert image_window.image.pixmap_item.scale() == pytest.approx(2.0, abs=0.1)
+    crossing = image_window.image.pixmap_item.mapToScene(
+        QPointF(image_scale.vertical.phase, image_scale.horizontal.phase)
+    )
+    grid = image_window.grid
+    for axis, value in enumerate((crossing.x(), crossing.y())):
+        distance = (value - grid.offset[axis]) % grid.pixels_per_square
+        assert min(distance, grid.pixels_per_square - distance) <= 1
+
+
+def test_autoscale_time_budget(image_window, gui_window, qtbot, monkeypatch):
+    # a budget that runs out right away
+    monkeypatch.setattr(scale_detection, "quick_time_budget", 1e-6)
+    image_window.add_image(str(image_path))
+    image_window.grid.set_size(70)
+    button = find_child_by_attribute(gui_window, QPushButton, "Autoscale")
+
+    with qtbot.waitSignal(image_window.autoscale_finished, timeout=30000):
+        qtbot.mouseClick(button, Qt.LeftButton)  # type: ignore[attr-defined]
+    assert button.text() == "Autoscale"
+    # the quick result is used, but not cached, so it can be refined
+    assert get_cached_scale(image_window.image.image_key) is None
+
+    # autoscale again moves on to the next candidate of that result, without detecting again
+    image = image_window.image
+    candidates = image.image_scale.candidates
+    with qtbot.assertNotEmitted(image_window.autoscale_started):
+        qtbot.mouseClick(button, Qt.LeftButton)  # type: ignore[attr-defined]
+    assert image.pixmap_item.scale() == pytest.approx(70 / candidates[1], abs=1e-5)
+
+
+def _mouse_event(event_type: QEvent.Type, x: int, y: int) -> QMouseEvent:
+    point = QPointF(x, y)
+    return QMouseEvent(
+        event_type,
+        point,
+        point,
+        Qt.MouseButton.LeftButton,
+        Qt.MouseButton.LeftButton,
+        Qt.KeyboardModifier.NoModifier,
+    )
+
+
+def test_restore_session(image_window, gui_window, qtbot, tmp_path):
+    session_journal.open(str(tmp_path / "session.journal"))
+    try:
+        with qtbot.waitSignal(image_window.image_loaded, timeout=30000):
+            image_window.add_image(str(image_path))
+        image_window.image.set_rotation(90)
+        image_window.image.scale(0.5)
+        image_window.image.pixmap_item.set_position((300, 200))
+        grid_controls = find_child_by_attribute(gui_window, GridControls)
+        grid_controls.slider_grid_size.setValue(70)
+        grid_controls.button_toggle_grid.click()
+        grid_controls.slider_grid_color.setValue(120)
+        initiative = find_child_by_attribute(gui_window, InitiativeTextArea)
+        with qtbot.waitSignal(initiative.textChangedDebounced):
+            initiative.setPlainText("20 heroes")
+        manager = image_window.area_of_effect_manager
+        manager.wait_for("circle", callback=lambda: None)
+        manager.mouse_press_event(_mouse_event(QEvent.Type.MouseButtonPress, 100, 100))
+        manager.mouse_release_event(_mouse_event(QEvent.Type.MouseButtonRelease, 150, 100))
+        session_journal.close()
+
+        # start over, like the app does on startup
+        image_window.close()
+        image_window.setObjectName("")
+        gui_window.close()
+        session_journal.open(str(tmp_path / "session.journal"))
+        restored_image_window = ImageWindow()
+        qtbot.addWidget(restored_image_window)
+        restored_gui_window = GuiWindow()
+        qtbot.addWidget(restored_gui_window)
+        with qtbot.waitSignal(restored_image_window.image_loaded, timeout=30000):
+            restored_image_window.restore_session()
+        restored_initiative = find_child_by_attribute(restored_gui_window, InitiativeTextArea)
+        with qtbot.waitSignal(restored_initiative.textChangedDebounced):
+            restored_gui_window.restore_session()
+
+        image = restored_image_window.image
+        assert image is not None
+        assert image.filepath == str(image_path)
+        assert image.rotation == 90
+        assert image.pixmap_item.scale() == 0.5
+        position = image.pixmap_item.pos() + QPointF(*image.pixmap_item.image_size) / 2
+        assert (position.x(), position.y()) == pytest.approx((300, 200), abs=1)
+        assert restored_image_window.grid.pixels_per_square == 70
+        assert restored_image_window.grid_overlay is not None
+        restored_grid_controls = find_child_by_attribute(restored_gui_window, GridControls)
+        assert restored_grid_controls.slider_grid_color.value() == 120
+        assert restored_initiative.toPlainText() == "20 heroes"
+        assert restored_image_window.initiative_overlay_manager.overlays
+        shapes = restored_image_window.area_of_effect_manager._store
+        assert [shape.shape_id for shape in shapes] == ["0"]
+        restored_gui_window.close()
+        restored_image_window.close()
+        restored_image_window.setObjectName("")
+    finally:
+        session_journal.close()
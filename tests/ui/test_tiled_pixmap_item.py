@@ -0,0 +1,116 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PySide6.QtCore import QRectF, Qt
+from PySide6.QtGui import QImage, QPainter
+from PySide6.QtWidgets import QGraphicsScene
+
+from battle_map_tv import image
+from battle_map_tv.image import TiledPixmapItem
+from battle_map_tv.image_buffer import ImageBuffer
+
+image_path = Path(__file__).parents[1] / "images" / "58fed75f78a991251930918a5793051d.jpg"
+
+
+def render(scene: QGraphicsScene, source: QRectF, scale: float) -> QImage:
+    output = QImage(
+        round(source.width() * scale), round(source.height() * scale), QImage.Format.Format_RGB32
+    )
+    output.fill(0)
+    painter = QPainter(output)
+    scene.render(painter, QRectF(output.rect()), source)
+    painter.end()
+    return output
+
+
+def pixels(qimage: QImage) -> np.ndarray:
+    array = np.frombuffer(qimage.constBits(), dtype=np.uint8)
+    return array.reshape(qimage.height(), qimage.bytesPerLine())[:, : qimage.width() * 4]
+
+
+@pytest.fixture
+def scene(app_instance):
+    return QGraphicsScene()
+
+
+@pytest.fixture
+def item(scene):
+    buffer = ImageBuffer.from_file(str(image_path))
+    item = TiledPixmapItem(image_key="abc", image_size=buffer.size, buffer=buffer)
+    scene.addItem(item)
+    return item
+
+
+def test_paints_tiles_of_matching_level(scene, item):
+    width, height = item.image_size
+    output = render(scene, QRectF(0, 0, width, height), scale=0.25)
+    assert {level for level, _, _ in item._tiles} == {2}
+    assert item.buffer is not None
+    expected = item.buffer.qimage.scaled(
+        output.width(),
+        output.height(),
+        Qt.AspectRatioMode.IgnoreAspectRatio,
+        Qt.TransformationMode.SmoothTransformation,
+    )
+    difference = np.abs(pixels(output).astype(int) - pixels(expected))
+    assert difference.mean() < 2
+
+
+def test_paints_only_visible_tiles(scene, item):
+    tile_size = image.tile_size
+    render(scene, QRectF(0, 0, tile_size * 1.5, tile_size / 2), scale=1)
+    assert set(item._tiles) == {(0, 0, 0), (0, 1, 0)}
+
+
+def test_paints_resampled_pixmap_once_still(scene, item, qtbot, monkeypatch):
+    monkeypatch.setattr(image, "resample_delay_ms", 0)
+    item.setRotation(30)
+    source = item.sceneBoundingRect()
+    tiled = render(scene, source, scale=0.2)
+    qtbot.waitUntil(lambda: item._screen_pixmap is not None, timeout=10000)
+
+    item._tiles.clear()
+    resampled = render(scene, source, scale=0.2)
+    assert not item._tiles
+    difference = np.abs(pixels(resampled).astype(int) - pixels(tiled))
+    assert difference.mean() < 3
+
+    # a new transform paints the tiles again, until it is resampled as well
+    render(scene, source, scale=0.3)
+    assert item._tiles
+
+
+def test_resamples_again_after_preview(scene, qtbot, monkeypatch):
+    monkeypatch.setattr(image, "resample_delay_ms", 0)
+    buffer = ImageBuffer.from_file(str(image_path))
+    width, height = buffer.size
+    preview = ImageBuffer(buffer.qimage.scaled(width // 4, height // 4))
+    item = TiledPixmapItem(image_key="abc", image_size=buffer.size, buffer=preview)
+    scene.addItem(item)
+    source = item.sceneBoundingRect()
+    render(scene, source, scale=0.5)
+    qtbot.waitUntil(lambda: item._screen_pixmap is not None, timeout=10000)
+
+    # the same transform is resampled from the loaded image
+    item.set_buffer(buffer)
+    render(scene, source, scale=0.5)
+    assert item._screen_pixmap is None
+    qtbot.waitUntil(lambda: item._screen_pixmap is not None, timeout=10000)
+    resampled = render(scene, source, scale=0.5)
+    expected = buffer.qimage.scaled(
+        resampled.width(),
+        resampled.height(),
+        Qt.AspectRatioMode.IgnoreAspectRatio,
+        Qt.TransformationMode.SmoothTransformation,
+    )
+    difference = np.abs(pixels(resampled).astype(int) - pixels(expected))
+    assert difference.mean() < 3
+
+
+def test_tile_cache_is_limited(scene, item, monkeypatch):
+    monkeypatch.setattr(image, "tile_cache_bytes", 2 * image.tile_size**2 * 4)
+    width, height = item.image_size
+    render(scene, QRectF(0, 0, width, height), scale=1)
+    assert item._tiles_bytes <= image.tile_cache_bytes
+    assert len(item._tiles) < -(-width // image.tile_size) * -(-height // image.tile_size)